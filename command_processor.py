@@ -6,17 +6,21 @@ Contains the response generated by a command request.
 # TODO - Add documentation on all of "pip installs" required
 
 import sys
-import time
+import signal
 import datetime
-import Queue
 import math
-from multiprocessing import Queue as MPQueue
 import serial  # Requires "pyserial"
 import text
 from fona_manager import FonaManager
+from fona_manager import PRIORITY_ALERT, PRIORITY_REPLY, PRIORITY_BROADCAST
 from Sensors import Sensors
 from relay_controller import RelayManager
 from lib.recurring_task import RecurringTask
+from lib.serial_supervisor import SerialSupervisor
+from lib.event_bus import EventBus
+import lib.wakeup as wakeup
+import lib.task_telemetry as task_telemetry
+import lib.lifecycle as lifecycle
 import lib.utilities as utilities
 import lib.local_debug as local_debug
 from lib.logger import Logger
@@ -38,6 +42,26 @@ VALID_COMMANDS = {text.FULL_STATUS_COMMAND,
                   text.RESTART_COMMAND,
                   text.QUIT_COMMAND}
 
+# A write that can not finish in this many seconds
+# means the modem is gone.
+SERIAL_WRITE_TIMEOUT = 10
+
+# The service loop wakes at least this often
+# even if nothing signals it.
+MAXIMUM_IDLE_SECONDS = 30
+
+# Alerts about the same condition. When the rate limit
+# holds them back only the latest of each kind is sent.
+GAS_ALERT_KIND = "gas"
+BATTERY_ALERT_KIND = "battery"
+
+# "kill -USR1" the process to write this file.
+TASK_DIAGNOSTICS_FILE = "task_diagnostics.txt"
+
+# Every timer and worker must be stopped within
+# this many seconds of being told to quit.
+SHUTDOWN_TIMEOUT = 0.9
+
 
 class CommandResponse(object):
     """
@@ -68,6 +92,28 @@ class CommandResponse(object):
         self.__message__ = message
 
 
+class GasSensorReading(object):
+    """
+    Event carrying a reading from the gas sensor.
+    """
+
+    __slots__ = ("is_gas_detected", "level")
+
+    def get_status_text(self):
+        """
+        Returns the reading as it is sent in messages.
+        """
+
+        if self.is_gas_detected:
+            return text.GAS_WARNING + ", level=" + str(self.level)
+
+        return text.GAS_OK + ", level=" + str(self.level)
+
+    def __init__(self, is_gas_detected, level):
+        self.is_gas_detected = is_gas_detected
+        self.level = level
+
+
 # Main business logic of the HangarBuddy
 # Takes the incoming texts, figures out
 # if they should be acted on,
@@ -87,8 +133,15 @@ class CommandProcessor(object):
         """
         self.__logger__.log_info_message('Press Ctrl-C to quit.')
 
+        # Windows has no SIGUSR1.
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self.__request_diagnostics__)
+
+        # systemd and "shutdown" send SIGTERM.
+        signal.signal(signal.SIGTERM, self.__stop_running__)
+
         # This can be safely used off the main thread.
-        # and writes into the MPqueue...
+        # and publishes on the event bus...
         # It kicks off every 30 seconds
 
         RecurringTask("monitor_gas_sensor", 30,
@@ -99,14 +152,31 @@ class CommandProcessor(object):
 
         RecurringTask("update_lcd", 5, self.__update_lcd__, self.__logger__)
 
-        # The main service loop
-        while True:
-            self.__run_servicer__(self.__service_gas_sensor_queue__,
-                                  "Gas sensor queue")
-            self.__relay_controller__.update()
-            self.__run_servicer__(self.__process_pending_text_messages__,
-                                  "Incoming request queue")
-            self.__fona_manager__.update()
+        # The main service loop. Sleeps until something
+        # signals work, or until the next deadline.
+        try:
+            while self.__is_running__:
+                self.__run_servicer__(self.__service_gas_sensor_queue__,
+                                      "Gas sensor queue")
+                self.__relay_controller__.update()
+                self.__run_servicer__(self.__process_pending_text_messages__,
+                                      "Incoming request queue")
+                self.__fona_manager__.update()
+
+                if self.__diagnostics_requested__:
+                    self.__diagnostics_requested__ = False
+                    self.__write_diagnostics__()
+
+                if not self.__is_running__:
+                    break
+
+                self.__wakeup__.wait(wakeup.get_seconds_until(
+                    [self.__relay_controller__.get_next_update_time(),
+                     self.__fona_manager__.get_next_update_time()],
+                    MAXIMUM_IDLE_SECONDS))
+        finally:
+            self.__logger__.log_info_message("Stopping background tasks.")
+            lifecycle.get_default_manager().shutdown(SHUTDOWN_TIMEOUT)
 
     def is_gas_detected(self):
         """
@@ -149,25 +219,42 @@ class CommandProcessor(object):
         self.__is_gas_detected__ = False
         self.__system_start_time__ = datetime.datetime.now()
         self.__sensors__ = Sensors(buddy_configuration)
+        self.__wakeup__ = wakeup.Wakeup()
+        self.__event_bus__ = EventBus(self.__wakeup__)
+        self.__is_running__ = True
+        self.__diagnostics_requested__ = False
+        lifecycle.get_default_manager().set_logger(logger)
 
+        self.__serial_supervisor__ = None
         serial_connection = self.__initialize_modem__()
         if serial_connection is None and not local_debug.is_debug():
             self.__logger__.log_warning_message(
-                "Unable to initialize serial connection, quiting.")
-            sys.exit()
+                "Unable to initialize serial connection, will keep trying.")
 
         self.__fona_manager__ = FonaManager(self.__logger__,
                                             serial_connection,
                                             self.__configuration__.cell_power_status_pin,
                                             self.__configuration__.cell_ring_indicator_pin,
-                                            self.__configuration__.utc_offset)
+                                            self.__configuration__.utc_offset,
+                                            self.__configuration__.outbound_journal_filename,
+                                            self.__configuration__.sms_rate_limit_per_hour,
+                                            self.__configuration__.sms_rate_limit_burst,
+                                            self.__configuration__.sms_recipient_rate_limit_per_hour,
+                                            self.__configuration__.sms_recipient_rate_limit_burst,
+                                            self.__serial_supervisor__,
+                                            self.__configuration__.modem_baud_rate,
+                                            self.__wakeup__,
+                                            self.__event_bus__)
 
         # create heater relay instance
         self.__relay_controller__ = RelayManager(buddy_configuration, logger,
                                                  self.__heater_turned_on_callback__,
                                                  self.__heater_turned_off_callback__,
-                                                 self.__heater_max_time_off_callback__)
-        self.__gas_sensor_queue__ = MPQueue()
+                                                 self.__heater_max_time_off_callback__,
+                                                 self.__wakeup__,
+                                                 self.__event_bus__)
+        self.__gas_sensor_readings__ = self.__event_bus__.subscribe(
+            GasSensorReading, self.__gas_sensor_reading_received__)
 
         self.__logger__.log_info_message(
             "Starting SMS monitoring and heater service")
@@ -318,6 +405,12 @@ class CommandProcessor(object):
             status += self.__get_light_status__() + "\n"
             status += self.__get_temp_probe_status__() + "\n"
             status += self.__get_fona_status__() + "\n"
+
+            for problem_status in [self.__fona_manager__.get_problem_statistics_text(),
+                                   task_telemetry.get_status_text()]:
+                if problem_status is not None:
+                    status += problem_status + "\n"
+
             status += self.__get_uptime_status__()
         except:
             status += "ERROR"
@@ -366,7 +459,7 @@ class CommandProcessor(object):
     #-- Message queing
     ##############################
 
-    def __queue_message__(self, phone_number, message):
+    def __queue_message__(self, phone_number, message, priority=PRIORITY_REPLY):
         """
         Puts a request to send a message into the queue.
         """
@@ -374,19 +467,28 @@ class CommandProcessor(object):
             self.__logger__.log_info_message(
                 "MSG - " + phone_number + " : " + utilities.escape(message))
             if not self.__configuration__.test_mode:
-                self.__fona_manager__.send_message(phone_number, message)
+                self.__fona_manager__.send_message(phone_number, message, priority=priority)
 
             return True
 
         return False
 
-    def __queue_message_to_all_numbers__(self, message):
+    def __queue_message_to_all_numbers__(self,
+                                         message,
+                                         priority=PRIORITY_BROADCAST,
+                                         alert_kind=None):
         """
         Puts a request to send a message to all numbers into the queue.
         """
 
-        for phone_number in self.__configuration__.allowed_phone_numbers:
-            self.__queue_message__(phone_number, message)
+        if self.__fona_manager__ is not None and message is not None:
+            self.__logger__.log_info_message(
+                "MSG - ALL : " + utilities.escape(message))
+            if not self.__configuration__.test_mode:
+                self.__fona_manager__.send_broadcast(self.__configuration__.allowed_phone_numbers,
+                                                     message,
+                                                     priority=priority,
+                                                     alert_kind=alert_kind)
 
         return message
 
@@ -553,7 +655,7 @@ class CommandProcessor(object):
 
         if self.__is_gas_detected__:
             cleared_message = "Gas warning cleared. " + gas_sensor_status
-            self.__queue_message_to_all_numbers__(cleared_message)
+            self.__queue_message_to_all_numbers__(cleared_message, PRIORITY_ALERT, GAS_ALERT_KIND)
             self.__logger__.log_info_message(
                 "Turning detected flag off.")
             self.__is_gas_detected__ = False
@@ -568,7 +670,7 @@ class CommandProcessor(object):
             if self.__relay_controller__.is_relay_on():
                 gas_status += "SHUTTING HEATER DOWN"
 
-            self.__queue_message_to_all_numbers__(gas_status)
+            self.__queue_message_to_all_numbers__(gas_status, PRIORITY_ALERT, GAS_ALERT_KIND)
             self.__logger__.log_warning_message(
                 "Turning detected flag on.")
             self.__is_gas_detected__ = True
@@ -618,9 +720,10 @@ class CommandProcessor(object):
                 self.__logger__.log_warning_message(
                     "CR: Issue restarting")
         elif command_response.get_command() == text.QUIT_COMMAND:
+            self.__stop_running__()
+
             try:
                 self.__lcd__.write_text("Quiting")
-                exit()
             except:
                 self.__logger__.log_warning_message(
                     "ERROR trying to quit."
@@ -697,16 +800,54 @@ class CommandProcessor(object):
             "SHUTDOWN: Shutting down HangarBuddy.")
         utilities.shutdown()
 
-    def __clear_queue__(self, queue):
+    def __stop_running__(self, signal_number=None, stack_frame=None):
         """
-        Clears a given queue.
+        Ends the service loop after the current pass.
+        Also the SIGTERM handler.
         """
-        if queue is None:
-            return False
 
-        while not queue.empty():
-            self.__logger__.log_info_message("cleared message from queue.")
-            queue.get()
+        self.__is_running__ = False
+        self.__wakeup__.signal()
+
+    def __request_diagnostics__(self, signal_number, stack_frame):
+        """
+        The SIGUSR1 handler. The service loop writes the
+        diagnostics, as a handler must not take the locks
+        the counters are read under.
+        """
+
+        self.__diagnostics_requested__ = True
+        self.__wakeup__.signal()
+
+    def __get_diagnostics_lines__(self):
+        """
+        Returns the messaging, serial and event counters
+        that are too detailed for the status message.
+        """
+
+        lines = [self.__fona_manager__.get_send_statistics_text(),
+                 self.__fona_manager__.get_throttle_statistics_text(),
+                 self.__fona_manager__.get_delivery_statistics_text(),
+                 self.__fona_manager__.get_serial_statistics_text(),
+                 self.__fona_manager__.get_connection_statistics_text(),
+                 self.__event_bus__.get_status_text()]
+
+        return [line for line in lines if line is not None]
+
+    def __write_diagnostics__(self):
+        """
+        Writes the messaging, serial and event counters, then
+        how every recurring task is running, with the last
+        exception each one raised.
+        """
+
+        diagnostics_path = self.__configuration__.get_log_directory() + TASK_DIAGNOSTICS_FILE
+
+        if task_telemetry.write_diagnostics(diagnostics_path,
+                                            self.__get_diagnostics_lines__()):
+            self.__logger__.log_info_message("Diagnostics written to " + diagnostics_path)
+        else:
+            self.__logger__.log_warning_message("Unable to write diagnostics.")
 
     ##############################
     #-- Recurring thread tasks
@@ -731,24 +872,24 @@ class CommandProcessor(object):
         # If gas is detected, send an immediate warning to
         # all of the phone numberss
         if detected:
-            self.__clear_queue__(self.__gas_sensor_queue__)
+            # clear the queue if it has a bunch of no warnings in it
+            for stale_reading in self.__gas_sensor_readings__.get_pending():
+                self.__logger__.log_info_message(
+                    "cleared " + stale_reading.get_status_text() + " from queue.")
 
             status = "WARNING!! GAS DETECTED!!! Level = " + \
                 str(current_level)
 
             if self.__relay_controller__.is_relay_on():
                 status += ", TURNING HEATER OFF."
-                # clear the queue if it has a bunch of no warnings in it
 
             self.__logger__.log_warning_message(status)
-            self.__gas_sensor_queue__.put(
-                text.GAS_WARNING + ", level=" + str(current_level))
-            self.__logger__.heater_queue.put(text.HEATER_OFF_COMMAND)
-            self.__queue_message_to_all_numbers__(status)
+            self.__event_bus__.publish(GasSensorReading(True, current_level))
+            self.__relay_controller__.turn_off()
+            self.__queue_message_to_all_numbers__(status, PRIORITY_ALERT, GAS_ALERT_KIND)
         else:
             self.__logger__.log_info_message("Sending OK into queue", False)
-            self.__gas_sensor_queue__.put(
-                text.GAS_OK + ", level=" + str(current_level))
+            self.__event_bus__.publish(GasSensorReading(False, current_level))
 
     def __monitor_fona_health__(self):
         """
@@ -765,7 +906,8 @@ class CommandProcessor(object):
         if not cbc.is_battery_ok():
             low_battery_message = "WARNING: LOW BATTERY for Fona. Currently " + \
                 str(cbc.get_percent_battery()) + "%"
-            self.__queue_message_to_all_numbers__(low_battery_message)
+            self.__queue_message_to_all_numbers__(low_battery_message, PRIORITY_ALERT,
+                                                  BATTERY_ALERT_KIND)
             self.__logger__.log_warning_message(low_battery_message)
 
     def __update_lcd__(self):
@@ -818,37 +960,40 @@ class CommandProcessor(object):
     #-- Initializers
     ##############################
 
-    def __initialize_modem__(self, retries=4, seconds_between_retries=10):
+    def __initialize_modem__(self):
         """
         Attempts to initialize the modem over the serial port.
+        If the port can not be opened, or is lost later,
+        the serial supervisor keeps trying to reopen it.
         """
 
-        serial_connection = None
-
         if local_debug.is_debug():
             return None
 
-        while retries > 0 and serial_connection is None:
-            try:
-                self.__logger__.log_info_message(
-                    "Opening on " + self.__configuration__.cell_serial_port)
+        self.__serial_supervisor__ = SerialSupervisor(self.__open_serial_connection__,
+                                                      self.__logger__)
 
-                serial_connection = serial.Serial(
-                    self.__configuration__.cell_serial_port,
-                    self.__configuration__.cell_baud_rate)
-            except:
-                self.__logger__.log_warning_message(
-                    "SERIAL DEVICE NOT LOCATED."
-                    + " Try changing /dev/ttyUSB0 to different USB port"
-                    + " (like /dev/ttyUSB1) in configuration file or"
-                    + " check to make sure device is connected correctly")
+        return self.__serial_supervisor__.connect()
 
-                # wait 60 seconds and check again
-                time.sleep(seconds_between_retries)
+    def __open_serial_connection__(self):
+        """
+        Opens the serial port to the modem.
+        """
 
-            retries -= 1
+        self.__logger__.log_info_message(
+            "Opening on " + self.__configuration__.cell_serial_port)
 
-        return serial_connection
+        try:
+            return serial.Serial(self.__configuration__.cell_serial_port,
+                                 self.__configuration__.cell_baud_rate,
+                                 writeTimeout=SERIAL_WRITE_TIMEOUT)
+        except:
+            self.__logger__.log_warning_message(
+                "SERIAL DEVICE NOT LOCATED."
+                + " Try changing /dev/ttyUSB0 to different USB port"
+                + " (like /dev/ttyUSB1) in configuration file or"
+                + " check to make sure device is connected correctly")
+            raise
 
     def __initialize_lcd__(self):
         """
@@ -869,24 +1014,22 @@ class CommandProcessor(object):
         from the gas sensor.
         """
 
-        try:
-            while not self.__gas_sensor_queue__.empty():
-                gas_sensor_status = self.__gas_sensor_queue__.get()
+        self.__gas_sensor_readings__.dispatch()
 
-                if gas_sensor_status is None:
-                    self.__logger__.log_warning_message("Gas sensor was None.")
-                else:
-                    self.__logger__.log_info_message(
-                        "Q:" + gas_sensor_status, False)
+        return self.__is_gas_detected__
 
-                if text.GAS_WARNING in gas_sensor_status:
-                    self.__handle_gas_warning__(gas_sensor_status)
-                elif text.GAS_OK in gas_sensor_status:
-                    self.__handle_gas_ok__(gas_sensor_status)
-        except Queue.Empty:
-            pass
+    def __gas_sensor_reading_received__(self, gas_sensor_reading):
+        """
+        Handles one reading from the gas sensor.
+        """
 
-        return self.__is_gas_detected__
+        gas_sensor_status = gas_sensor_reading.get_status_text()
+        self.__logger__.log_info_message("Q:" + gas_sensor_status, False)
+
+        if gas_sensor_reading.is_gas_detected:
+            self.__handle_gas_warning__(gas_sensor_status)
+        else:
+            self.__handle_gas_ok__(gas_sensor_status)
 
     def __process_pending_text_messages__(self):
         """
@@ -918,6 +1061,14 @@ class CommandProcessor(object):
                 messages_processed_count += 1
                 self.__fona_manager__.delete_message(message)
 
+                # Never act on a message that could not be read,
+                # or on part of a multipart message.
+                if not message.is_message_ok():
+                    self.__logger__.log_warning_message(
+                        "Ignoring an unreadable or incomplete message from "
+                        + str(message.sender_number))
+                    continue
+
                 if message.minutes_waiting() > self.__configuration__.oldest_message:
                     old_message = "MSG too old, " + \
                         str(message.minutes_waiting()) + " minutes old."
@@ -991,6 +1142,54 @@ def test_valid_commands():
         assert command_response.get_message() == message
 
 
+class FakeFonaManager(object):
+    """
+    Stand in for the FonaManager that hands out
+    the given messages once.
+    """
+
+    def is_message_waiting(self):
+        return len(self.messages) > 0
+
+    def get_messages(self):
+        messages = self.messages
+        self.messages = []
+        return messages
+
+    def delete_message(self, message):
+        self.deleted.append(message)
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.deleted = []
+
+
+def test_incomplete_message_is_not_executed():
+    """
+    Test that part one of a two part message that
+    timed out is deleted without being run as a command.
+    """
+    import time
+    import logging
+    from lib.sms_reassembly import MultipartReassembler, FakeMessagePart
+
+    reassembler = MultipartReassembler(0)
+    reassembler.add_message(FakeMessagePart("1", text.HEATER_ON_COMMAND, (7, 2, 1)))
+    time.sleep(0.01)
+    expired_messages = reassembler.get_expired_messages()
+    assert len(expired_messages) == 1
+
+    executed = []
+    processor = CommandProcessor.__new__(CommandProcessor)
+    processor.__logger__ = Logger(logging.getLogger("test"))
+    processor.__fona_manager__ = FakeFonaManager(expired_messages)
+    processor.__process_message__ = lambda *args: executed.append(args)
+
+    assert processor.__process_pending_text_messages__()
+    assert executed == []
+    assert processor.__fona_manager__.deleted == expired_messages
+
+
 #############
 # SELF TEST #
 #############
@@ -32,6 +32,16 @@ class Configuration(object):
 
         return self.__config_parser__.get('SETTINGS', 'LOGFILE_DIRECTORY')
 
+    def __get_optional_int__(self, setting, default_value):
+        """
+        Returns an integer setting, or the default if it is not set.
+        """
+
+        try:
+            return self.__config_parser__.getint('SETTINGS', setting)
+        except:
+            return default_value
+
     def __init__(self):
         print "SETTINGS" + get_config_file_location()
 
@@ -76,6 +86,27 @@ class Configuration(object):
         except:
             self.test_mode = False
 
+        try:
+            self.outbound_journal_filename = self.__config_parser__.get(
+                'SETTINGS', 'OUTBOUND_JOURNAL_FILE')
+        except:
+            self.outbound_journal_filename = self.get_log_directory() + "outbound_journal.log"
+
+        # Rate limits are in message segments.
+        self.sms_rate_limit_per_hour = self.__get_optional_int__(
+            'SMS_RATE_LIMIT_PER_HOUR', 120)
+        self.sms_rate_limit_burst = self.__get_optional_int__(
+            'SMS_RATE_LIMIT_BURST', 20)
+        self.sms_recipient_rate_limit_per_hour = self.__get_optional_int__(
+            'SMS_RECIPIENT_RATE_LIMIT_PER_HOUR', 40)
+        self.sms_recipient_rate_limit_burst = self.__get_optional_int__(
+            'SMS_RECIPIENT_RATE_LIMIT_BURST', 10)
+
+        # The port opens at BAUDRATE, then the modem
+        # is moved up to this rate if it is set.
+        self.modem_baud_rate = self.__get_optional_int__(
+            'MODEM_BAUDRATE', None)
+
 
 ##################
 ### UNIT TESTS ###
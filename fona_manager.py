@@ -5,11 +5,81 @@ the Fona in a thread safe way.
 import sys
 import threading
 import time
-from multiprocessing import Queue as MPQueue
-import text
+import itertools
+import heapq
+import Queue
+from collections import OrderedDict
 import lib.local_debug as local_debug
 import lib.fona as fona
-from lib.recurring_task import RecurringTask
+from lib.latency_histogram import LatencyHistogram
+from lib.message_journal import MessageJournal
+from lib.priority_message_queue import PriorityMessageQueue
+import lib.backoff as backoff
+import lib.utilities as utilities
+from lib.token_bucket import TokenBucket
+from lib.delivery_tracker import DeliveryTracker
+
+# Outbound message classes, most urgent first.
+PRIORITY_ALERT = 0
+PRIORITY_REPLY = 1
+PRIORITY_BROADCAST = 2
+PRIORITY_NAMES = ["alert", "reply", "broadcast"]
+
+# Delivery states for each recipient of a broadcast.
+DELIVERY_QUEUED = "queued"
+DELIVERY_SENT = "sent"
+DELIVERY_DELIVERED = "delivered"
+DELIVERY_RETRYING = "retrying"
+DELIVERY_FAILED = "failed"
+DELIVERY_EXPIRED = "expired"
+DELIVERY_COLLAPSED = "collapsed"
+
+
+class OutboundMessage(object):
+    """
+    A text message waiting to be sent.
+    """
+
+    def to_record(self):
+        """
+        Returns the message as a dictionary for the journal.
+        """
+
+        return {"id": self.message_id,
+                "phone_number": self.phone_number,
+                "text": self.encoded_message.text,
+                "retries_remaining": self.retries_remaining,
+                "queued_time": self.queued_time,
+                "priority": self.priority,
+                "alert_kind": self.alert_kind}
+
+    def __init__(self,
+                 message_id,
+                 phone_number,
+                 text_message,
+                 retries_remaining,
+                 priority=PRIORITY_REPLY,
+                 queued_time=None,
+                 alert_kind=None):
+        """
+        Create the message.
+        Messages with the same alert kind report the
+        same condition, so only the latest matters.
+        """
+
+        if queued_time is None:
+            queued_time = time.time()
+
+        self.message_id = message_id
+        self.phone_number = phone_number
+        self.encoded_message = fona.EncodedMessage(text_message)
+        self.retries_remaining = retries_remaining
+        self.priority = priority
+        self.queued_time = queued_time
+        self.alert_kind = alert_kind
+        self.attempt_count = 0
+        self.was_throttled = False
+        self.broadcast_ids = []
 
 
 class FonaManager(object):
@@ -23,9 +93,16 @@ class FonaManager(object):
     and other monitoring of the device.
     """
 
-    CHECK_SIGNAL_INTERVAL = 60  # Once a minute
-    CHECK_BATTERY_INTERVAL = 60 * 5  # Every five minutes
     DEFAULT_RETRY_ATTEMPTS = 4
+    MAXIMUM_MESSAGE_AGE = 60 * 60 * 2  # Two hours
+    REGISTRATION_CHECK_INTERVAL = 30
+    DEFAULT_RATE_LIMIT_PER_HOUR = 120  # Segments, all recipients
+    DEFAULT_RATE_LIMIT_BURST = 20
+    DEFAULT_RECIPIENT_RATE_LIMIT_PER_HOUR = 40  # Segments, each recipient
+    DEFAULT_RECIPIENT_RATE_LIMIT_BURST = 10
+    COALESCE_WINDOW = 2  # Seconds to wait for more messages to the same number
+    MAXIMUM_COALESCED_SEGMENTS = 4
+    MAXIMUM_TRACKED_BROADCASTS = 32
 
     def is_power_on(self):
         """
@@ -41,21 +118,273 @@ class FonaManager(object):
         ... on a single thread...
         """
 
+        self.__process_connection__()
         self.__process_status_updates__()
+        self.__process_delivery_reports__()
         self.__process_send_messages__()
 
     def send_message(self,
                      phone_number,
                      text_message,
-                     maximum_number_of_retries=DEFAULT_RETRY_ATTEMPTS):
+                     maximum_number_of_retries=DEFAULT_RETRY_ATTEMPTS,
+                     priority=PRIORITY_REPLY,
+                     alert_kind=None):
         """
         Queues the message to be sent out.
+        The text is transliterated to GSM 7 bit where that is
+        safe, and the segment count is worked out before sending.
+        The message is journaled so it survives a restart.
+
+        This does not wait on the send lock, so an alert
+        queued while other messages are going out is
+        sent next.
+
+        Anything other than an alert is held for a moment
+        so it can be merged with other messages to the
+        same number.
+
+        A message held by the rate limit is replaced by a
+        later one with the same alert kind.
         """
 
-        self.__lock__.acquire(True)
-        self.__send_message_queue__.put(
-            [phone_number, text_message, maximum_number_of_retries])
-        self.__lock__.release()
+        self.__queue_outbound_message__(phone_number,
+                                        text_message,
+                                        maximum_number_of_retries,
+                                        priority,
+                                        alert_kind=alert_kind)
+
+    def send_broadcast(self,
+                       phone_numbers,
+                       text_message,
+                       maximum_number_of_retries=DEFAULT_RETRY_ATTEMPTS,
+                       priority=PRIORITY_BROADCAST,
+                       alert_kind=None):
+        """
+        Queues the same message for each number.
+        The copies are sent together in one modem session.
+        Returns an id that can be passed to get_broadcast_state.
+        """
+
+        broadcast_id = next(self.__broadcast_ids__)
+
+        self.__broadcast_lock__.acquire(True)
+        try:
+            self.__broadcasts__[broadcast_id] = OrderedDict()
+
+            while len(self.__broadcasts__) > self.MAXIMUM_TRACKED_BROADCASTS:
+                self.__broadcasts__.popitem(False)
+        finally:
+            self.__broadcast_lock__.release()
+
+        for phone_number in phone_numbers:
+            self.__queue_outbound_message__(phone_number,
+                                            text_message,
+                                            maximum_number_of_retries,
+                                            priority,
+                                            broadcast_id,
+                                            alert_kind)
+
+        return broadcast_id
+
+    def get_broadcast_state(self, broadcast_id):
+        """
+        Returns the delivery state of each recipient of a
+        broadcast, keyed by phone number, or None if the
+        broadcast is no longer tracked.
+        """
+
+        self.__broadcast_lock__.acquire(True)
+        try:
+            if broadcast_id not in self.__broadcasts__:
+                return None
+
+            return dict(self.__broadcasts__[broadcast_id])
+        finally:
+            self.__broadcast_lock__.release()
+
+    def get_send_statistics(self):
+        """
+        Returns the sent message counts, keyed by name.
+        """
+
+        return {"messages": self.__messages_sent__,
+                "segments": self.__segments_sent__,
+                "ucs2_messages": self.__ucs2_messages_sent__,
+                "transliterated_messages": self.__transliterated_messages_sent__,
+                "coalesced_messages": self.__messages_coalesced__}
+
+    def get_retry_statistics(self):
+        """
+        Returns the retry counts, keyed by name.
+        """
+
+        return {"retries_scheduled": self.__retries_scheduled__,
+                "retries_waiting": len(self.__retry_schedule__),
+                "messages_expired": self.__messages_expired__,
+                "messages_abandoned": self.__messages_abandoned__,
+                "waiting_for_network": self.__network_wait_started__ is not None}
+
+    def get_delivery_statistics(self):
+        """
+        Returns the delivery report counts, keyed by name.
+        """
+
+        return {"delivered": self.__messages_delivered__,
+                "failed": self.__delivery_failures__,
+                "awaiting_report": self.__delivery_tracker__.get_pending_count(),
+                "untracked": self.__delivery_tracker__.get_evicted_count()}
+
+    def get_delivery_statistics_text(self):
+        """
+        Returns a short description of the delivery reports.
+        """
+
+        return "Delivered:" + str(self.__messages_delivered__) \
+            + " Failed:" + str(self.__delivery_failures__) \
+            + " Awaiting:" + str(self.__delivery_tracker__.get_pending_count())
+
+    def get_throttle_statistics(self):
+        """
+        Returns the rate limiting counts, keyed by name.
+        """
+
+        return {"messages_throttled": self.__messages_throttled__,
+                "messages_collapsed": self.__messages_collapsed__,
+                "throttled_waiting": len(self.__throttle_schedule__)}
+
+    def get_throttle_statistics_text(self):
+        """
+        Returns a short description of the rate limiting.
+        """
+
+        return "Throttled:" + str(self.__messages_throttled__) \
+            + " Collapsed:" + str(self.__messages_collapsed__) \
+            + " Waiting:" + str(len(self.__throttle_schedule__))
+
+    def get_problem_statistics_text(self):
+        """
+        Returns a short description of the messages held back
+        by rate limiting or expired unsent, or None if none were.
+        """
+
+        if self.__messages_throttled__ < 1 and self.__messages_expired__ < 1:
+            return None
+
+        return "Throttled:" + str(self.__messages_throttled__) \
+            + " Expired:" + str(self.__messages_expired__)
+
+    def get_next_update_time(self):
+        """
+        Returns the earliest time update() has work that
+        nothing will signal: a held message coming due, a
+        registration check, or the modem needing a look.
+        Returns None if there is nothing scheduled.
+        """
+
+        update_times = [self.__fona__.get_next_update_time()]
+
+        if len(self.__retry_schedule__) > 0:
+            update_times.append(self.__retry_schedule__[0][0])
+
+        if len(self.__throttle_schedule__) > 0:
+            update_times.append(self.__throttle_schedule__[0][0])
+
+        if self.__network_wait_started__ is not None:
+            update_times.append(self.__last_registration_check__
+                                + self.REGISTRATION_CHECK_INTERVAL)
+
+        self.__coalesce_lock__.acquire(True)
+        try:
+            for window_start, recipient_messages in self.__coalescing_messages__.values():
+                update_times.append(window_start + self.COALESCE_WINDOW)
+        finally:
+            self.__coalesce_lock__.release()
+
+        update_times = [update_time for update_time in update_times if update_time is not None]
+
+        if len(update_times) < 1:
+            return None
+
+        return min(update_times)
+
+    def get_queue_depths(self):
+        """
+        Returns the number of messages waiting, keyed by priority name.
+        """
+
+        return dict((priority_name, self.__send_message_queue__.get_depth(priority))
+                    for priority, priority_name in enumerate(PRIORITY_NAMES))
+
+    def get_queue_wait_times(self):
+        """
+        Returns the histograms of how long messages waited
+        to be sent, keyed by priority name.
+        """
+
+        return dict(zip(PRIORITY_NAMES, self.__send_message_queue__.get_wait_times()))
+
+    def get_send_latency(self):
+        """
+        Returns the histogram of how long each send took.
+        """
+
+        return self.__send_latency__
+
+    def get_connection_statistics(self):
+        """
+        Returns the modem reconnect counters,
+        or None if the connection is not supervised.
+        """
+
+        return self.__fona__.get_connection_statistics()
+
+    def get_connection_statistics_text(self):
+        """
+        Returns a short description of the reconnects,
+        or None if the connection is not supervised.
+        """
+
+        statistics = self.get_connection_statistics()
+
+        if statistics is None:
+            return None
+
+        connection_text = "Serial reconnects:" + str(statistics["reconnects"])
+
+        if not statistics["connected"]:
+            connection_text += " DOWN " + str(int(statistics["disconnected_seconds"])) + "s"
+        elif statistics["last_outage_seconds"] is not None:
+            connection_text += " Last outage:" \
+                + str(int(statistics["last_outage_seconds"])) + "s"
+
+        return connection_text
+
+    def get_serial_statistics(self):
+        """
+        Returns the modem's serial rate and throughput.
+        """
+
+        return self.__fona__.get_serial_statistics()
+
+    def get_serial_statistics_text(self):
+        """
+        Returns a short description of the serial throughput.
+        """
+
+        statistics = self.get_serial_statistics()
+
+        return "Serial:" + str(statistics["baud_rate"]) + " baud, " \
+            + str(int(statistics["effective_bytes_per_second"])) + " B/s effective"
+
+    def get_send_statistics_text(self):
+        """
+        Returns a short description of what has been sent.
+        """
+
+        return "SMS:" + str(self.__messages_sent__) \
+            + " sent, " + str(self.__segments_sent__) + " seg, " \
+            + str(self.__ucs2_messages_sent__) + " UCS2, avg " \
+            + str(round(self.__send_latency__.get_mean(), 1)) + "s"
 
     def signal_strength(self):
         """
@@ -129,43 +458,29 @@ class FonaManager(object):
             self.__logger__.log_warning_message(exception_message)
         self.__lock__.release()
 
-    def __update_battery_state__(self):
+    def __update_modem_status__(self):
         """
-        Updates the battery state.
-        """
-        self.__current_battery_state__ = self.__fona__.get_current_battery_condition()
-
-    def __update_signal_strength__(self):
-        """
-        Updates the battery state.
+        Copies the battery state and signal strength
+        out of the modem's status cache.
         """
 
+        self.__current_battery_state__ = self.__fona__.get_current_battery_condition()
         self.__current_signal_strength__ = self.__fona__.get_signal_strength()
 
     def __process_status_updates__(self):
         """
         Handles updating the cell signal
         and battery status.
+        The modem is only asked when a cached value
+        has gone stale, and everything stale is read
+        with one command.
         """
 
-        # Only perform these checks once per
-        # update. This lets us clear the thread
-        # faster and prevents redundant work.
-        battery_checked = False
-        signal_checked = False
-
         self.__lock__.acquire(True)
 
         try:
-            while not self.__update_status_queue__.empty():
-                command = self.__update_status_queue__.get()
-
-                if text.CHECK_BATTERY in command and not battery_checked:
-                    self.__update_battery_state__()
-                    battery_checked = True
-                if text.CHECK_SIGNAL in command and not signal_checked:
-                    self.__update_signal_strength__()
-                    signal_checked = True
+            if self.__fona__.refresh_modem_status() > 0:
+                self.__update_modem_status__()
         except:
             exception_message = "ERROR updating signal & battery status!"
             print exception_message
@@ -173,95 +488,1149 @@ class FonaManager(object):
 
         self.__lock__.release()
 
+    def __process_connection__(self):
+        """
+        Reopens the modem connection if it was lost.
+        Messages held back while it was down are
+        sent without waiting out their backoff.
+        """
+
+        self.__lock__.acquire(True)
+
+        try:
+            if self.__fona__.check_connection():
+                self.__release_due_messages__(self.__retry_schedule__, True)
+        except:
+            exception_message = "ERROR reconnecting to the modem!"
+            print exception_message
+            self.__logger__.log_warning_message(exception_message)
+
+        self.__lock__.release()
+
     def __process_send_messages__(self):
         """
         Handles sending any pending messages.
         """
 
-        messages_to_retry = []
-
         self.__lock__.acquire(True)
         try:
-            while not self.__send_message_queue__.empty():
-                self.__logger__.log_info_message("__send_message_queue__")
+            self.__release_coalesced_messages__()
+            self.__release_due_messages__(self.__retry_schedule__)
+            self.__release_due_messages__(self.__throttle_schedule__)
+
+            # Take one message at a time so anything more
+            # urgent queued during a send goes next. Copies of
+            # the same text to other numbers go out with it.
+            while not self.__is_waiting_for_network__():
                 message_to_send = self.__send_message_queue__.get()
-                self.__logger__.log_info_message(
-                    "done: __send_message_queue__")
 
-                try:
-                    self.__logger__.log_info_message("sending..")
-                    self.__fona__.send_message(
-                        message_to_send[0], message_to_send[1])
-                    self.__logger__.log_info_message("done sending")
-                except:
-                    self.__logger__.log_warning_message(
-                        "Exception servicing outgoing message:" + str(sys.exc_info()[0]))
-
-                    message_to_send[3] -= 1
-                    if message_to_send[3] > 0:
-                        messages_to_retry.append(message_to_send)
+                if message_to_send is None:
+                    break
+
+                message_text = message_to_send.encoded_message.text
+                message_batch = [message_to_send] + self.__send_message_queue__.take_matching(
+                    message_to_send.priority,
+                    lambda message: message.encoded_message.text == message_text)
+
+                self.__send_queued_messages__(message_batch)
         except:
             self.__logger__.log_warning_message(
                 "Exception servicing outgoing queue:" + str(sys.exc_info()[0]))
+        finally:
+            # One fsync covers everything queued,
+            # sent, or retried since the last update.
+            if self.__journal__ is not None:
+                self.__journal__.sync()
+
+            self.__lock__.release()
+
+    def __send_queued_messages__(self, message_batch):
+        """
+        Sends messages with the same text to their numbers in
+        one modem session. Each message that fails is
+        scheduled to be tried again on its own.
+        """
+
+        messages_to_send = []
+
+        for message_to_send in message_batch:
+            message_age = time.time() - message_to_send.queued_time
+
+            if message_age > self.MAXIMUM_MESSAGE_AGE:
+                self.__logger__.log_warning_message(
+                    "Message " + str(message_to_send.message_id) + " to "
+                    + str(message_to_send.phone_number) + " expired after "
+                    + str(int(message_age)) + " seconds.")
+                self.__messages_expired__ += 1
+                self.__set_delivery_state__(message_to_send, DELIVERY_EXPIRED)
+                self.__journal_remove__(message_to_send)
+            elif self.__take_send_tokens__(message_to_send):
+                messages_to_send.append(message_to_send)
 
-        for message_to_retry in messages_to_retry:
+        if len(messages_to_send) < 1:
+            return
+
+        self.__logger__.log_info_message(
+            "Sending " + PRIORITY_NAMES[messages_to_send[0].priority]
+            + " message(s) " + ", ".join([str(message.message_id)
+                                          for message in messages_to_send]))
+
+        send_results = [[None, None]] * len(messages_to_send)
+        send_start_time = time.time()
+
+        try:
+            send_results = self.__fona__.send_broadcast(
+                [message.phone_number for message in messages_to_send],
+                messages_to_send[0].encoded_message.text)
+        except:
             self.__logger__.log_warning_message(
-                "Adding message back for up to" + str(message_to_retry[3]) + " more retries.")
-            self.__send_message_queue__.put(message_to_retry)
+                "Exception servicing outgoing message:" + str(sys.exc_info()[0]))
 
-        self.__lock__.release()
+        send_seconds = (time.time() - send_start_time) / len(messages_to_send)
+
+        for message_to_send, send_result in zip(messages_to_send, send_results):
+            message_reference, send_error = send_result
+
+            if message_reference is not None:
+                self.__record_send__(message_to_send.encoded_message, send_seconds)
+                self.__set_delivery_state__(message_to_send, DELIVERY_SENT)
+                self.__journal_remove__(message_to_send)
+                self.__delivery_tracker__.add(message_reference,
+                                              self.__get_recipient_key__(
+                                                  message_to_send.phone_number),
+                                              message_to_send)
+            else:
+                self.__schedule_retry__(message_to_send, send_error)
+
+    def __delivery_report_received__(self, urc_line):
+        """
+        The modem sent a +CDS delivery report.
+        """
+
+        self.__delivery_reports__.put(urc_line)
+        self.__signal_wakeup__()
+
+    def __signal_wakeup__(self):
+        """
+        Wakes the service loop, if there is one to wake.
+        """
+
+        if self.__wakeup__ is not None:
+            self.__wakeup__.signal()
+
+    def __process_delivery_reports__(self):
+        """
+        Matches the delivery reports from the modem
+        to the messages they are about.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            while True:
+                try:
+                    status_report_text = self.__delivery_reports__.get_nowait()
+                except Queue.Empty:
+                    break
+
+                self.__handle_delivery_report__(fona.SmsStatusReport(status_report_text))
+        except:
+            self.__logger__.log_warning_message(
+                "Exception processing delivery reports:" + str(sys.exc_info()[0]))
+        finally:
+            if self.__journal__ is not None:
+                self.__journal__.sync()
+
+            self.__lock__.release()
+
+    def __handle_delivery_report__(self, status_report):
+        """
+        Marks a message delivered, or sends it again
+        if the network gave up on a temporary error.
+        """
+
+        if not status_report.is_valid():
+            self.__logger__.log_warning_message("Unable to decode a delivery report.")
+            return
+
+        # The service centre is still trying,
+        # so another report will follow.
+        if status_report.is_pending():
+            return
+
+        delivered_message = self.__delivery_tracker__.pop(status_report.message_reference,
+                                                          status_report.recipient_number)
+
+        if delivered_message is None:
+            return
+
+        if status_report.is_delivered():
+            self.__messages_delivered__ += 1
+            self.__set_delivery_state__(delivered_message, DELIVERY_DELIVERED)
+            self.__logger__.log_info_message(
+                "Message " + str(delivered_message.message_id) + " delivered to "
+                + str(delivered_message.phone_number))
+            return
+
+        self.__delivery_failures__ += 1
+        self.__logger__.log_warning_message(
+            "Delivery of message " + str(delivered_message.message_id) + " to "
+            + str(delivered_message.phone_number) + " failed with status "
+            + str(status_report.status))
+
+        if status_report.is_permanent_failure():
+            self.__set_delivery_state__(delivered_message, DELIVERY_FAILED)
+            return
+
+        # The message left the journal when it was sent.
+        if self.__journal__ is not None:
+            self.__journal__.add_message(delivered_message.to_record())
+
+        self.__schedule_retry__(delivered_message, None)
+
+    def __schedule_retry__(self, message_to_retry, send_error):
+        """
+        Puts a failed message aside until its backoff has passed.
+        Network failures also hold back all sending until
+        the modem is registered again.
+        """
+
+        failure_kind = fona.classify_send_failure(send_error)
+        message_to_retry.attempt_count += 1
+
+        # A message that never reached the modem
+        # does not use up one of its retries.
+        if not self.__fona__.is_connection_lost():
+            message_to_retry.retries_remaining -= 1
+
+        if failure_kind == fona.SEND_FAILURE_PERMANENT \
+                or message_to_retry.retries_remaining < 1:
+            self.__logger__.log_warning_message(
+                "Giving up on message to " + str(message_to_retry.phone_number)
+                + ", error " + str(send_error) + " (" + failure_kind + ")")
+            self.__messages_abandoned__ += 1
+            self.__set_delivery_state__(message_to_retry, DELIVERY_FAILED)
+            self.__journal_remove__(message_to_retry)
+            return
+
+        self.__set_delivery_state__(message_to_retry, DELIVERY_RETRYING)
+
+        if failure_kind == fona.SEND_FAILURE_NETWORK \
+                and self.__network_wait_started__ is None:
+            self.__logger__.log_warning_message(
+                "Network error " + str(send_error)
+                + ", holding messages until the modem is registered.")
+            self.__network_wait_started__ = time.time()
+            self.__last_registration_check__ = time.time()
+
+        retry_delay = backoff.get_backoff_seconds(message_to_retry.attempt_count - 1)
+        heapq.heappush(self.__retry_schedule__,
+                       (time.time() + retry_delay, message_to_retry.message_id, message_to_retry))
+        self.__retries_scheduled__ += 1
+
+        self.__logger__.log_warning_message(
+            "Retrying message " + str(message_to_retry.message_id) + " in "
+            + str(int(retry_delay)) + " seconds, up to "
+            + str(message_to_retry.retries_remaining) + " more retries.")
+
+        if self.__journal__ is not None:
+            self.__journal__.update_message(
+                message_to_retry.message_id,
+                {"retries_remaining": message_to_retry.retries_remaining})
+
+    def __queue_outbound_message__(self,
+                                   phone_number,
+                                   text_message,
+                                   maximum_number_of_retries,
+                                   priority,
+                                   broadcast_id=None,
+                                   alert_kind=None):
+        """
+        Journals a message and queues it, holding anything
+        other than an alert for coalescing.
+        """
+
+        message_to_send = OutboundMessage(next(self.__message_ids__),
+                                          phone_number,
+                                          text_message,
+                                          maximum_number_of_retries,
+                                          priority,
+                                          alert_kind=alert_kind)
+
+        if broadcast_id is not None:
+            message_to_send.broadcast_ids.append(broadcast_id)
+            self.__set_delivery_state__(message_to_send, DELIVERY_QUEUED)
+
+        if self.__journal__ is not None:
+            self.__journal__.add_message(message_to_send.to_record())
+
+        if priority == PRIORITY_ALERT:
+            self.__send_message_queue__.put(message_to_send, priority)
+        else:
+            self.__hold_for_coalescing__(message_to_send)
+
+        self.__logger__.log_info_message("Queuing message to " + str(phone_number)
+                                         + ": " + str(message_to_send.encoded_message.segment_count)
+                                         + " segment(s), "
+                                         + message_to_send.encoded_message.alphabet)
+
+        self.__signal_wakeup__()
+
+    def __set_delivery_state__(self, message, delivery_state):
+        """
+        Records the state of a message for every
+        broadcast it is part of.
+        """
+
+        if len(message.broadcast_ids) < 1:
+            return
 
-    def __trigger_check_battery__(self):
+        recipient_key = self.__get_recipient_key__(message.phone_number)
+
+        self.__broadcast_lock__.acquire(True)
+        try:
+            for broadcast_id in message.broadcast_ids:
+                if broadcast_id in self.__broadcasts__:
+                    self.__broadcasts__[broadcast_id][recipient_key] = delivery_state
+        finally:
+            self.__broadcast_lock__.release()
+
+    def __hold_for_coalescing__(self, message_to_send):
         """
-        Triggers the battery state to be checked.
+        Holds a message until the coalescing window
+        for its recipient closes.
         """
 
-        self.__update_status_queue__.put(text.CHECK_BATTERY)
+        recipient_key = self.__get_recipient_key__(message_to_send.phone_number)
 
-    def __trigger_check_signal__(self):
+        self.__coalesce_lock__.acquire(True)
+        try:
+            if recipient_key not in self.__coalescing_messages__:
+                self.__coalescing_messages__[recipient_key] = [time.time(), []]
+
+            self.__coalescing_messages__[recipient_key][1].append(message_to_send)
+        finally:
+            self.__coalesce_lock__.release()
+
+    def __release_coalesced_messages__(self):
         """
-        Triggers the signal to be checked.
+        Merges the messages held for each recipient whose
+        window has closed, and queues the result.
+        Only messages of the same priority are merged.
         """
 
-        self.__update_status_queue__.put(text.CHECK_SIGNAL)
+        current_time = time.time()
+        held_messages = []
+
+        self.__coalesce_lock__.acquire(True)
+        try:
+            for recipient_key in list(self.__coalescing_messages__.keys()):
+                window_start, recipient_messages = self.__coalescing_messages__[recipient_key]
+
+                if current_time - window_start >= self.COALESCE_WINDOW:
+                    del self.__coalescing_messages__[recipient_key]
+
+                    for priority in range(len(PRIORITY_NAMES)):
+                        priority_messages = [message for message in recipient_messages
+                                             if message.priority == priority]
+
+                        if len(priority_messages) > 0:
+                            held_messages.append(priority_messages)
+        finally:
+            self.__coalesce_lock__.release()
+
+        for recipient_messages in held_messages:
+            message_group = [recipient_messages[0]]
+
+            for message_to_send in recipient_messages[1:]:
+                if self.__can_coalesce__(message_group + [message_to_send]):
+                    message_group.append(message_to_send)
+                else:
+                    self.__queue_coalesced_group__(message_group)
+                    message_group = [message_to_send]
+
+            self.__queue_coalesced_group__(message_group)
+
+    def __can_coalesce__(self, message_group):
+        """
+        Returns True if the messages all have the same
+        priority and fit in one message that takes no more
+        segments than sending them separately.
+        """
+
+        if len(set([message.priority for message in message_group])) > 1:
+            return False
+
+        merged_message = fona.EncodedMessage(
+            "\n".join([message.encoded_message.text for message in message_group]))
+        separate_segment_count = sum([message.encoded_message.segment_count
+                                      for message in message_group])
+
+        return merged_message.segment_count <= self.MAXIMUM_COALESCED_SEGMENTS \
+            and merged_message.segment_count <= separate_segment_count
+
+    def __queue_coalesced_group__(self, message_group):
+        """
+        Queues the group as a single message.
+        """
+
+        if len(message_group) == 1:
+            self.__send_message_queue__.put(message_group[0], message_group[0].priority)
+            return
+
+        merged_message = OutboundMessage(
+            next(self.__message_ids__),
+            message_group[0].phone_number,
+            "\n".join([message.encoded_message.text for message in message_group]),
+            max([message.retries_remaining for message in message_group]),
+            min([message.priority for message in message_group]),
+            min([message.queued_time for message in message_group]))
+
+        for message in message_group:
+            merged_message.broadcast_ids += message.broadcast_ids
+
+        if self.__journal__ is not None:
+            self.__journal__.add_message(merged_message.to_record())
+
+        for message in message_group:
+            self.__journal_remove__(message)
+
+        self.__messages_coalesced__ += len(message_group) - 1
+        self.__logger__.log_info_message(
+            "Coalesced " + str(len(message_group)) + " messages to "
+            + str(merged_message.phone_number) + " into "
+            + str(merged_message.encoded_message.segment_count) + " segment(s).")
+
+        self.__send_message_queue__.put(merged_message, merged_message.priority)
+
+    def __take_send_tokens__(self, message_to_send):
+        """
+        Takes one token per segment from the global and the
+        recipient's rate limits. If either is short the
+        message is held until it will have enough, or is
+        collapsed into a message already held that is
+        identical or has the same alert kind. The held
+        message keeps the latest text.
+        Returns True if the message can be sent now.
+        """
+
+        segment_count = message_to_send.encoded_message.segment_count
+        recipient_bucket = self.__get_recipient_bucket__(message_to_send.phone_number)
+        wait_seconds = max(self.__global_bucket__.get_seconds_until_available(segment_count),
+                           recipient_bucket.get_seconds_until_available(segment_count))
+
+        if wait_seconds <= 0:
+            self.__global_bucket__.try_consume(segment_count)
+            recipient_bucket.try_consume(segment_count)
+
+            return True
+
+        for held_message in [entry[2] for entry in self.__throttle_schedule__]:
+            if self.__is_same_report__(held_message, message_to_send):
+                self.__logger__.log_info_message(
+                    "Collapsed message " + str(message_to_send.message_id)
+                    + " into held message " + str(held_message.message_id))
+
+                if held_message.encoded_message.text != message_to_send.encoded_message.text:
+                    held_message.encoded_message = message_to_send.encoded_message
+
+                    if self.__journal__ is not None:
+                        self.__journal__.update_message(
+                            held_message.message_id,
+                            {"text": message_to_send.encoded_message.text})
+
+                self.__messages_collapsed__ += 1
+                self.__set_delivery_state__(message_to_send, DELIVERY_COLLAPSED)
+                self.__journal_remove__(message_to_send)
+
+                return False
+
+        if not message_to_send.was_throttled:
+            message_to_send.was_throttled = True
+            self.__messages_throttled__ += 1
+
+        self.__logger__.log_info_message(
+            "Rate limit reached, holding message " + str(message_to_send.message_id)
+            + " for " + str(int(wait_seconds)) + " seconds.")
+        heapq.heappush(self.__throttle_schedule__,
+                       (time.time() + wait_seconds, message_to_send.message_id, message_to_send))
+
+        return False
+
+    def __is_same_report__(self, held_message, message_to_send):
+        """
+        Returns True if the message says the same thing as
+        the held one, to the same number at the same priority.
+        """
+
+        if held_message.priority != message_to_send.priority \
+                or self.__get_recipient_key__(held_message.phone_number) \
+                != self.__get_recipient_key__(message_to_send.phone_number):
+            return False
+
+        if held_message.alert_kind is not None:
+            return held_message.alert_kind == message_to_send.alert_kind
+
+        return held_message.encoded_message.text == message_to_send.encoded_message.text
+
+    def __get_recipient_key__(self, phone_number):
+        """
+        Returns the number used to look up a recipient's rate limit.
+        """
+
+        cleaned_number = utilities.get_cleaned_phone_number(phone_number)
+
+        if cleaned_number is None:
+            return str(phone_number)
+
+        return cleaned_number
+
+    def __get_recipient_bucket__(self, phone_number):
+        """
+        Returns the rate limit for a recipient.
+        """
+
+        recipient_key = self.__get_recipient_key__(phone_number)
+
+        if recipient_key not in self.__recipient_buckets__:
+            self.__recipient_buckets__[recipient_key] = TokenBucket(
+                self.__recipient_rate_limit_burst__,
+                self.__recipient_rate_limit_per_hour__ / 3600.0)
+
+        return self.__recipient_buckets__[recipient_key]
+
+    def __release_due_messages__(self, schedule, release_all=False):
+        """
+        Puts the held messages whose time has come back in the queue.
+        """
+
+        current_time = time.time()
+
+        while len(schedule) > 0 \
+                and (release_all or schedule[0][0] <= current_time):
+            message_to_release = heapq.heappop(schedule)[2]
+            self.__send_message_queue__.put(message_to_release, message_to_release.priority)
+
+    def __is_waiting_for_network__(self):
+        """
+        Returns True while sending is held back after a
+        network error. Checks AT+CREG at most every
+        REGISTRATION_CHECK_INTERVAL seconds.
+        """
+
+        if self.__fona__.is_connection_lost():
+            return True
+
+        if self.__network_wait_started__ is None:
+            return False
+
+        if time.time() - self.__last_registration_check__ < self.REGISTRATION_CHECK_INTERVAL:
+            return True
+
+        self.__last_registration_check__ = time.time()
+
+        if not self.__fona__.is_network_registered(True):
+            return True
+
+        self.__logger__.log_info_message(
+            "Modem registered again after "
+            + str(int(time.time() - self.__network_wait_started__)) + " seconds.")
+        self.__network_wait_started__ = None
+
+        # The network was the problem, so do not
+        # make the held messages wait out their backoff.
+        self.__release_due_messages__(self.__retry_schedule__, True)
+
+        return False
+
+    def __journal_remove__(self, message_to_send):
+        """
+        Takes a message that is finished with out of the journal.
+        """
+
+        if self.__journal__ is not None:
+            self.__journal__.remove_message(message_to_send.message_id)
+
+    def __replay_journal__(self):
+        """
+        Queues the messages that were waiting to
+        be sent when the process last stopped.
+        """
+
+        self.__message_ids__ = itertools.count(1)
+
+        if self.__journal__ is None:
+            return
+
+        try:
+            replayed_records = self.__journal__.replay()
+        except:
+            self.__logger__.log_warning_message(
+                "Unable to replay the message journal:" + str(sys.exc_info()[0]))
+            return
+
+        last_message_id = 0
+
+        for record in replayed_records:
+            message_to_send = OutboundMessage(record["id"],
+                                              record["phone_number"],
+                                              record["text"],
+                                              record["retries_remaining"],
+                                              record.get("priority", PRIORITY_REPLY),
+                                              record["queued_time"],
+                                              record.get("alert_kind"))
+            last_message_id = max(last_message_id, record["id"])
+            self.__send_message_queue__.put(message_to_send, message_to_send.priority)
+
+        self.__message_ids__ = itertools.count(last_message_id + 1)
+
+        if len(replayed_records) > 0:
+            self.__logger__.log_info_message(
+                "Replayed " + str(len(replayed_records)) + " unsent messages from the journal.")
+
+    def __record_send__(self, encoded_message, send_seconds):
+        """
+        Adds a sent message to the statistics.
+        """
+
+        self.__messages_sent__ += 1
+        self.__segments_sent__ += encoded_message.segment_count
+        self.__send_latency__.record(send_seconds)
+
+        if encoded_message.alphabet == fona.ALPHABET_UCS2:
+            self.__ucs2_messages_sent__ += 1
+
+        if encoded_message.was_transliterated:
+            self.__transliterated_messages_sent__ += 1
+
+        self.__logger__.log_info_message("Sent " + str(encoded_message.segment_count)
+                                         + " segment(s) in "
+                                         + str(round(send_seconds, 2)) + " seconds")
 
     def __init__(self,
                  logger,
                  serial_connection,
                  power_status_pin,
                  ring_indicator_pin,
-                 utc_offset):
+                 utc_offset,
+                 journal_path=None,
+                 rate_limit_per_hour=DEFAULT_RATE_LIMIT_PER_HOUR,
+                 rate_limit_burst=DEFAULT_RATE_LIMIT_BURST,
+                 recipient_rate_limit_per_hour=DEFAULT_RECIPIENT_RATE_LIMIT_PER_HOUR,
+                 recipient_rate_limit_burst=DEFAULT_RECIPIENT_RATE_LIMIT_BURST,
+                 serial_supervisor=None,
+                 modem_baud_rate=None,
+                 wakeup=None,
+                 event_bus=None):
         """
         Initializes the Fona.
+        Outbound messages are only journaled
+        when a journal path is given.
+        Rate limits are in message segments.
+        A lost connection is reopened through
+        the serial supervisor if one is given.
+        The modem is moved up to the modem baud
+        rate if one is given.
+        The wakeup is signalled when there is work for update().
+        The Fona asks for message checks on the event bus.
         """
 
         fona.TIMEZONE_OFFSET = utc_offset
         self.__logger__ = logger
+        self.__wakeup__ = wakeup
         self.__lock__ = threading.Lock()
         self.__fona__ = fona.Fona(logger,
                                   serial_connection,
                                   power_status_pin,
-                                  ring_indicator_pin)
+                                  ring_indicator_pin,
+                                  serial_supervisor=serial_supervisor,
+                                  target_baud_rate=modem_baud_rate,
+                                  wakeup=wakeup,
+                                  event_bus=event_bus)
         self.__current_battery_state__ = None
         self.__current_signal_strength__ = None
-        self.__update_status_queue__ = MPQueue()
-        self.__send_message_queue__ = MPQueue()
+        self.__send_message_queue__ = PriorityMessageQueue(len(PRIORITY_NAMES))
+        self.__messages_sent__ = 0
+        self.__segments_sent__ = 0
+        self.__ucs2_messages_sent__ = 0
+        self.__transliterated_messages_sent__ = 0
+        self.__send_latency__ = LatencyHistogram()
+        self.__retry_schedule__ = []
+        self.__retries_scheduled__ = 0
+        self.__messages_expired__ = 0
+        self.__messages_abandoned__ = 0
+        self.__network_wait_started__ = None
+        self.__last_registration_check__ = 0
+        self.__global_bucket__ = TokenBucket(rate_limit_burst, rate_limit_per_hour / 3600.0)
+        self.__recipient_buckets__ = {}
+        self.__recipient_rate_limit_per_hour__ = recipient_rate_limit_per_hour
+        self.__recipient_rate_limit_burst__ = recipient_rate_limit_burst
+        self.__throttle_schedule__ = []
+        self.__messages_throttled__ = 0
+        self.__messages_collapsed__ = 0
+        self.__coalesce_lock__ = threading.Lock()
+        self.__coalescing_messages__ = {}
+        self.__messages_coalesced__ = 0
+        self.__broadcast_lock__ = threading.Lock()
+        self.__broadcasts__ = OrderedDict()
+        self.__broadcast_ids__ = itertools.count(1)
+        self.__delivery_tracker__ = DeliveryTracker()
+        self.__delivery_reports__ = Queue.Queue()
+        self.__messages_delivered__ = 0
+        self.__delivery_failures__ = 0
+        self.__fona__.subscribe_unsolicited("+CDS:", self.__delivery_report_received__)
+        self.__journal__ = None
+
+        if journal_path is not None:
+            self.__journal__ = MessageJournal(journal_path, logger)
+
+        self.__replay_journal__()
 
         # Update the status now as we dont
         # know how long it will be until
         # the queues are serviced.
-        self.__update_battery_state__()
-        self.__update_signal_strength__()
-
-        RecurringTask("check_battery",
-                      self.CHECK_BATTERY_INTERVAL,
-                      self.__trigger_check_battery__,
-                      self.__logger__)
-
-        RecurringTask("check_signal",
-                      self.CHECK_SIGNAL_INTERVAL,
-                      self.__trigger_check_signal__,
-                      self.__logger__)
+        self.__fona__.refresh_modem_status()
+        self.__update_modem_status__()
+
+
+##############
+# UNIT TESTS #
+##############
+
+
+class FakeFona(object):
+    """
+    Stands in for the modem in the tests.
+    Sends to a number in failing_numbers fail
+    with that number's +CMS ERROR code.
+    """
+
+    def is_power_on(self):
+        return True
+
+    def get_next_update_time(self):
+        return None
+
+    def subscribe_unsolicited(self, prefix, callback):
+        self.unsolicited_callbacks[prefix] = callback
+
+    def refresh_modem_status(self):
+        return 0
+
+    def get_current_battery_condition(self):
+        return None
+
+    def get_signal_strength(self):
+        return None
+
+    def check_connection(self):
+        return False
+
+    def is_connection_lost(self):
+        return self.connection_lost
+
+    def is_network_registered(self, force_check=False):
+        return self.network_registered
+
+    def send_broadcast(self, phone_numbers, text):
+        self.sent.append((list(phone_numbers), text))
+
+        if self.on_send is not None:
+            self.on_send()
+
+        send_results = []
+
+        for phone_number in phone_numbers:
+            if phone_number in self.failing_numbers:
+                send_results.append([None, self.failing_numbers[phone_number]])
+            else:
+                send_results.append([next(self.__message_references__), None])
+
+        return send_results
+
+    def get_sent_numbers(self):
+        return [phone_number for phone_numbers, text in self.sent
+                for phone_number in phone_numbers]
+
+    def __init__(self):
+        self.unsolicited_callbacks = {}
+        self.connection_lost = False
+        self.network_registered = True
+        self.failing_numbers = {}
+        self.on_send = None
+        self.sent = []
+        self.__message_references__ = itertools.count(1)
+
+
+def create_test_manager(fake_fona, journal_path=None, **kwargs):
+    """
+    Returns a FonaManager that sends through the fake,
+    with the coalescing window closed.
+    """
+    import logging
+    from lib.logger import Logger
+
+    real_fona = fona.Fona
+    fona.Fona = lambda *args, **kwargs: fake_fona
+
+    try:
+        manager = FonaManager(Logger(logging.getLogger("test")),
+                              None,
+                              None,
+                              None,
+                              fona.TIMEZONE_OFFSET,
+                              journal_path,
+                              **kwargs)
+    finally:
+        fona.Fona = real_fona
+
+    manager.COALESCE_WINDOW = 0
+
+    return manager
+
+
+def make_held_messages_due(manager):
+    """
+    Moves every retry's backoff and every
+    rate limit hold into the past.
+    """
+
+    for schedule in [manager.__retry_schedule__, manager.__throttle_schedule__]:
+        schedule[:] = [(0, message_id, message) for due_time, message_id, message in schedule]
+        heapq.heapify(schedule)
+
+
+def test_journal_replay_after_crash():
+    """
+    Test that a restart sends the messages that were still
+    waiting when the process died, and not the ones sent.
+    """
+    import os
+    import tempfile
+
+    journal_path = os.path.join(tempfile.mkdtemp(), "journal.log")
+    fake_fona = FakeFona()
+    fake_fona.failing_numbers["2065550100"] = None
+    manager = create_test_manager(fake_fona, journal_path)
+    manager.send_message("2061234567", "STATUS", 3, PRIORITY_ALERT)
+    manager.send_message("2065550100", "HELP", 3, PRIORITY_ALERT)
+    manager.update()
+    assert fake_fona.get_sent_numbers() == ["2061234567", "2065550100"]
+    assert manager.__journal__.get_pending_count() == 1
+
+    # The process dies without closing the journal.
+    restarted_fona = FakeFona()
+    restarted = create_test_manager(restarted_fona, journal_path)
+    assert restarted.get_queue_depths()["alert"] == 1
+    restarted.update()
+    assert restarted_fona.sent == [(["2065550100"], "HELP")]
+    assert restarted.__journal__.get_pending_count() == 0
+    assert next(restarted.__message_ids__) == 3
+
+
+def test_retry_after_send_failure():
+    """
+    Test that a failed send is held for its backoff, sent
+    again once it is due, and given up on when it runs
+    out of retries or the error is permanent.
+    """
+    fake_fona = FakeFona()
+    fake_fona.failing_numbers["2061234567"] = None
+    manager = create_test_manager(fake_fona)
+    manager.send_message("2061234567", "STATUS", 2, PRIORITY_ALERT)
+    manager.update()
+    assert len(fake_fona.sent) == 1
+    assert manager.get_retry_statistics()["retries_waiting"] == 1
+
+    # Not sent again until the backoff has passed.
+    manager.update()
+    assert len(fake_fona.sent) == 1
+    make_held_messages_due(manager)
+    manager.update()
+    assert len(fake_fona.sent) == 2
+    assert manager.get_retry_statistics()["retries_waiting"] == 0
+    assert manager.get_retry_statistics()["messages_abandoned"] == 1
+
+    fake_fona.failing_numbers["2061234567"] = 21
+    manager.send_message("2061234567", "HELP", 4, PRIORITY_ALERT)
+    manager.update()
+    assert manager.get_retry_statistics()["retries_waiting"] == 0
+    assert manager.get_retry_statistics()["messages_abandoned"] == 2
+
+    del fake_fona.failing_numbers["2061234567"]
+    fake_fona.failing_numbers["2065550100"] = None
+    manager.send_message("2065550100", "STATUS", 4, PRIORITY_ALERT)
+    manager.update()
+    make_held_messages_due(manager)
+    del fake_fona.failing_numbers["2065550100"]
+    manager.update()
+    assert fake_fona.sent[-1] == (["2065550100"], "STATUS")
+    assert manager.get_send_statistics()["messages"] == 1
+
+
+def test_alert_is_sent_first():
+    """
+    Test that an alert goes ahead of the replies and
+    broadcasts already queued, even one queued while
+    another message is being sent.
+    """
+    fake_fona = FakeFona()
+    manager = create_test_manager(fake_fona)
+    manager.send_broadcast(["2065550100", "2065550101"], "Heater turned OFF.")
+    manager.send_message("2061234567", "STATUS")
+    manager.send_message("2065550102", "Gas warning", priority=PRIORITY_ALERT)
+    manager.update()
+    assert fake_fona.sent == [(["2065550102"], "Gas warning"),
+                              (["2061234567"], "STATUS"),
+                              (["2065550100", "2065550101"], "Heater turned OFF.")]
+
+    del fake_fona.sent[:]
+    manager.send_message("2061234567", "HELP")
+    manager.send_broadcast(["2065550100"], "Heater turned ON.")
+
+    def queue_alert():
+        fake_fona.on_send = None
+        manager.send_message("2065550102", "Low battery", priority=PRIORITY_ALERT)
+
+    fake_fona.on_send = queue_alert
+    manager.update()
+    assert [text for phone_numbers, text in fake_fona.sent] \
+        == ["HELP", "Low battery", "Heater turned ON."]
+
+
+def test_network_wait():
+    """
+    Test that a network error holds back every send until
+    the modem is registered again, and that the held
+    messages then go without waiting out their backoff.
+    """
+    fake_fona = FakeFona()
+    fake_fona.failing_numbers["2061234567"] = 38
+    manager = create_test_manager(fake_fona)
+    manager.send_message("2061234567", "STATUS", 4, PRIORITY_ALERT)
+    manager.update()
+    assert manager.get_retry_statistics()["waiting_for_network"]
+
+    del fake_fona.failing_numbers["2061234567"]
+    manager.send_message("2065550100", "Gas warning", 4, PRIORITY_ALERT)
+    manager.update()
+    assert len(fake_fona.sent) == 1
+
+    manager.REGISTRATION_CHECK_INTERVAL = 0
+    fake_fona.network_registered = False
+    manager.update()
+    assert len(fake_fona.sent) == 1
+
+    fake_fona.network_registered = True
+    manager.update()
+    assert not manager.get_retry_statistics()["waiting_for_network"]
+    assert fake_fona.get_sent_numbers() == ["2061234567", "2065550100", "2061234567"]
+
+
+def test_lost_connection_keeps_retries():
+    """
+    Test that nothing is sent while the serial connection
+    is down, and that a send that never reached the modem
+    does not use up a retry.
+    """
+    fake_fona = FakeFona()
+    manager = create_test_manager(fake_fona)
+    fake_fona.connection_lost = True
+    manager.send_message("2061234567", "STATUS", 1, PRIORITY_ALERT)
+    manager.update()
+    assert fake_fona.sent == []
+
+    # The port drops part way through the send.
+    fake_fona.failing_numbers["2061234567"] = None
+    fake_fona.connection_lost = False
+
+    def lose_connection():
+        fake_fona.connection_lost = True
+
+    fake_fona.on_send = lose_connection
+    manager.update()
+    assert len(fake_fona.sent) == 1
+    assert manager.get_retry_statistics()["messages_abandoned"] == 0
+    assert manager.get_retry_statistics()["retries_waiting"] == 1
+
+
+def test_rate_limit_defers_sends():
+    """
+    Test that a message over the global or a recipient's
+    rate limit is held and sent later, not dropped, and
+    that a copy of a held message is collapsed into it.
+    """
+    fake_fona = FakeFona()
+    manager = create_test_manager(fake_fona, rate_limit_burst=1)
+    assert manager.get_problem_statistics_text() is None
+    manager.send_message("2061234567", "STATUS", priority=PRIORITY_ALERT)
+    manager.send_message("2065550100", "HELP", priority=PRIORITY_ALERT)
+    manager.update()
+    assert fake_fona.sent == [(["2061234567"], "STATUS")]
+    assert manager.get_throttle_statistics()["throttled_waiting"] == 1
+    assert manager.get_problem_statistics_text() == "Throttled:1 Expired:0"
+
+    manager.send_message("2065550100", "HELP", priority=PRIORITY_ALERT)
+    manager.update()
+    assert manager.get_throttle_statistics() == {"messages_throttled": 1,
+                                                 "messages_collapsed": 1,
+                                                 "throttled_waiting": 1}
+
+    manager.__global_bucket__ = TokenBucket(1, 0)
+    make_held_messages_due(manager)
+    manager.update()
+    assert fake_fona.sent[-1] == (["2065550100"], "HELP")
+    assert manager.get_throttle_statistics()["throttled_waiting"] == 0
+
+    fake_fona = FakeFona()
+    manager = create_test_manager(fake_fona, recipient_rate_limit_burst=1)
+    manager.send_message("2061234567", "STATUS", priority=PRIORITY_ALERT)
+    manager.send_message("2061234567", "HELP", priority=PRIORITY_ALERT)
+    manager.send_message("2065550100", "HELP", priority=PRIORITY_ALERT)
+    manager.update()
+    assert fake_fona.get_sent_numbers() == ["2061234567", "2065550100"]
+    assert manager.get_throttle_statistics()["throttled_waiting"] == 1
+
+
+def test_held_alerts_collapse_by_kind():
+    """
+    Test that a gas alert held by the rate limit is
+    replaced by a later one with a different level,
+    and that other kinds of alert are kept.
+    """
+    import os
+    import tempfile
+
+    journal_path = os.path.join(tempfile.mkdtemp(), "journal.log")
+    fake_fona = FakeFona()
+    manager = create_test_manager(fake_fona, journal_path, rate_limit_burst=1)
+    manager.send_message("2061234567", "STATUS", priority=PRIORITY_ALERT)
+    manager.update()
+
+    for gas_level in [300, 450, 600]:
+        manager.send_message("2061234567", "GAS DETECTED!!! Level = " + str(gas_level),
+                             priority=PRIORITY_ALERT, alert_kind="gas")
+        manager.update()
+
+    manager.send_message("2061234567", "LOW BATTERY", priority=PRIORITY_ALERT,
+                         alert_kind="battery")
+    manager.update()
+    assert manager.get_throttle_statistics()["messages_collapsed"] == 2
+    assert manager.get_throttle_statistics()["throttled_waiting"] == 2
+    assert sorted([record["text"] for record in MessageJournal(journal_path).replay()]) \
+        == ["GAS DETECTED!!! Level = 600", "LOW BATTERY"]
+
+    manager.__global_bucket__ = TokenBucket(2, 0)
+    make_held_messages_due(manager)
+    manager.update()
+    assert [text for phone_numbers, text in fake_fona.sent[1:]] \
+        == ["GAS DETECTED!!! Level = 600", "LOW BATTERY"]
+
+
+def test_coalesce_same_recipient_and_priority():
+    """
+    Test that messages are held for the coalescing window,
+    then merged only with others to the same number at the
+    same priority.
+    """
+    fake_fona = FakeFona()
+    manager = create_test_manager(fake_fona)
+    manager.COALESCE_WINDOW = FonaManager.COALESCE_WINDOW
+    manager.send_message("2061234567", "STATUS")
+    manager.send_broadcast(["2061234567"], "Heater turned OFF.")
+    manager.send_message("(206) 123-4567", "HELP")
+    manager.send_message("2065550100", "TEMP")
+    manager.update()
+    assert fake_fona.sent == []
+    assert manager.get_next_update_time() is not None
+
+    manager.COALESCE_WINDOW = 0
+    manager.update()
+    assert sorted(fake_fona.sent) == [(["2061234567"], "Heater turned OFF."),
+                                      (["2061234567"], "STATUS\nHELP"),
+                                      (["2065550100"], "TEMP")]
+    assert manager.get_send_statistics()["coalesced_messages"] == 1
+
+    # Too long to merge into fewer segments.
+    del fake_fona.sent[:]
+    manager.send_message("2061234567", "A" * 155)
+    manager.send_message("2061234567", "B" * 155)
+    manager.update()
+    assert len(fake_fona.sent) == 2
+
+
+def test_broadcast_in_one_session():
+    """
+    Test that a broadcast goes to every number in one
+    modem session, and that only the recipients it
+    failed for are sent to again.
+    """
+    fake_fona = FakeFona()
+    fake_fona.failing_numbers["2065550100"] = None
+    manager = create_test_manager(fake_fona)
+    broadcast_id = manager.send_broadcast(["2061234567", "2065550100", "2065550101"],
+                                          "Heater turned OFF.")
+    assert set(manager.get_broadcast_state(broadcast_id).values()) == set([DELIVERY_QUEUED])
+    manager.update()
+    assert len(fake_fona.sent) == 1
+    assert sorted(fake_fona.get_sent_numbers()) == ["2061234567", "2065550100", "2065550101"]
+    assert manager.get_broadcast_state(broadcast_id) == {"2061234567": DELIVERY_SENT,
+                                                         "2065550100": DELIVERY_RETRYING,
+                                                         "2065550101": DELIVERY_SENT}
+
+    del fake_fona.failing_numbers["2065550100"]
+    make_held_messages_due(manager)
+    manager.update()
+    assert fake_fona.sent[-1] == (["2065550100"], "Heater turned OFF.")
+    assert manager.get_broadcast_state(broadcast_id)["2065550100"] == DELIVERY_SENT
+
+
+def test_delivery_reports():
+    """
+    Test that a report of a temporary failure puts the
+    message back in the journal and sends it again, and
+    that a delivered report leaves nothing behind.
+    """
+    import os
+    import tempfile
+
+    def report(message_reference, status):
+        fake_fona.unsolicited_callbacks["+CDS:"](
+            '+CDS: 6,' + str(message_reference) + ',"2061234567",129,'
+            + '"17/10/16,12:00:41-28","17/10/16,12:01:41-28",' + str(status))
+
+    journal_path = os.path.join(tempfile.mkdtemp(), "journal.log")
+    fake_fona = FakeFona()
+    manager = create_test_manager(fake_fona, journal_path)
+    broadcast_id = manager.send_broadcast(["2061234567"], "Gas warning", priority=PRIORITY_ALERT)
+    manager.update()
+    assert manager.__journal__.get_pending_count() == 0
+
+    report(1, 96)
+    manager.update()
+    assert manager.__journal__.get_pending_count() == 1
+    assert manager.get_broadcast_state(broadcast_id)["2061234567"] == DELIVERY_RETRYING
+    make_held_messages_due(manager)
+    manager.update()
+    assert len(fake_fona.sent) == 2
+    assert manager.__journal__.get_pending_count() == 0
+
+    report(2, 0)
+    manager.update()
+    assert manager.get_delivery_statistics() == {"delivered": 1,
+                                                 "failed": 1,
+                                                 "awaiting_report": 0,
+                                                 "untracked": 0}
+    assert manager.get_broadcast_state(broadcast_id)["2061234567"] == DELIVERY_DELIVERED
+    assert MessageJournal(journal_path).replay() == []
+
+    # The number can never be reached, so it is not sent again.
+    manager.send_message("2061234567", "STATUS", priority=PRIORITY_ALERT)
+    manager.update()
+    report(3, 0x41)
+    manager.update()
+    assert len(fake_fona.sent) == 3
+    assert manager.get_retry_statistics()["retries_waiting"] == 0
+    assert manager.__journal__.get_pending_count() == 0
 
 
 if __name__ == '__main__':
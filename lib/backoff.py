@@ -0,0 +1,41 @@
+"""
+Module to work out how long to wait before trying again.
+"""
+
+import random
+
+DEFAULT_BASE_SECONDS = 15
+DEFAULT_MAXIMUM_SECONDS = 60 * 10
+
+
+def get_backoff_seconds(attempt_number,
+                        base_seconds=DEFAULT_BASE_SECONDS,
+                        maximum_seconds=DEFAULT_MAXIMUM_SECONDS,
+                        jitter=random.random):
+    """
+    Returns how long to wait before the given retry.
+    The delay doubles with each attempt up to the maximum.
+    Half of it is fixed and half is random so that
+    retries queued together do not fire together.
+
+    >>> get_backoff_seconds(0, 10, 600, lambda: 0.0)
+    5.0
+    >>> get_backoff_seconds(3, 10, 600, lambda: 1.0)
+    80.0
+    >>> get_backoff_seconds(12, 10, 600, lambda: 0.5)
+    450.0
+    """
+
+    delay_seconds = min(maximum_seconds, base_seconds * (2 ** attempt_number))
+
+    return (delay_seconds / 2.0) + (delay_seconds / 2.0) * jitter()
+
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
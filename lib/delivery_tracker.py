@@ -0,0 +1,116 @@
+"""
+Module to match delivery reports to the messages they are about.
+"""
+
+from collections import OrderedDict
+
+DEFAULT_MAXIMUM_TRACKED = 128
+
+# Numbers are compared on their last digits so a report
+# that adds a country code still matches.
+RECIPIENT_MATCH_DIGITS = 7
+
+
+def is_same_recipient(first_number, second_number):
+    """
+    Returns True if the numbers look like the same phone.
+
+    >>> is_same_recipient("2061234567", "12061234567")
+    True
+    >>> is_same_recipient("2061234567", "2065550000")
+    False
+    >>> is_same_recipient(None, "2061234567")
+    False
+    """
+
+    if first_number is None or second_number is None:
+        return False
+
+    return first_number[-RECIPIENT_MATCH_DIGITS:] == second_number[-RECIPIENT_MATCH_DIGITS:]
+
+
+class DeliveryTracker(object):
+    """
+    Bounded index of sent messages that are waiting on a
+    delivery report, keyed by the modem's message reference.
+    References wrap at 256, so a newer message with the same
+    reference replaces the older one, and the oldest entries
+    are dropped once the index is full.
+
+    >>> tracker = DeliveryTracker(2)
+    >>> tracker.add(1, "2061234567", "first")
+    >>> tracker.add(2, "2061234567", "second")
+    >>> tracker.add(3, "2061234567", "third")
+    >>> tracker.get_pending_count(), tracker.get_evicted_count()
+    (2, 1)
+    >>> tracker.pop(1, "2061234567")
+    >>> tracker.pop(3, "+12061234567")
+    'third'
+    """
+
+    def add(self, message_reference, recipient_number, item):
+        """
+        Starts waiting on a report for a sent message.
+        """
+
+        if message_reference in self.__pending__:
+            del self.__pending__[message_reference]
+
+        self.__pending__[message_reference] = [recipient_number, item]
+
+        while len(self.__pending__) > self.__maximum_tracked__:
+            self.__pending__.popitem(False)
+            self.__evicted_count__ += 1
+
+    def pop(self, message_reference, recipient_number):
+        """
+        Removes and returns the item a report is about,
+        or None if it is not being tracked.
+        """
+
+        if message_reference not in self.__pending__:
+            return None
+
+        tracked_number, item = self.__pending__[message_reference]
+
+        if recipient_number is not None \
+                and not is_same_recipient(tracked_number, recipient_number):
+            return None
+
+        del self.__pending__[message_reference]
+
+        return item
+
+    def get_pending_count(self):
+        """
+        Returns how many messages are waiting on a report.
+        """
+
+        return len(self.__pending__)
+
+    def get_evicted_count(self):
+        """
+        Returns how many messages were dropped before
+        their report arrived.
+        """
+
+        return self.__evicted_count__
+
+    def __init__(self, maximum_tracked=DEFAULT_MAXIMUM_TRACKED):
+        """
+        Create the tracker.
+        """
+
+        self.__maximum_tracked__ = maximum_tracked
+        self.__pending__ = OrderedDict()
+        self.__evicted_count__ = 0
+
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
@@ -0,0 +1,257 @@
+"""
+Module to pass events between the parts of the HangarBuddy.
+
+Everything runs in one process, so events are plain objects
+handed over in memory. Each subscriber has its own bounded
+queue, drained on the thread that services it. A full queue
+turns the event away and counts it, instead of growing
+without limit while the service loop is stuck.
+Events that must never be lost, such as a command to
+turn the heater off, are subscribed with no limit.
+"""
+
+import threading
+import collections
+
+DEFAULT_MAXIMUM_PENDING = 64
+
+
+class Subscription(object):
+    """
+    The queue of events waiting for one subscriber.
+
+    >>> bus = EventBus()
+    >>> subscription = bus.subscribe(int, maximum_pending=2)
+    >>> bus.publish(1), bus.publish(2), bus.publish(3), bus.publish("ignored")
+    (True, True, False, True)
+    >>> subscription.get_pending()
+    [1, 2]
+    >>> subscription.get_statistics()["rejected"]
+    1
+    """
+
+    def has_pending(self):
+        """
+        Returns True if there are events waiting.
+        """
+
+        return len(self.__pending__) > 0
+
+    def get_pending(self):
+        """
+        Removes and returns the events waiting, oldest first.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            pending = list(self.__pending__)
+            self.__pending__.clear()
+            self.__dispatched_count__ += len(pending)
+
+            return pending
+        finally:
+            self.__lock__.release()
+
+    def dispatch(self):
+        """
+        Calls the callback with each event waiting.
+        Returns how many were handled.
+        """
+
+        pending = self.get_pending()
+
+        for event in pending:
+            self.__callback__(event)
+
+        return len(pending)
+
+    def get_statistics(self):
+        """
+        Returns the queue counters.
+        """
+
+        return {"name": self.name,
+                "pending": len(self.__pending__),
+                "delivered": self.__delivered_count__,
+                "dispatched": self.__dispatched_count__,
+                "rejected": self.__rejected_count__,
+                "high_water": self.__high_water__,
+                "maximum_pending": self.__maximum_pending__}
+
+    def __deliver__(self, event):
+        """
+        Adds an event to the queue.
+        Returns False if the queue is full.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            if self.__maximum_pending__ is not None \
+                    and len(self.__pending__) >= self.__maximum_pending__:
+                self.__rejected_count__ += 1
+                return False
+
+            self.__pending__.append(event)
+            self.__delivered_count__ += 1
+            self.__high_water__ = max(self.__high_water__, len(self.__pending__))
+
+            return True
+        finally:
+            self.__lock__.release()
+
+    def __init__(self, name, callback, maximum_pending):
+        """
+        Create the subscription.
+        """
+
+        self.name = name
+        self.__callback__ = callback
+        self.__maximum_pending__ = maximum_pending
+        self.__lock__ = threading.Lock()
+        self.__pending__ = collections.deque()
+        self.__delivered_count__ = 0
+        self.__dispatched_count__ = 0
+        self.__rejected_count__ = 0
+        self.__high_water__ = 0
+
+
+class EventBus(object):
+    """
+    Hands each published event to the subscribers
+    of its class, then wakes the service loop.
+    """
+
+    def subscribe(self, event_type, callback=None, maximum_pending=DEFAULT_MAXIMUM_PENDING):
+        """
+        Returns a new Subscription to events of the given class.
+        The callback is used by Subscription.dispatch().
+        A maximum of None never turns an event away.
+        """
+
+        subscription = Subscription(event_type.__name__, callback, maximum_pending)
+
+        self.__lock__.acquire(True)
+        try:
+            # Copied so publish() can read the list without the lock.
+            self.__subscriptions__[event_type] = \
+                self.__subscriptions__.get(event_type, []) + [subscription]
+        finally:
+            self.__lock__.release()
+
+        return subscription
+
+    def publish(self, event):
+        """
+        Queues the event for everyone that subscribed to its class.
+        Safe to call from any thread.
+        Returns False if a subscriber's queue was full.
+        """
+
+        is_accepted = True
+        subscriptions = self.__subscriptions__.get(type(event), [])
+
+        for subscription in subscriptions:
+            is_accepted = subscription.__deliver__(event) and is_accepted
+
+        self.__published_count__ += 1
+
+        if len(subscriptions) > 0 and self.__wakeup__ is not None:
+            self.__wakeup__.signal()
+
+        return is_accepted
+
+    def get_statistics(self):
+        """
+        Returns the counters for every subscription.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            subscriptions = [subscription
+                             for subscription_list in self.__subscriptions__.values()
+                             for subscription in subscription_list]
+        finally:
+            self.__lock__.release()
+
+        return {"published": self.__published_count__,
+                "subscriptions": [subscription.get_statistics()
+                                  for subscription in subscriptions]}
+
+    def get_status_text(self):
+        """
+        Returns a short line for the status message.
+
+        >>> bus = EventBus()
+        >>> subscription = bus.subscribe(int, maximum_pending=1)
+        >>> bus.publish(1), bus.publish(2)
+        (True, False)
+        >>> bus.get_status_text()
+        'Events:2 rejected:1 peak:1'
+        """
+
+        statistics = self.get_statistics()
+        subscriptions = statistics["subscriptions"]
+
+        return "Events:" + str(statistics["published"]) \
+            + " rejected:" + str(sum([subscription["rejected"]
+                                      for subscription in subscriptions])) \
+            + " peak:" + str(max([0] + [subscription["high_water"]
+                                        for subscription in subscriptions]))
+
+    def __init__(self, wakeup=None):
+        """
+        Create the bus.
+        The wakeup is signalled after each event is queued.
+        """
+
+        self.__wakeup__ = wakeup
+        self.__lock__ = threading.Lock()
+        self.__subscriptions__ = {}
+        self.__published_count__ = 0
+
+
+##############
+# UNIT TESTS #
+##############
+
+
+class SampleEvent(object):
+    """
+    An event for the tests.
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+def test_dispatch_to_each_subscriber():
+    """
+    Test that every subscriber gets its own copy of the
+    queue, and that events of other classes are not delivered.
+    """
+    bus = EventBus()
+    first_values = []
+    second_values = []
+    first = bus.subscribe(SampleEvent, lambda event: first_values.append(event.value))
+    second = bus.subscribe(SampleEvent, lambda event: second_values.append(event.value))
+    bus.publish(SampleEvent(1))
+    bus.publish(SampleEvent(2))
+    bus.publish(1)
+    assert first.dispatch() == 2
+    assert first_values == [1, 2]
+    assert not first.has_pending()
+    assert second.has_pending()
+    second.dispatch()
+    assert second_values == [1, 2]
+
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
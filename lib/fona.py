@@ -1,13 +1,20 @@
+# -*- coding: utf-8 -*-
 """
 Module to help with tha AdaFruit Fona modules
 """
+import sys
 import time
 import threading
-from multiprocessing import Queue as MPQueue
 import datetime
 import local_debug
 import utilities
+import lifecycle
 from logger import Logger
+from modem_reader import ModemReader
+from recurring_task import RecurringTask
+from latency_histogram import LatencyHistogram
+from sms_reassembly import MultipartReassembler
+from event_bus import EventBus
 
 if not local_debug.is_debug():
     import RPi.GPIO as GPIO
@@ -16,11 +23,279 @@ SECONDS_TO_WAIT_AFTER_SEND = 5
 BATTERY_CRITICAL = 40
 BATTERY_WARNING = 60
 DEFAULT_RESPONSE_READ_TIMEOUT = 5
+DEFAULT_COMMAND_TIMEOUT = 2
+MESSAGE_LIST_TIMEOUT = 10
+MESSAGE_READ_TIMEOUT = 5
+MESSAGE_PURGE_TIMEOUT = 25
+COMMAND_POLL_INTERVAL = 0.01
+
+RESULT_OK = "OK"
+RESULT_ERROR = "ERROR"
+RESULT_PROMPT = ">"
+RESULT_TIMEOUT = "TIMEOUT"
+RESULT_NO_CONNECTION = "NO CON"
+FINAL_ERROR_PREFIXES = ["+CME ERROR", "+CMS ERROR"]
+
+SEND_FAILURE_PERMANENT = "permanent"
+SEND_FAILURE_NETWORK = "network"
+SEND_FAILURE_TRANSIENT = "transient"
+
+# +CMS ERROR codes that will fail the same way
+# no matter how often the message is retried.
+CMS_PERMANENT_ERRORS = [1, 8, 10, 21, 29, 50, 96, 304, 305]
+
+# +CMS ERROR codes that mean the network is not
+# available. Retry once the modem is registered again.
+CMS_NETWORK_ERRORS = [27, 38, 41, 42, 47, 331, 332]
+
+# +CREG: stat values for registered on the home network or roaming.
+NETWORK_REGISTERED_STATES = ["1", "5"]
+
+MESSAGE_POLL_FALLBACK_INTERVAL = 60 * 5
+
+# Why the SIM should be checked for messages.
+MESSAGE_CHECK_POLL = "POLL"
+MESSAGE_CHECK_INDICATED = "CMTI"
+MESSAGE_CHECK_RING_INDICATOR = "RI"
+MESSAGE_CHECK_RECONNECT = "RECONNECT"
+
+# More checks than this waiting means
+# some were turned away.
+MESSAGE_CHECK_QUEUE_SIZE = 32
+
+SMS_MODE_PDU = "0"
+SMS_MODE_TEXT = "1"
+DEFAULT_USE_PDU_MODE = True
+
+SMS_PROMPT_TIMEOUT = 5
+SMS_SUBMIT_TIMEOUT = 60
+
+SEND_STAGE_PROMPT = "prompt"
+SEND_STAGE_SUBMIT = "submit"
+SEND_STAGE_NETWORK_ACK = "network_ack"
+SEND_STAGE_TOTAL = "total"
 
 DEFAULT_RING_INDICATOR_PIN = 18  # (Physical... GPIO24)
 DEFAULT_POWER_STATUS_PIN = 16  # (Physical ..GPIO23)
 TIMEZONE_OFFSET = 8
 
+# URCs that mean the modem restarted and lost its settings.
+MODEM_RESET_URCS = ["RDY", "+CFUN:", "+CPIN:", "Call Ready", "SMS Ready"]
+
+# Status queries whose answers are cached, and how many
+# seconds each answer is trusted before it is read again.
+MODEM_STATUS_SIGNAL = "+CSQ"
+MODEM_STATUS_BATTERY = "+CBC"
+MODEM_STATUS_CARRIER = "+COPS?"
+MODEM_STATUS_REGISTRATION = "+CREG?"
+MODEM_STATUS_TIME_TO_LIVE = [[MODEM_STATUS_SIGNAL, 60],
+                             [MODEM_STATUS_BATTERY, 60 * 5],
+                             [MODEM_STATUS_CARRIER, 60 * 10],
+                             [MODEM_STATUS_REGISTRATION, 60]]
+MODEM_STATUS_TIMEOUT = 5
+
+# Rates the modem can be moved to with AT+IPR, fastest first.
+SUPPORTED_BAUD_RATES = [115200, 57600, 38400, 19200, 9600]
+BAUD_RATE_SETTLE_SECONDS = 0.1
+BAUD_RATE_ECHO_TESTS = 3
+
+# After this many timeouts in a row at a negotiated
+# rate, go back to the rate the port was opened at.
+BAUD_RATE_FALLBACK_TIMEOUTS = 3
+
+
+def get_status_response_prefix(status_command):
+    """
+    Returns the prefix of the line that answers a status query.
+
+    >>> get_status_response_prefix("+COPS?")
+    '+COPS:'
+    >>> get_status_response_prefix("+CSQ")
+    '+CSQ:'
+    """
+
+    return status_command.rstrip("?") + ":"
+
+
+def get_final_result_code(response_line):
+    """
+    Returns the final result code if the line ends
+    a command response, otherwise None.
+
+    >>> get_final_result_code("OK")
+    'OK'
+    >>> get_final_result_code("+CMS ERROR: 38")
+    '+CMS ERROR: 38'
+    >>> get_final_result_code("> ")
+    '>'
+    >>> get_final_result_code("+CSQ: 14,0")
+    """
+
+    if response_line is None:
+        return None
+
+    response_line = response_line.strip()
+
+    if response_line in [RESULT_OK, RESULT_ERROR, RESULT_PROMPT]:
+        return response_line
+
+    for error_prefix in FINAL_ERROR_PREFIXES:
+        if response_line.startswith(error_prefix):
+            return response_line
+
+    return None
+
+
+def get_message_reference(cmgs_response):
+    """
+    Returns the message reference from a +CMGS response line.
+
+    >>> get_message_reference("+CMGS: 27")
+    27
+    >>> get_message_reference(None)
+    """
+
+    if cmgs_response is None:
+        return None
+
+    try:
+        return int(cmgs_response.rpartition(":")[2])
+    except ValueError:
+        return None
+
+
+def classify_send_failure(error_code):
+    """
+    Returns what kind of failure a +CMS ERROR code is.
+    Failures without a code are taken to be transient.
+
+    >>> classify_send_failure(38)
+    'network'
+    >>> classify_send_failure(21)
+    'permanent'
+    >>> classify_send_failure(None)
+    'transient'
+    """
+
+    if error_code in CMS_PERMANENT_ERRORS:
+        return SEND_FAILURE_PERMANENT
+
+    if error_code in CMS_NETWORK_ERRORS:
+        return SEND_FAILURE_NETWORK
+
+    return SEND_FAILURE_TRANSIENT
+
+
+def is_registration_response(creg_response):
+    """
+    Returns True if a +CREG? response says the modem
+    is registered on the network.
+
+    >>> is_registration_response("+CREG: 0,1")
+    True
+    >>> is_registration_response("+CREG: 0,2")
+    False
+    >>> is_registration_response(None)
+    False
+    """
+
+    if creg_response is None:
+        return False
+
+    return creg_response.rpartition(",")[2].strip() in NETWORK_REGISTERED_STATES
+
+
+def is_modem_rejection(command_result):
+    """
+    Returns True if the modem answered with an error,
+    as opposed to not answering at all.
+
+    >>> is_modem_rejection(CommandResult("AT+CFGRI=1", [], "ERROR", 0))
+    True
+    >>> is_modem_rejection(CommandResult("AT+CSMS=1", [], "+CME ERROR: 4", 0))
+    True
+    >>> is_modem_rejection(CommandResult("AT", [], RESULT_TIMEOUT, 0))
+    False
+    """
+
+    return command_result.result_code == RESULT_ERROR \
+        or command_result.get_error_code() is not None
+
+
+class CommandResult(object):
+    """
+    Class to hold the outcome of a single AT command.
+    """
+
+    def is_ok(self):
+        """
+        Did the modem answer with OK?
+        """
+        return self.result_code == RESULT_OK
+
+    def is_prompt(self):
+        """
+        Did the modem answer with the input prompt?
+        """
+        return self.result_code == RESULT_PROMPT
+
+    def is_timeout(self):
+        """
+        Did the command run out of time before
+        a final result code was seen?
+        """
+        return self.result_code == RESULT_TIMEOUT
+
+    def is_error(self):
+        """
+        Did the command fail for any reason?
+        """
+        return not self.is_ok() and not self.is_prompt()
+
+    def get_error_code(self):
+        """
+        Returns the numeric +CME/+CMS error code,
+        or None if there is not one.
+
+        >>> CommandResult("AT+CMGS", [], "+CMS ERROR: 38", 0).get_error_code()
+        38
+        >>> CommandResult("AT", [], "OK", 0).get_error_code()
+        """
+
+        for error_prefix in FINAL_ERROR_PREFIXES:
+            if self.result_code.startswith(error_prefix):
+                try:
+                    return int(self.result_code.rpartition(":")[2])
+                except ValueError:
+                    return None
+
+        return None
+
+    def get_response(self, prefix):
+        """
+        Returns the first response line that starts with
+        the given prefix, or None.
+
+        >>> CommandResult("AT+CSQ", ["+CSQ: 14,0"], "OK", 0).get_response("+CSQ:")
+        '+CSQ: 14,0'
+        """
+
+        for response_line in self.response_lines:
+            if response_line.startswith(prefix):
+                return response_line
+
+        return None
+
+    def __init__(self, command, response_lines, result_code, elapsed_seconds):
+        """
+        Create the object.
+        """
+
+        self.command = command
+        self.response_lines = response_lines
+        self.result_code = result_code
+        self.elapsed_seconds = elapsed_seconds
+
 
 class BatteryCondition(object):
     """
@@ -129,435 +404,2220 @@ class SignalStrength(object):
             self.bit_error_rate = 0
 
 
-class SmsMessage(object):
+##############################
+#--- PDU mode codec
+##############################
+
+# GSM 03.38 default alphabet. The index is the septet value.
+GSM7_BASIC_ALPHABET = u"@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?" \
+    u"¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+
+# Characters reached with the 0x1B escape.
+GSM7_EXTENDED_ALPHABET = {0x0A: u"\f", 0x14: u"^", 0x28: u"{", 0x29: u"}",
+                          0x2F: u"\\", 0x3C: u"[", 0x3D: u"~", 0x3E: u"]",
+                          0x40: u"|", 0x65: u"€"}
+
+GSM7_ESCAPE = 0x1B
+GSM7_BASIC_LOOKUP = dict((character, septet)
+                         for septet, character in enumerate(GSM7_BASIC_ALPHABET))
+GSM7_EXTENDED_LOOKUP = dict((character, septet)
+                            for septet, character in GSM7_EXTENDED_ALPHABET.items())
+
+ALPHABET_GSM7 = "GSM7"
+ALPHABET_8BIT = "8BIT"
+ALPHABET_UCS2 = "UCS2"
+
+GSM7_SINGLE_SEGMENT_SEPTETS = 160
+GSM7_MULTIPART_SEGMENT_SEPTETS = 153
+UCS2_SINGLE_SEGMENT_OCTETS = 140
+UCS2_MULTIPART_SEGMENT_OCTETS = 134
+
+TYPE_OF_ADDRESS_UNKNOWN = 0x81
+TYPE_OF_ADDRESS_INTERNATIONAL = 0x91
+TYPE_OF_ADDRESS_ALPHANUMERIC = 0xD0
+
+SUBMIT_FIRST_OCTET = 0x11  # SMS-SUBMIT, relative validity period
+UDHI_FLAG = 0x40
+STATUS_REPORT_REQUEST_FLAG = 0x20
+TEXT_MODE_SUBMIT_PARAMETERS = "49,167,0,0"  # SMS-SUBMIT with a status report request
+VALIDITY_PERIOD_ONE_DAY = 0xA7
+
+IEI_CONCATENATED_8BIT = 0x00
+IEI_CONCATENATED_16BIT = 0x08
+
+# Message status numbers used by AT+CMGL / AT+CMGR in PDU mode.
+PDU_MESSAGE_STATUS = {"REC UNREAD": "0", "REC READ": "1",
+                      "STO UNSENT": "2", "STO SENT": "3", "ALL": "4"}
+
+# Stand ins for characters outside the GSM 7 bit alphabet.
+# Any one of these would otherwise force the whole
+# message into UCS2 and double its segment count.
+GSM7_TRANSLITERATIONS = {u"\u00a0": u" ",      # no-break space
+                         u"\t": u" ",
+                         u"\u2018": u"'",      # smart quotes
+                         u"\u2019": u"'",
+                         u"\u201a": u",",
+                         u"\u201c": u'"',
+                         u"\u201d": u'"',
+                         u"\u201e": u'"',
+                         u"\u2013": u"-",      # en and em dash
+                         u"\u2014": u"-",
+                         u"\u2212": u"-",      # minus sign
+                         u"\u2026": u"...",
+                         u"\u2022": u"*",
+                         u"\u00b0": u"deg",    # degree sign
+                         u"\u00b1": u"+/-",
+                         u"\u00b5": u"u",
+                         u"\u00e7": u"\u00c7",
+                         u"\u00e1": u"a",
+                         u"\u00e2": u"a",
+                         u"\u00ea": u"e",
+                         u"\u00eb": u"e",
+                         u"\u00ed": u"i",
+                         u"\u00ee": u"i",
+                         u"\u00ef": u"i",
+                         u"\u00f3": u"o",
+                         u"\u00f4": u"o",
+                         u"\u00fa": u"u",
+                         u"\u00fb": u"u"}
+
+
+def pack_septets(septets, fill_bits=0):
     """
-    Class to abstract a text message.
+    Packs 7 bit values into octets, least significant bit first.
+
+    >>> ''.join('%02X' % octet for octet in pack_septets(encode_gsm7(u"hellohello")))
+    'E8329BFD4697D9EC37'
     """
 
-    def get_sender_number(self):
-        """
-        Gets the sender's number.
-        """
-        if self.is_message_ok():
-            return utilities.get_cleaned_phone_number(self.sender_number)
+    octets = []
+    bit_buffer = 0
+    bit_count = fill_bits
 
-        return None
+    for septet in septets:
+        bit_buffer |= (septet & 0x7F) << bit_count
+        bit_count += 7
 
-    def is_message_ok(self):
-        """
-        Is the message valid?
-        """
-        return not self.error_state
+        while bit_count >= 8:
+            octets.append(bit_buffer & 0xFF)
+            bit_buffer >>= 8
+            bit_count -= 8
 
-    def minutes_waiting(self):
-        """
-        How many hours between being sent
-        and received.
-        """
+    if bit_count > 0:
+        octets.append(bit_buffer & 0xFF)
 
-        return (self.received_time
-                - (self.sent_time + datetime.timedelta(hours=TIMEZONE_OFFSET))).days * 24 * 60
+    return octets
 
-    def message_sent_time_utc(self):
-        """
-        When was the message sent in UTC time?
-        The SIM card returns time as Local...
-        """
 
-        return (self.sent_time + datetime.timedelta(hours=TIMEZONE_OFFSET))
+def unpack_septets(octets, septet_count, fill_bits=0):
+    """
+    Unpacks 7 bit values from octets.
 
-    def __init__(self,
-                 message_header,
-                 message_text):
-        """
-        Create the object.
-        """
-        self.message_id = None
-        self.sender_number = None
-        self.message_status = None
-        self.message_text = None
-        self.received_time = datetime.datetime.now()
-        self.sent_time = None
+    >>> decode_gsm7(unpack_septets(bytearray.fromhex(u"E8329BFD4697D9EC37"), 10))
+    u'hellohello'
+    """
 
-        try:
-            metadata_list = message_header.split(",")
-            message_id = metadata_list[0]
-            message_id = message_id.rpartition(":")[2].strip()
-            message_status = metadata_list[1]
-            sender_number = metadata_list[2]
-            message_date = metadata_list[4].replace('"', '')
-            date_tokens = message_date.split('/')
-            message_time = metadata_list[5].split('-')[0]
-            time_tokens = message_time.split(':')
+    septets = []
+    bit_buffer = 0
+    bit_count = 0
 
-            self.message_id = message_id
-            self.sent_time = datetime.datetime.combine(
-                datetime.datetime(
-                    int("20" + date_tokens[0]), int(date_tokens[1]), int(date_tokens[2])),
-                datetime.time(
-                    int(time_tokens[0]), int(time_tokens[1]), int(time_tokens[2])))
-            self.sender_number = sender_number
-            self.message_status = message_status
-            self.message_text = message_text
-            self.error_state = False
-        except:
-            self.error_state = True
+    for octet in octets:
+        bit_buffer |= octet << bit_count
+        bit_count += 8
 
+        if fill_bits > 0:
+            bit_buffer >>= fill_bits
+            bit_count -= fill_bits
+            fill_bits = 0
 
-class Fona(object):
-    """
-    Class that send messages with an Adafruit Fona
-    SERIAL_PORT, BAUDRATE, timeout=.1, rtscts=0
-    Attributes:
-    unauthorize numbers
+        while bit_count >= 7 and len(septets) < septet_count:
+            septets.append(bit_buffer & 0x7F)
+            bit_buffer >>= 7
+            bit_count -= 7
+
+    return septets
+
+
+def is_gsm7_encodable(text):
     """
+    Returns True if every character is in the GSM 7 bit alphabet.
 
-    def is_power_on(self):
-        """
-        Returns TRUE if the power is on.
-        """
+    >>> is_gsm7_encodable(u"Heater is ON.")
+    True
+    >>> is_gsm7_encodable(u"72\u00b0F")
+    False
+    """
 
-        if local_debug.is_debug():
-            return True
+    for character in text:
+        if character not in GSM7_BASIC_LOOKUP and character not in GSM7_EXTENDED_LOOKUP:
+            return False
 
-        if self.__use_gpio_pins__():
-            pin_value = GPIO.input(self.power_status_pin)
-            self.__logger__.log_info_message(
-                "Power... PIN=" + str(self.power_status_pin) + ", VAL=" + str(pin_value))
-            return GPIO.input(self.power_status_pin) == GPIO.HIGH
+    return True
 
-        # If we are not using the power pins
-        # then use the existance of the serial
-        # modem connection
-        return self.serial_connection is not None
 
-    def is_message_waiting(self):
-        """
-        Uses the GPIO pin to see if a message is waiting.
-        """
+def encode_gsm7(text):
+    """
+    Returns the septets for the text.
+    Characters outside the alphabet become '?'.
 
-        return not self.__message_waiting_queue__.empty()
+    >>> encode_gsm7(u"a[")
+    [97, 27, 60]
+    """
 
-    def get_carrier(self):
-        """
-        Returns the carrier.
-        """
-        return self.__send_command__("AT+COPS?")
+    septets = []
 
-    def get_signal_strength(self):
-        """
-        Returns an object representing the signal strength.
-        """
-        command_result = self.__send_command__("AT+CSQ")
-        if command_result is None or len(command_result) < 2:
-            command_result = None
+    for character in text:
+        if character in GSM7_BASIC_LOOKUP:
+            septets.append(GSM7_BASIC_LOOKUP[character])
+        elif character in GSM7_EXTENDED_LOOKUP:
+            septets.append(GSM7_ESCAPE)
+            septets.append(GSM7_EXTENDED_LOOKUP[character])
         else:
-            command_result = command_result[1]
+            septets.append(GSM7_BASIC_LOOKUP[u"?"])
 
-        return SignalStrength(command_result)
+    return septets
 
-    def get_current_battery_condition(self):
-        """
-        Returns an object representing the current battery state.
-        """
-        self.__logger__.log_info_message("Sending CBC command")
-        time.sleep(5)
-        command_result = self.__send_command__("AT+CBC")
 
-        for result in command_result:
-            if "CBC:" in result:
-                return BatteryCondition(result)
+def decode_gsm7(septets):
+    """
+    Returns the text for the septets.
 
-        return BatteryCondition(None)
+    >>> decode_gsm7([97, 27, 60, 0])
+    u'a[@'
+    """
 
-    def get_module_name(self):
-        """
-        Returns the name of the GSM module.
-        """
-        return self.__send_command__("ATI")
+    characters = []
+    is_escaped = False
 
-    def get_sim_card_number(self):
-        """
-        Returns the id of the sim card.
-        """
-        return self.__send_command__("AT+CCID")
+    for septet in septets:
+        if is_escaped:
+            characters.append(GSM7_EXTENDED_ALPHABET.get(septet, u" "))
+            is_escaped = False
+        elif septet == GSM7_ESCAPE:
+            is_escaped = True
+        else:
+            characters.append(GSM7_BASIC_ALPHABET[septet])
 
-    def send_message(self, message_num, text):
-        """
-        Sends a message to the specified phone numbers.
-        """
+    return u"".join(characters)
 
-        cleaned_number = utilities.get_cleaned_phone_number(message_num)
 
-        if cleaned_number is None or text is None:
-            return
+def decode_semi_octets(octets):
+    """
+    Returns the digits from swapped semi-octets.
+    An F nibble is padding.
 
-        self.__logger__.log_info_message("Setting receiving number...")
-        self.__set_sms_mode__()
-        self.__write_to_fona__('\r\r\n')
-        self.__logger__.log_info_message("Wait for resp:")
-        if self.__wait_for_command_response__:
-            self.__logger__.log_info_message(self.__read_from_fona__(5))
-        self.__write_to_fona__('AT+CMGS="' + cleaned_number + '"')
-        self.__logger__.log_info_message("Wait for resp 2:")
-        self.__wait_for_command_response__()
-        self.__logger__.log_info_message(self.__read_from_fona__(5))
-        self.__write_to_fona__('\r')
-        self.__wait_for_command_response__()
-        self.__logger__.log_info_message(self.__read_from_fona__(5))
-        self.__logger__.log_info_message(self.__write_to_fona__(text + '\x1a'))
-        self.__wait_for_command_response__()
+    >>> decode_semi_octets(bytearray.fromhex(u"0216214365F7"))
+    '20611234567'
+    """
 
-        self.__logger__.log_info_message(self.__read_from_fona__(2))
-        self.__logger__.log_info_message("Check phone")
+    digits = ""
 
-        return True
+    for octet in octets:
+        for nibble in [octet & 0x0F, octet >> 4]:
+            if nibble < 10:
+                digits += str(nibble)
 
-    def get_messages(self):
-        """
-        Reads text messages on the SIM card and returns
-        a list of messages with three fields: id, num, message.
-        """
+    return digits
 
-        if self.serial_connection is None:
-            return []
 
-        # put into SMS mode
+def encode_semi_octets(digits):
+    """
+    Returns swapped semi-octets for the digits, padded with F.
 
-        self.__set_sms_mode__()
-        # get all text messages currently on SIM Card
-        self.serial_connection.write('AT+CMGL="ALL"\r')
-        time.sleep(3)
-        messages = []
-        while self.serial_connection.inWaiting() > 0:
-            message_header = self.serial_connection.readline().strip()
-            if "+CMGL:" in message_header:
-                message_text = self.serial_connection.readline().strip()
+    >>> ''.join('%02X' % octet for octet in encode_semi_octets("20611234567"))
+    '0216214365F7'
+    """
 
-                new_message = SmsMessage(message_header,
-                                         message_text)
-                messages.append(new_message)
+    if len(digits) % 2 == 1:
+        digits += "F"
 
-                time.sleep(1)
+    return [int(digits[index + 1] + digits[index], 16)
+            for index in range(0, len(digits), 2)]
 
-        self.__clear_messages_waiting_queue__()
 
-        return messages
+def decode_timestamp(octets):
+    """
+    Decodes a 7 octet service centre time stamp.
+    Returns the local time and the offset from UTC in minutes.
 
-    def delete_message(self, message_to_delete):
-        """
-        Deletes a message with the given Id.
-        """
-        self.__send_command__("AT+CMGD=" + str(message_to_delete.message_id))
+    >>> decode_timestamp(bytearray.fromhex(u"71016121001423"))
+    (datetime.datetime(2017, 10, 16, 12, 0, 41), 480)
+    >>> decode_timestamp(bytearray.fromhex(u"7101612100148A"))
+    (datetime.datetime(2017, 10, 16, 12, 0, 41), -420)
+    """
 
-    def delete_messages(self):
-        """ Deletes any messages. """
-        messages = self.get_messages()
-        messages_deleted = 0
-        for message_to_delete in messages:
-            messages_deleted += 1
-            self.delete_message(message_to_delete)
+    fields = [(octet & 0x0F) * 10 + (octet >> 4) for octet in octets[0:6]]
+    local_time = datetime.datetime(2000 + fields[0], fields[1], fields[2],
+                                   fields[3], fields[4], fields[5])
 
-        if local_debug.is_debug():
-            self.__clear_messages_waiting_queue__()
+    timezone_octet = octets[6]
+    quarter_hours = (timezone_octet & 0x07) * 10 + (timezone_octet >> 4)
 
-        return messages_deleted
+    if timezone_octet & 0x08:
+        quarter_hours = -quarter_hours
 
-    def simple_terminal(self):
-        """
-        Simple interactive terminal to play with the Fona.
-        """
+    return local_time, quarter_hours * 15
 
-        should_quit = False
-        ret = []
-        start_time = time.time()
 
-        while not should_quit:
-            try:
-                command = str(input("READY:"))
-                if command == "quit":
-                    should_quit = True
-                else:
-                    ret.append(
-                        "time.sleep(" + str(time.time() - start_time) + ")")
-                    write_result = self.__write_to_fona__(command)
-                    start_time = time.time()
-                    self.__logger__.log_info_message(write_result)
+def get_alphabet(data_coding_scheme):
+    """
+    Returns the alphabet named by the data coding scheme.
+
+    >>> get_alphabet(0x00)
+    'GSM7'
+    >>> get_alphabet(0x08)
+    'UCS2'
+    >>> get_alphabet(0xF4)
+    '8BIT'
+    """
 
-                    self.__logger__.log_info_message(self.__read_from_fona__(
-                        DEFAULT_RESPONSE_READ_TIMEOUT))
-            except:
-                self.__logger__.log_warning_message("ERROR")
+    if data_coding_scheme & 0xC0 == 0x00:
+        alphabet_bits = (data_coding_scheme >> 2) & 0x03
+    elif data_coding_scheme & 0xF0 == 0xF0:
+        alphabet_bits = (data_coding_scheme >> 2) & 0x01
+    elif data_coding_scheme & 0xF0 == 0xE0:
+        alphabet_bits = 0x02
+    else:
+        alphabet_bits = 0x00
+
+    return [ALPHABET_GSM7, ALPHABET_8BIT, ALPHABET_UCS2, ALPHABET_GSM7][alphabet_bits]
+
+
+def split_gsm7_septets(septets, segment_size):
+    """
+    Splits septets into segments without
+    separating an escape from its character.
+
+    >>> [len(segment) for segment in split_gsm7_septets([97] * 152 + [27, 60], 153)]
+    [152, 2]
+    """
+
+    segments = []
+    segment = []
+
+    index = 0
+    while index < len(septets):
+        character_septets = septets[index:index + 1]
+
+        if septets[index] == GSM7_ESCAPE:
+            character_septets = septets[index:index + 2]
+
+        if len(segment) + len(character_septets) > segment_size:
+            segments.append(segment)
+            segment = []
+
+        segment += character_septets
+        index += len(character_septets)
+
+    if len(segment) > 0 or len(segments) == 0:
+        segments.append(segment)
+
+    return segments
+
+
+def split_ucs2_octets(octets, segment_size):
+    """
+    Splits UTF-16 octets into segments without
+    separating a surrogate pair.
+
+    >>> [len(segment) for segment in split_ucs2_octets(bytearray(10), 4)]
+    [4, 4, 2]
+    """
+
+    segments = []
+    index = 0
+
+    while index < len(octets):
+        end = min(index + segment_size, len(octets))
+
+        # Do not end a segment on a high surrogate.
+        if end < len(octets) and 0xD8 <= octets[end - 2] <= 0xDB:
+            end -= 2
+
+        segments.append(octets[index:end])
+        index = end
+
+    if len(segments) == 0:
+        segments.append(bytearray())
+
+    return segments
+
+
+def to_unicode(text):
+    """
+    Returns the text as unicode.
+    Byte strings are taken to be UTF-8.
+
+    >>> to_unicode("OK")
+    u'OK'
+    """
+
+    if isinstance(text, unicode):
+        return text
+
+    return text.decode('utf-8', 'replace')
+
+
+def transliterate_to_gsm7(text):
+    """
+    Swaps characters outside the GSM 7 bit alphabet for
+    safe stand ins. The text is only changed if the result
+    fits in GSM 7 bit; text that needs UCS2 anyway is kept
+    as it is.
+
+    >>> transliterate_to_gsm7(u"\u201cHeater\u201d is ON \u2013 72\u00b0F")
+    u'"Heater" is ON - 72degF'
+    >>> transliterate_to_gsm7(u"\u2018OK\u2019 \u263a")
+    u'\\u2018OK\\u2019 \\u263a'
+    """
+
+    unicode_text = to_unicode(text)
+    transliterated_text = u"".join([GSM7_TRANSLITERATIONS.get(character, character)
+                                    for character in unicode_text])
+
+    if is_gsm7_encodable(transliterated_text):
+        return transliterated_text
+
+    return unicode_text
+
+
+def get_message_segments(text):
+    """
+    Splits a message into the segments it will be sent as.
+    Returns the alphabet and the list of segments, as
+    septets for GSM 7 bit or octets for UCS2.
+
+    >>> alphabet, segments = get_message_segments("x" * 160)
+    >>> alphabet, len(segments)
+    ('GSM7', 1)
+    >>> alphabet, segments = get_message_segments("x" * 161)
+    >>> alphabet, len(segments)
+    ('GSM7', 2)
+    >>> alphabet, segments = get_message_segments(u"x" * 70 + u"\u263a")
+    >>> alphabet, len(segments)
+    ('UCS2', 2)
+    """
+
+    unicode_text = to_unicode(text)
+
+    if is_gsm7_encodable(unicode_text):
+        septets = encode_gsm7(unicode_text)
+
+        if len(septets) <= GSM7_SINGLE_SEGMENT_SEPTETS:
+            return ALPHABET_GSM7, [septets]
+
+        return ALPHABET_GSM7, split_gsm7_septets(septets, GSM7_MULTIPART_SEGMENT_SEPTETS)
+
+    octets = bytearray(unicode_text.encode('utf-16-be'))
+
+    if len(octets) <= UCS2_SINGLE_SEGMENT_OCTETS:
+        return ALPHABET_UCS2, [octets]
+
+    return ALPHABET_UCS2, split_ucs2_octets(octets, UCS2_MULTIPART_SEGMENT_OCTETS)
+
+
+def encode_submit_pdus(phone_number, text, concatenation_reference=0, first_octet_flags=0):
+    """
+    Encodes a message as one or more SMS-SUBMIT PDUs.
+    Uses GSM 7 bit when every character fits,
+    otherwise UCS2. Long messages get a concatenation header.
+    Returns a list of [hex PDU, TPDU length] pairs.
+
+    >>> encode_submit_pdus("2061234567", "hellohello")
+    [['0011000A8102163254760000A70AE8329BFD4697D9EC37', 22]]
+    >>> len(encode_submit_pdus("2061234567", "x" * 161))
+    2
+    >>> encode_submit_pdus("2061234567", u"72\u00b0")[0][0][22:24]
+    '08'
+    """
+
+    alphabet, segments = get_message_segments(text)
+    is_gsm7 = alphabet == ALPHABET_GSM7
+
+    address_digits = utilities.get_cleaned_phone_number(phone_number)
+    pdus = []
+
+    for segment_index, segment in enumerate(segments):
+        user_data_header = []
+
+        if len(segments) > 1:
+            user_data_header = [5, IEI_CONCATENATED_8BIT, 3,
+                                concatenation_reference & 0xFF,
+                                len(segments), segment_index + 1]
+
+        first_octet = SUBMIT_FIRST_OCTET | first_octet_flags
+        if len(user_data_header) > 0:
+            first_octet |= UDHI_FLAG
+
+        tpdu = [first_octet, 0x00, len(address_digits), TYPE_OF_ADDRESS_UNKNOWN]
+        tpdu += encode_semi_octets(address_digits)
+        tpdu += [0x00, 0x00 if is_gsm7 else 0x08, VALIDITY_PERIOD_ONE_DAY]
+
+        if is_gsm7:
+            header_septets = (len(user_data_header) * 8 + 6) // 7
+            fill_bits = header_septets * 7 - len(user_data_header) * 8
+            tpdu += [header_septets + len(segment)]
+            tpdu += user_data_header
+            tpdu += pack_septets(segment, fill_bits)
+        else:
+            tpdu += [len(user_data_header) + len(segment)]
+            tpdu += user_data_header
+            tpdu += list(segment)
+
+        # "00" means use the SMSC stored on the SIM.
+        pdus.append(["00" + "".join("%02X" % octet for octet in tpdu), len(tpdu)])
+
+    return pdus
+
+
+def decode_address(octets, offset):
+    """
+    Decodes an address field.
+    Returns the address and the offset after it.
+
+    >>> decode_address(bytearray.fromhex(u"0A810216325476"), 0)
+    ('2061234567', 7)
+    """
+
+    digit_count = octets[offset]
+    type_of_address = octets[offset + 1]
+    octet_count = (digit_count + 1) // 2
+    address_octets = octets[offset + 2:offset + 2 + octet_count]
+
+    if type_of_address & 0x70 == TYPE_OF_ADDRESS_ALPHANUMERIC & 0x70:
+        address = decode_gsm7(unpack_septets(address_octets,
+                                             (digit_count * 4) // 7)).encode('utf-8')
+    else:
+        address = decode_semi_octets(address_octets)
+
+        if type_of_address == TYPE_OF_ADDRESS_INTERNATIONAL:
+            address = "+" + address
+
+    return address, offset + 2 + octet_count
+
+
+class EncodedMessage(object):
+    """
+    An outbound message after transliteration,
+    with the alphabet and number of segments it will
+    be sent as, so the airtime cost is known up front.
+
+    >>> message = EncodedMessage(u"Heater is ON \u2013 72\u00b0F")
+    >>> message.text, message.alphabet, message.segment_count, message.was_transliterated
+    ('Heater is ON - 72degF', 'GSM7', 1, True)
+    """
+
+    def __init__(self, text):
+        """
+        Encode the message.
+        """
+
+        unicode_text = to_unicode(text)
+        transliterated_text = transliterate_to_gsm7(unicode_text)
+
+        self.text = transliterated_text.encode('utf-8')
+        self.was_transliterated = transliterated_text != unicode_text
+        self.alphabet, segments = get_message_segments(transliterated_text)
+        self.segment_count = len(segments)
+
+
+class SmsDeliverPdu(object):
+    """
+    Decodes a received SMS-DELIVER PDU.
+    """
+
+    def is_valid(self):
+        """
+        Did the PDU decode?
+        """
+        return not self.error_state
+
+    def is_concatenated(self):
+        """
+        Is this one part of a longer message?
+        """
+        return self.concatenation_total > 1
+
+    def __decode_user_data_header__(self, header_octets):
+        """
+        Picks the concatenation details out of the user data header.
+        """
+
+        index = 0
+
+        while index + 1 < len(header_octets):
+            element_id = header_octets[index]
+            element_length = header_octets[index + 1]
+            element = header_octets[index + 2:index + 2 + element_length]
+
+            if element_id == IEI_CONCATENATED_8BIT and element_length == 3:
+                self.concatenation_reference = element[0]
+                self.concatenation_total = element[1]
+                self.concatenation_sequence = element[2]
+            elif element_id == IEI_CONCATENATED_16BIT and element_length == 4:
+                self.concatenation_reference = (element[0] << 8) | element[1]
+                self.concatenation_total = element[2]
+                self.concatenation_sequence = element[3]
+
+            index += 2 + element_length
+
+    def __init__(self, pdu_hex):
+        """
+        Decode the PDU.
+        """
+
+        self.error_state = False
+        self.sender_number = None
+        self.sent_time = None
+        self.sent_time_utc = None
+        self.utc_offset_minutes = 0
+        self.text = u""
+        self.alphabet = ALPHABET_GSM7
+        self.concatenation_reference = None
+        self.concatenation_total = 1
+        self.concatenation_sequence = 1
+
+        try:
+            octets = bytearray.fromhex(to_unicode(pdu_hex.strip()))
+            offset = octets[0] + 1  # Skip the SMSC
+            first_octet = octets[offset]
+            has_user_data_header = first_octet & UDHI_FLAG
+            self.sender_number, offset = decode_address(octets, offset + 1)
+            data_coding_scheme = octets[offset + 1]
+            self.alphabet = get_alphabet(data_coding_scheme)
+            self.sent_time, self.utc_offset_minutes = decode_timestamp(
+                octets[offset + 2:offset + 9])
+            self.sent_time_utc = self.sent_time - \
+                datetime.timedelta(minutes=self.utc_offset_minutes)
+            user_data_length = octets[offset + 9]
+            user_data = octets[offset + 10:]
+            header_length = 0
+
+            if has_user_data_header:
+                header_length = user_data[0] + 1
+                self.__decode_user_data_header__(user_data[1:header_length])
+
+            if self.alphabet == ALPHABET_GSM7:
+                header_septets = (header_length * 8 + 6) // 7
+                fill_bits = header_septets * 7 - header_length * 8
+                self.text = decode_gsm7(unpack_septets(user_data[header_length:],
+                                                       user_data_length - header_septets,
+                                                       fill_bits))
+            elif self.alphabet == ALPHABET_UCS2:
+                self.text = bytes(user_data[header_length:user_data_length]).decode(
+                    'utf-16-be', 'replace')
+            else:
+                self.text = to_unicode(bytes(user_data[header_length:user_data_length]))
+        except:
+            self.error_state = True
+
+
+class SmsStatusReport(object):
+    """
+    Decodes a +CDS delivery report.
+    In PDU mode the report is the +CDS line and the
+    SMS-STATUS-REPORT PDU on the line after it, joined by
+    a newline. In text mode it is a single line.
+
+    >>> report = SmsStatusReport("+CDS: 25\\n07912160130300F4061B0A8102163254767101612100148A7101612101148A00")
+    >>> report.message_reference, report.recipient_number, report.is_delivered()
+    (27, '2061234567', True)
+    >>> report = SmsStatusReport('+CDS: 6,27,"2061234567",129,"17/10/16,12:00:41-28","17/10/16,12:01:41-28",96')
+    >>> report.message_reference, report.is_failed(), report.is_permanent_failure()
+    (27, True, False)
+    """
+
+    def is_valid(self):
+        """
+        Did the report decode?
+        """
+        return not self.error_state
+
+    def is_delivered(self):
+        """
+        Did the message reach the phone?
+        """
+        return self.is_valid() and self.status < 0x20
+
+    def is_pending(self):
+        """
+        Is the service centre still trying?
+        """
+        return self.is_valid() and 0x20 <= self.status < 0x40
+
+    def is_failed(self):
+        """
+        Has the service centre given up on the message?
+        """
+        return self.is_valid() and self.status >= 0x40
+
+    def is_permanent_failure(self):
+        """
+        Did it give up because the message can never be delivered?
+        Failures from 0x60 up were temporary errors that ran
+        out of time, so sending again may work.
+        """
+        return self.is_valid() and 0x40 <= self.status < 0x60
+
+    def __decode_pdu__(self, pdu_hex):
+        """
+        Decodes an SMS-STATUS-REPORT PDU.
+        """
+
+        octets = bytearray.fromhex(to_unicode(pdu_hex.strip()))
+        offset = octets[0] + 1  # Skip the SMSC
+        self.message_reference = octets[offset + 1]
+        self.recipient_number, offset = decode_address(octets, offset + 2)
+        # Skip the service centre and discharge time stamps.
+        self.status = octets[offset + 14]
+
+    def __decode_text__(self, urc_line):
+        """
+        Decodes a text mode +CDS: fo,mr,ra,tora,scts,dt,st line.
+        """
+
+        fields = urc_line.partition(":")[2].split(",")
+        self.message_reference = int(fields[1])
+        self.recipient_number = fields[2].replace('"', '').strip()
+        self.status = int(fields[-1])
+
+    def __init__(self, status_report_text):
+        """
+        Decode the report.
+        """
+
+        self.error_state = False
+        self.message_reference = None
+        self.recipient_number = None
+        self.status = None
+
+        try:
+            lines = status_report_text.strip().split("\n")
+
+            if "," in lines[0]:
+                self.__decode_text__(lines[0])
+            else:
+                self.__decode_pdu__(lines[1])
+        except:
+            self.error_state = True
+
+
+class SmsMessage(object):
+    """
+    Class to abstract a text message.
+    """
+
+    def get_sender_number(self):
+        """
+        Gets the sender's number.
+        """
+        if self.is_message_ok():
+            return utilities.get_cleaned_phone_number(self.sender_number)
+
+        return None
+
+    def is_message_ok(self):
+        """
+        Is the message valid?
+        """
+        return not self.error_state
+
+    def minutes_waiting(self):
+        """
+        How many hours between being sent
+        and received.
+        """
+
+        return (self.received_time
+                - (self.sent_time + datetime.timedelta(hours=TIMEZONE_OFFSET))).days * 24 * 60
+
+    def message_sent_time_utc(self):
+        """
+        When was the message sent in UTC time?
+        The SIM card returns time as Local...
+        """
+
+        return (self.sent_time + datetime.timedelta(hours=TIMEZONE_OFFSET))
+
+    def get_message_ids(self):
+        """
+        Returns the SIM indexes that hold this message.
+        """
+
+        return [self.message_id]
+
+    def get_concatenation_info(self):
+        """
+        Returns the reference, part count, and sequence
+        number if this is one part of a longer message.
+        Text mode does not show the parts, so this is None.
+        """
+
+        return None
+
+    def __init__(self,
+                 message_header,
+                 message_text,
+                 message_id=None):
+        """
+        Create the object.
+        The header is either a +CMGL line, or a +CMGR line
+        together with the index it was read from.
+        """
+        self.message_id = None
+        self.sender_number = None
+        self.message_status = None
+        self.message_text = None
+        self.received_time = datetime.datetime.now()
+        self.sent_time = None
+
+        try:
+            metadata_list = message_header.split(",")
+            # +CMGR does not repeat the index, so line
+            # the fields up with the +CMGL layout.
+            if message_id is not None:
+                metadata_list.insert(0, str(message_id))
+            message_id = metadata_list[0]
+            message_id = message_id.rpartition(":")[2].strip()
+            message_status = metadata_list[1].rpartition(":")[2].strip()
+            sender_number = metadata_list[2]
+            message_date = metadata_list[4].replace('"', '')
+            date_tokens = message_date.split('/')
+            message_time = metadata_list[5].split('-')[0]
+            time_tokens = message_time.split(':')
+
+            self.message_id = message_id
+            self.sent_time = datetime.datetime.combine(
+                datetime.datetime(
+                    int("20" + date_tokens[0]), int(date_tokens[1]), int(date_tokens[2])),
+                datetime.time(
+                    int(time_tokens[0]), int(time_tokens[1]), int(time_tokens[2])))
+            self.sender_number = sender_number
+            self.message_status = message_status
+            self.message_text = message_text
+            self.error_state = False
+        except:
+            self.error_state = True
+
+
+class PduSmsMessage(SmsMessage):
+    """
+    A text message read in PDU mode.
+    The sender and text can hold any character, the
+    text can span lines, and the sent time carries its own
+    time zone so no configured offset is needed.
+    """
+
+    def minutes_waiting(self):
+        """
+        How many minutes between being sent
+        and received.
+        """
+
+        return int((self.received_time_utc - self.sent_time_utc).total_seconds() // 60)
+
+    def message_sent_time_utc(self):
+        """
+        When was the message sent in UTC time?
+        """
+
+        return self.sent_time_utc
+
+    def is_concatenated(self):
+        """
+        Is this one part of a longer message?
+        """
+
+        return self.pdu.is_concatenated()
+
+    def get_concatenation_info(self):
+        """
+        Returns the reference, part count, and sequence
+        number if this is one part of a longer message.
+        """
+
+        if not self.is_message_ok() or not self.is_concatenated():
+            return None
+
+        return (self.pdu.concatenation_reference,
+                self.pdu.concatenation_total,
+                self.pdu.concatenation_sequence)
+
+    def __init__(self,
+                 message_header,
+                 pdu_hex,
+                 message_id=None):
+        """
+        Create the object.
+        The header is either a +CMGL line, or a +CMGR line
+        together with the index it was read from.
+        """
+        self.received_time = datetime.datetime.now()
+        self.received_time_utc = datetime.datetime.utcnow()
+        self.pdu = SmsDeliverPdu(pdu_hex)
+
+        metadata_list = message_header.partition(":")[2].split(",")
+        if message_id is None:
+            message_id = metadata_list.pop(0).strip()
+
+        status_names = dict((number, name) for name, number in PDU_MESSAGE_STATUS.items())
+
+        self.message_id = str(message_id)
+        self.message_status = status_names.get(metadata_list[0].strip())
+        self.sender_number = self.pdu.sender_number
+        self.message_text = self.pdu.text.encode('utf-8')
+        self.sent_time = self.pdu.sent_time
+        self.sent_time_utc = self.pdu.sent_time_utc
+        self.error_state = not self.pdu.is_valid()
+
+
+class MessageCheckRequested(object):
+    """
+    Event asking for the SIM to be checked for messages.
+    The index is set when the modem said where the message is.
+    """
+
+    __slots__ = ("reason", "message_index")
+
+    def __init__(self, reason, message_index=None):
+        self.reason = reason
+        self.message_index = message_index
+
+
+class Fona(object):
+    """
+    Class that send messages with an Adafruit Fona
+    SERIAL_PORT, BAUDRATE, timeout=.1, rtscts=0
+    Attributes:
+    unauthorize numbers
+    """
+
+    def is_power_on(self):
+        """
+        Returns TRUE if the power is on.
+        """
+
+        if local_debug.is_debug():
+            return True
+
+        if self.__use_gpio_pins__():
+            pin_value = GPIO.input(self.power_status_pin)
+            self.__logger__.log_info_message(
+                "Power... PIN=" + str(self.power_status_pin) + ", VAL=" + str(pin_value))
+            return self.__check_power_status__()
+
+        # If we are not using the power pins
+        # then use the existance of the serial
+        # modem connection
+        return self.serial_connection is not None
+
+    def is_connection_lost(self):
+        """
+        Returns True if the serial connection failed
+        and has not been reopened yet.
+        """
+
+        return self.__serial_supervisor__ is not None \
+            and self.serial_connection is None
+
+    def check_connection(self):
+        """
+        Reopens a lost serial connection once its backoff has
+        passed, then sets the modem up again.
+        Returns True if the connection was reopened.
+        """
+
+        if not self.is_connection_lost():
+            return False
+
+        serial_connection = self.__serial_supervisor__.reconnect_if_due()
+
+        if serial_connection is None:
+            return False
+
+        self.__modem_access_lock__.acquire(True)
+        try:
+            self.__modem_reader__.stop(DEFAULT_COMMAND_TIMEOUT)
+            self.__modem_reader__.attach(serial_connection)
+            self.serial_connection = serial_connection
+            self.__modem_reader__.start()
+
+            self.__invalidate_modem_settings__("reconnect")
+            self.__modem_status__ = {}
+            self.__start_link__()
+            self.__ensure_modem_configuration__()
+        finally:
+            self.__modem_access_lock__.release()
+
+        # Messages may have arrived while the port was down.
+        self.__request_message_check__(MESSAGE_CHECK_RECONNECT)
+
+        return True
+
+    def get_connection_statistics(self):
+        """
+        Returns the reconnect counters, or None
+        if the connection is not supervised.
+        """
+
+        if self.__serial_supervisor__ is None:
+            return None
+
+        return self.__serial_supervisor__.get_statistics()
+
+    def is_message_waiting(self):
+        """
+        Returns True if the modem reported a new message (+CMTI),
+        the RI pin pulsed, the fallback poll came due, or
+        a partial multipart message has waited too long.
+        """
+
+        return self.__message_checks__.has_pending() \
+            or self.__reassembler__.has_expired_parts()
+
+    def refresh_modem_status(self, forced_commands=None, wait_for_modem=True):
+        """
+        Reads every cached status value that is past its time to live,
+        plus any that are forced, with a single chained command
+        such as AT+CSQ;+CBC.
+        If wait_for_modem is False and the modem is busy,
+        nothing is read and the cached values stand.
+        Returns the number of values that were read.
+        """
+
+        if forced_commands is None:
+            forced_commands = []
+
+        current_time = time.time()
+        status_commands = []
+
+        for status_command, time_to_live in MODEM_STATUS_TIME_TO_LIVE:
+            if status_command in forced_commands \
+                    or self.get_modem_status_age(status_command, current_time) >= time_to_live:
+                status_commands.append(status_command)
+
+        if len(status_commands) < 1:
+            return 0
+
+        if not self.__modem_access_lock__.acquire(wait_for_modem):
+            return 0
+
+        try:
+            command_result = self.__send_command__("AT" + ";".join(status_commands),
+                                                   timeout=MODEM_STATUS_TIMEOUT)
+        finally:
+            self.__modem_access_lock__.release()
+
+        values_read = 0
+        read_time = time.time()
+
+        for status_command in status_commands:
+            response = command_result.get_response(
+                get_status_response_prefix(status_command))
+
+            if response is None:
+                # Keep the last good answer, but do not ask
+                # again until its time to live has passed.
+                response = self.get_modem_status(status_command)
+            else:
+                values_read += 1
+
+            self.__modem_status__[status_command] = [response, read_time]
+
+        return values_read
+
+    def get_next_update_time(self):
+        """
+        Returns the earliest time something in the Fona needs
+        looking at without being signalled: a cached status
+        going stale, a reconnect attempt, or an incomplete
+        multipart message expiring.
+        """
+
+        update_times = [self.__reassembler__.get_next_expiry_time()]
+
+        if self.__serial_supervisor__ is not None:
+            update_times.append(self.__serial_supervisor__.get_next_attempt_time())
+
+        if not self.is_connection_lost():
+            for status_command, time_to_live in MODEM_STATUS_TIME_TO_LIVE:
+                if status_command in self.__modem_status__:
+                    update_times.append(self.__modem_status__[status_command][1] + time_to_live)
+
+        update_times = [update_time for update_time in update_times if update_time is not None]
+
+        if len(update_times) < 1:
+            return None
+
+        return min(update_times)
+
+    def get_modem_status(self, status_command):
+        """
+        Returns the cached answer to a status query,
+        or None if it has never been read.
+        """
+
+        if status_command not in self.__modem_status__:
+            return None
+
+        return self.__modem_status__[status_command][0]
+
+    def get_modem_status_age(self, status_command, current_time=None):
+        """
+        Returns how many seconds ago a status query was read.
+        """
+
+        if status_command not in self.__modem_status__:
+            return float('inf')
+
+        if current_time is None:
+            current_time = time.time()
+
+        return current_time - self.__modem_status__[status_command][1]
+
+    def __get_cached_status__(self, status_command):
+        """
+        Returns the cached answer to a status query,
+        refreshing stale values first if the modem is free.
+        """
+
+        self.refresh_modem_status(wait_for_modem=False)
+
+        return self.get_modem_status(status_command)
+
+    def is_network_registered(self, force_refresh=False):
+        """
+        Returns True if the modem is registered on the network.
+        """
+
+        if force_refresh:
+            self.refresh_modem_status([MODEM_STATUS_REGISTRATION])
+
+        return is_registration_response(
+            self.__get_cached_status__(MODEM_STATUS_REGISTRATION))
+
+    def get_last_send_error(self):
+        """
+        Returns the +CMS ERROR code from the last failed send,
+        or None if it did not give one.
+        """
+        return self.__last_send_error__
+
+    def get_carrier(self):
+        """
+        Returns the carrier.
+        """
+        return self.__get_cached_status__(MODEM_STATUS_CARRIER)
+
+    def get_signal_strength(self):
+        """
+        Returns an object representing the signal strength.
+        """
+        return SignalStrength(self.__get_cached_status__(MODEM_STATUS_SIGNAL))
+
+    def get_current_battery_condition(self):
+        """
+        Returns an object representing the current battery state.
+        """
+        return BatteryCondition(self.__get_cached_status__(MODEM_STATUS_BATTERY))
+
+    def get_module_name(self):
+        """
+        Returns the name of the GSM module.
+        """
+        return self.__get_first_response__(self.__send_command__("ATI"))
+
+    def get_sim_card_number(self):
+        """
+        Returns the id of the sim card.
+        """
+        return self.__get_first_response__(self.__send_command__("AT+CCID"))
+
+    def send_message(self, message_num, text):
+        """
+        Sends a message to the specified phone number.
+        In PDU mode long messages go out as concatenated segments.
+        Returns the message reference of the last segment,
+        or None if the send failed.
+        """
+
+        return self.send_broadcast([message_num], text)[0][0]
+
+    def send_broadcast(self, phone_numbers, text):
+        """
+        Sends the same message to each number.
+        The modem is configured once and held for the whole
+        batch, so the AT+CMGS submissions go out back to
+        back with nothing else in between.
+        Returns a [message reference, error code] pair for
+        each number. The reference is None if that send failed.
+        """
+
+        send_results = []
+
+        self.__modem_access_lock__.acquire(True)
+        try:
+            self.__ensure_modem_configuration__()
+
+            for phone_number in phone_numbers:
+                message_reference = self.__send_to_number__(phone_number, text)
+                send_results.append([message_reference, self.__last_send_error__])
+        finally:
+            self.__modem_access_lock__.release()
+
+        return send_results
+
+    def get_round_trips_avoided(self):
+        """
+        Returns how many setting commands were skipped
+        because the modem already had them.
+        """
+        return self.__round_trips_avoided__
+
+    def get_baud_rate(self):
+        """
+        Returns the rate the serial port is running at,
+        or None if there is no connection.
+        """
+
+        if self.serial_connection is None:
+            return None
+
+        return int(self.serial_connection.baudrate)
+
+    def negotiate_baud_rate(self, target_baud_rate):
+        """
+        Moves the modem up to a faster rate with AT+IPR,
+        checks the link with a few AT round trips,
+        and saves the rate with AT&W.
+        Goes back to the starting rate if the check fails.
+        Returns the rate in use.
+        """
+
+        starting_baud_rate = self.get_baud_rate()
+
+        if starting_baud_rate is None or target_baud_rate is None \
+                or target_baud_rate <= starting_baud_rate:
+            return starting_baud_rate
+
+        self.__modem_access_lock__.acquire(True)
+        try:
+            if self.__change_baud_rate__(target_baud_rate) \
+                    and self.__is_link_verified__():
+                self.__send_command__("AT&W")
+                self.__fallback_baud_rate__ = starting_baud_rate
+                self.__logger__.log_info_message(
+                    "Modem moved from " + str(starting_baud_rate)
+                    + " to " + str(target_baud_rate) + " baud.")
+            else:
+                self.__logger__.log_warning_message(
+                    "Modem failed the check at " + str(target_baud_rate)
+                    + " baud, going back to " + str(starting_baud_rate))
+                self.__restore_baud_rate__(starting_baud_rate)
+        finally:
+            self.__modem_access_lock__.release()
+
+        return self.get_baud_rate()
+
+    def get_serial_statistics(self):
+        """
+        Returns the serial rate and throughput counters.
+        Effective throughput is the bytes moved by commands
+        divided by the time the commands took.
+        """
+
+        serial_buffer = self.__modem_reader__.get_serial_buffer()
+        effective_bytes_per_second = 0.0
+
+        if self.__command_seconds__ > 0:
+            effective_bytes_per_second = self.__command_bytes__ / self.__command_seconds__
+
+        return {"baud_rate": self.get_baud_rate(),
+                "bytes_written": self.__bytes_written__,
+                "bytes_read": serial_buffer.get_total_bytes_read(),
+                "read_bytes_per_second": serial_buffer.get_bytes_per_second(),
+                "effective_bytes_per_second": effective_bytes_per_second}
+
+    def get_send_timings(self):
+        """
+        Returns the latency histograms for each stage of
+        sending a message, keyed by stage name.
+        """
+        return self.__send_timings__
+
+    def get_messages(self):
+        """
+        Reads the new text messages on the SIM card and returns
+        a list of messages with three fields: id, num, message.
+
+        Messages the modem announced with +CMTI are read
+        by index. The SIM is only listed when a poll or the
+        RI pin fired and the SIM holds messages we have not seen.
+        Messages stay "seen" until they are deleted.
+
+        The parts of a multipart message are held back until
+        every part has arrived, then returned as one message.
+        Parts that never complete are deleted from the SIM
+        once the reassembly timeout passes, and never returned.
+        """
+
+        if self.serial_connection is None:
+            self.__clear_messages_waiting_queue__()
+            return []
+
+        indicated_indexes = []
+        should_scan = False
+
+        events = self.__clear_messages_waiting_queue__()
+
+        for event in events:
+            if event.message_index is not None:
+                indicated_indexes.append(event.message_index)
+            else:
+                should_scan = True
+
+        # Checks may have been turned away, so read everything.
+        if len(events) >= MESSAGE_CHECK_QUEUE_SIZE:
+            should_scan = True
+
+        # put into SMS mode
+        self.__ensure_modem_configuration__()
+
+        messages = []
+
+        for message_index in indicated_indexes:
+            if message_index not in self.__seen_message_indexes__:
+                messages += self.__read_message__(message_index)
+
+        if should_scan and self.__has_unseen_messages__():
+            messages += self.__list_messages__("REC UNREAD")
+
+            if self.__has_unseen_messages__():
+                messages += self.__list_messages__("ALL")
+
+        complete_messages = []
+
+        for message in messages:
+            complete_messages += self.__reassembler__.add_message(message)
+
+        # A fragment could read as a different command,
+        # so it is thrown away instead of being processed.
+        for expired_message in self.__reassembler__.get_expired_messages():
+            self.__logger__.log_warning_message("Gave up waiting on "
+                                                + str(expired_message.total_parts
+                                                      - expired_message.get_part_count())
+                                                + " parts of a message from "
+                                                + str(expired_message.get_sender_number())
+                                                + ", deleting the parts that arrived.")
+            self.delete_message(expired_message)
+
+        return complete_messages
+
+    def delete_message(self, message_to_delete):
+        """
+        Deletes a message with the given Id.
+        Every part of a multipart message is
+        deleted with one chained command.
+        """
+
+        message_ids = [str(message_id) for message_id
+                       in message_to_delete.get_message_ids()]
+
+        self.__send_command__("AT" + ";".join(["+CMGD=" + message_id
+                                               for message_id in message_ids]),
+                              timeout=MESSAGE_READ_TIMEOUT)
+
+        for message_id in message_ids:
+            self.__seen_message_indexes__.discard(message_id)
+
+    def delete_messages(self):
+        """
+        Deletes every message on the SIM.
+
+        Uses the delete-all forms (AT+CMGD=1,4 then AT+CMGDA)
+        and only deletes one index at a time if the
+        modem refuses both.
+        Returns the number of messages removed.
+        """
+        start_time = time.time()
+        self.__ensure_modem_configuration__()
+
+        stored_before = self.__get_stored_message_count__()
+        messages_deleted = 0
+
+        if stored_before is None or stored_before > 0:
+            if self.__purge_messages__():
+                stored_after = self.__get_stored_message_count__()
+
+                if stored_before is not None and stored_after is not None:
+                    messages_deleted = stored_before - stored_after
+                elif stored_before is not None:
+                    messages_deleted = stored_before
+            else:
+                for message_to_delete in self.__list_messages__("ALL", True):
+                    messages_deleted += 1
+                    self.delete_message(message_to_delete)
+
+        self.__seen_message_indexes__.clear()
+        self.__reassembler__.clear()
+        self.__last_purge_seconds__ = time.time() - start_time
+        self.__logger__.log_info_message("Purged " + str(messages_deleted)
+                                         + " messages in "
+                                         + str(round(self.__last_purge_seconds__, 2))
+                                         + " seconds")
+
+        if local_debug.is_debug():
+            self.__clear_messages_waiting_queue__()
+
+        return messages_deleted
+
+    def get_last_purge_seconds(self):
+        """
+        Returns how long the last call to delete_messages took.
+        """
+        return self.__last_purge_seconds__
+
+    def get_serial_reader(self):
+        """
+        Returns the buffered reader so its throughput
+        and latency counters can be reported.
+        """
+        return self.__modem_reader__.get_serial_buffer()
+
+    def subscribe_unsolicited(self, urc_prefix, callback):
+        """
+        Calls the callback with the line every time the modem
+        sends an unsolicited result code with the given prefix.
+        """
+        self.__modem_reader__.subscribe(urc_prefix, callback)
+
+    def simple_terminal(self):
+        """
+        Simple interactive terminal to play with the Fona.
+        """
+
+        should_quit = False
+        ret = []
+        start_time = time.time()
+
+        while not should_quit:
+            try:
+                command = str(input("READY:"))
+                if command == "quit":
+                    should_quit = True
+                else:
+                    ret.append(
+                        "time.sleep(" + str(time.time() - start_time) + ")")
+                    write_result = self.__write_to_fona__(command)
+                    start_time = time.time()
+                    self.__logger__.log_info_message(write_result)
+
+                    self.__logger__.log_info_message(self.__read_from_fona__(
+                        DEFAULT_RESPONSE_READ_TIMEOUT))
+            except:
+                self.__logger__.log_warning_message("ERROR")
 
     def __init__(self,
                  logger,
                  serial_connection,
                  power_status_pin,
-                 ring_indicator_pin):
+                 ring_indicator_pin,
+                 use_pdu_mode=DEFAULT_USE_PDU_MODE,
+                 serial_supervisor=None,
+                 target_baud_rate=None,
+                 wakeup=None,
+                 event_bus=None):
+        """
+        Create the Fona. If a serial supervisor is given,
+        a lost connection is reopened through it.
+        If a target baud rate is given, the modem is
+        moved up to it once it answers.
+        Message checks go through the event bus, which
+        signals the wakeup when there may be messages.
+        """
+
+        self.__logger__ = logger
+        self.__event_bus__ = event_bus
+
+        if self.__event_bus__ is None:
+            self.__event_bus__ = EventBus(wakeup)
+
+        self.__message_checks__ = self.__event_bus__.subscribe(MessageCheckRequested,
+                                                               maximum_pending=MESSAGE_CHECK_QUEUE_SIZE)
+        self.__serial_supervisor__ = serial_supervisor
+        self.__target_baud_rate__ = target_baud_rate
+        self.__fallback_baud_rate__ = None
+        self.__timeouts_in_row__ = 0
+        self.__bytes_written__ = 0
+        self.__command_bytes__ = 0
+        self.__command_seconds__ = 0.0
+        self.__use_pdu_mode__ = use_pdu_mode
+        self.__concatenation_reference__ = 0
+        self.__last_send_error__ = None
+        self.__modem_status__ = {}
+        self.__modem_access_lock__ = threading.RLock()
+        self.serial_connection = serial_connection
+        self.power_status_pin = power_status_pin
+        self.ring_indicator_pin = ring_indicator_pin
+        self.__seen_message_indexes__ = set()
+        self.__reassembler__ = MultipartReassembler()
+        self.__last_purge_seconds__ = None
+        self.__send_timings__ = {SEND_STAGE_PROMPT: LatencyHistogram(),
+                                 SEND_STAGE_SUBMIT: LatencyHistogram(),
+                                 SEND_STAGE_NETWORK_ACK: LatencyHistogram(),
+                                 SEND_STAGE_TOTAL: LatencyHistogram()}
+
+        if self.serial_connection is not None:
+            self.serial_connection.flushInput()
+            self.serial_connection.flushOutput()
+
+        # Echo off so message text can not be mistaken for a result code.
+        # Verbose errors off, required for AT+CMGS to work.
+        # New message indexes come as +CMTI and delivery reports as +CDS.
+        self.__desired_modem_settings__ = [["E", "0"],
+                                           ["+CMEE", "0"],
+                                           ["+CMGF", self.__get_sms_mode__()],
+                                           ["+CSCS", '"GSM"'],
+                                           ["+CNMI", "2,1,0,1,0"]]
+
+        # Text mode sets the status report request
+        # with AT+CSMP. PDU mode sets it in each PDU.
+        if not self.__use_pdu_mode__:
+            self.__desired_modem_settings__.append(["+CSMP", TEXT_MODE_SUBMIT_PARAMETERS])
+
+        # Set the RI pin to pulse low when
+        # a text message is received
+        if self.__use_gpio_pins__():
+            self.__desired_modem_settings__.append(["+CFGRI", "1"])
+
+        self.__modem_settings__ = {}
+        self.__rejected_modem_settings__ = {}
+        self.__round_trips_avoided__ = 0
+        self.__last_power_state__ = None
+
+        self.__modem_reader__ = ModemReader(serial_connection, logger,
+                                            error_callback=self.__connection_failed__)
+        self.__modem_reader__.subscribe("+CMTI:", self.__message_indicated__)
+        self.__modem_reader__.subscribe("UNDER-VOLTAGE", self.__log_power_warning__)
+        self.__modem_reader__.subscribe("OVER-VOLTAGE", self.__log_power_warning__)
+        for reset_urc in MODEM_RESET_URCS:
+            self.__modem_reader__.subscribe(reset_urc, self.__modem_was_reset__)
+        self.__modem_reader__.start()
+        lifecycle.get_default_manager().register("modem_reader", self.__modem_reader__.stop)
+
+        self.__start_link__()
+        self.__ensure_modem_configuration__()
+
+        self.__read_from_fona__(10)
+
+        self.__initialize_gpio_pins__()
+        self.__poll_task__ = RecurringTask("poll_for_messages",
+                                           MESSAGE_POLL_FALLBACK_INTERVAL,
+                                           self.__poll_for_messages__,
+                                           logger)
+
+    def __use_gpio_pins__(self):
+        """
+        Returns true if we should use the GPIO pins
+        to tell status.
+        """
+
+        return self.power_status_pin is not None \
+            and self.ring_indicator_pin is not None
+
+    def __initialize_gpio_pins__(self):
+        """
+        Gets the Fona ready to be interacted with by the GPIO board.
+        """
+
+        if not self.__use_gpio_pins__():
+            self.__logger__.log_info_message("Skipping GPIO init.")
+            return False
+
+        self.__logger__.log_info_message("Setting GPIO input modes")
+
+        if not local_debug.is_debug():
+            GPIO.setwarnings(False)
+            GPIO.setmode(GPIO.BOARD)
+            GPIO.setup(self.ring_indicator_pin, GPIO.IN)
+            GPIO.setup(self.power_status_pin, GPIO.IN)
+            GPIO.add_event_detect(self.ring_indicator_pin,
+                                  GPIO.RISING, self.__ring_indicator_pulsed__)
+
+        return True
+
+    def __poll_for_messages__(self):
+        """
+        Check for messages every so often in case
+        a +CMTI was missed.
+        """
+        self.__request_message_check__(MESSAGE_CHECK_POLL)
+
+    def __message_indicated__(self, urc_line):
+        """
+        The modem sent +CMTI: "SM",<index>.
+        That means a message.
+        """
+        self.__request_message_check__(MESSAGE_CHECK_INDICATED,
+                                       urc_line.rpartition(",")[2].strip())
+
+    def __start_link__(self):
+        """
+        Makes sure the modem answers, following it to the rate
+        it was saved at if that is not the rate the port opened at,
+        then moves it up to the target rate.
+        """
+
+        if self.serial_connection is None:
+            return
+
+        self.__fallback_baud_rate__ = None
+
+        if not self.__send_command__("AT").is_ok():
+            self.__find_modem_baud_rate__()
+
+        self.negotiate_baud_rate(self.__target_baud_rate__)
+
+    def __find_modem_baud_rate__(self):
+        """
+        Tries each rate until the modem answers AT.
+        Returns the rate, or None with the port
+        left at the rate it started at.
+        """
+
+        starting_baud_rate = self.get_baud_rate()
+
+        for baud_rate in [starting_baud_rate] + SUPPORTED_BAUD_RATES:
+            self.__set_port_baud_rate__(baud_rate)
+
+            if self.__send_command__("AT").is_ok():
+                if baud_rate != starting_baud_rate:
+                    self.__logger__.log_info_message(
+                        "Modem found at " + str(baud_rate) + " baud.")
+                return baud_rate
+
+        self.__set_port_baud_rate__(starting_baud_rate)
+
+        return None
+
+    def __restore_baud_rate__(self, baud_rate):
+        """
+        Finds the modem and moves it back to the given rate.
+        Returns True if it answers at that rate.
+        """
+
+        self.__fallback_baud_rate__ = None
+        modem_baud_rate = self.__find_modem_baud_rate__()
+
+        if modem_baud_rate is None:
+            self.__set_port_baud_rate__(baud_rate)
+            return False
+
+        if modem_baud_rate != baud_rate \
+                and not (self.__change_baud_rate__(baud_rate)
+                         and self.__is_link_verified__()):
+            return False
+
+        self.__send_command__("AT&W")
+
+        return True
+
+    def __change_baud_rate__(self, baud_rate):
+        """
+        Tells the modem to use a new rate, then follows it.
+        Returns False if the modem refused.
+        """
+
+        if not self.__send_command__("AT+IPR=" + str(baud_rate)).is_ok():
+            return False
+
+        self.__set_port_baud_rate__(baud_rate)
+        self.__invalidate_modem_settings__("baud rate change")
+
+        return True
+
+    def __set_port_baud_rate__(self, baud_rate):
+        """
+        Changes the rate of the serial port and lets it settle.
+        """
+
+        self.serial_connection.baudrate = baud_rate
+        time.sleep(BAUD_RATE_SETTLE_SECONDS)
+        self.serial_connection.flushInput()
+
+    def __is_link_verified__(self):
+        """
+        Echo test for a new rate. Every AT has to come back OK.
+        """
+
+        for echo_test in range(BAUD_RATE_ECHO_TESTS):
+            if not self.__send_command__("AT").is_ok():
+                return False
+
+        return True
+
+    def __check_link_errors__(self, command_result):
+        """
+        Goes back to the rate the port was opened at if commands
+        keep timing out after moving to a faster rate.
+        """
+
+        if command_result.is_timeout():
+            self.__timeouts_in_row__ += 1
+        else:
+            self.__timeouts_in_row__ = 0
+
+        if self.__fallback_baud_rate__ is None \
+                or self.__timeouts_in_row__ < BAUD_RATE_FALLBACK_TIMEOUTS:
+            return
+
+        fallback_baud_rate = self.__fallback_baud_rate__
+        self.__timeouts_in_row__ = 0
+        self.__logger__.log_warning_message(
+            "Commands keep timing out at " + str(self.get_baud_rate())
+            + " baud, going back to " + str(fallback_baud_rate))
+
+        self.__modem_access_lock__.acquire(True)
+        try:
+            self.__restore_baud_rate__(fallback_baud_rate)
+        finally:
+            self.__modem_access_lock__.release()
+
+    def __connection_failed__(self, reason):
+        """
+        The serial port failed to read or write.
+        Drops it so it can be reopened.
+        """
+
+        if self.__serial_supervisor__ is None:
+            self.__logger__.log_warning_message("Serial error " + reason)
+            return
+
+        if self.serial_connection is None:
+            return
+
+        self.serial_connection = None
+        self.__serial_supervisor__.report_failure(reason)
+
+    def __log_power_warning__(self, urc_line):
+        """
+        The modem is unhappy with its supply voltage.
+        """
+        self.__logger__.log_warning_message("Fona power warning:" + urc_line)
+
+    def __ring_indicator_pulsed__(self, io_pin):
+        """
+        The RI went from LOW to HIGH.
+        That means a message.
+        """
+        self.__request_message_check__(MESSAGE_CHECK_RING_INDICATOR)
+
+    def __request_message_check__(self, reason, message_index=None):
+        """
+        Asks for the SIM to be checked for messages.
+        The event bus wakes the service loop.
+        """
+
+        self.__event_bus__.publish(MessageCheckRequested(reason, message_index))
+
+    def __write_to_fona__(self, text):
+        """
+        Write text to the Fona in a safe manner.
+        """
+        self.__logger__.log_info_message("Checking connection")
+        if self.serial_connection is None:
+            return "NO CON"
+
+        self.__logger__.log_info_message("Writting to serial")
+        self.__modem_reader__.begin_command(text)
+        num_bytes_written = self.serial_connection.write(text)
+        self.serial_connection.flush()
+
+        self.__logger__.log_info_message("Checking return")
+        self.__logger__.log_info_message("Wrote " + str(num_bytes_written) +
+                                         ", expected " + str(len(text)))
+
+        self.__wait_for_command_response__()
+
+        self.__logger__.log_info_message(
+            "Done with wait_for_command_repsonse()")
+
+        return num_bytes_written
+
+    def __read_from_fona__(self, response_timeout=2):
+        """
+        Read back from the Fona in a safe manner.
+        """
+        start_time = time.time()
+
+        if self.serial_connection is None:
+            return "NOCON"
+
+        self.__logger__.log_info_message("   starting read")
+        response_lines = []
+        line = self.__modem_reader__.read_response_line(0)
+        while line is not None:
+            response_lines.append(line)
+            line = self.__modem_reader__.read_response_line(0)
+            time_elapsed = time.time() - start_time
+            if time_elapsed > response_timeout:
+                self.__logger__.log_warning_message("TIMEOUT")
+                break
+
+        read_buffer = "\n".join(response_lines)
+
+        self.__logger__.log_info_message("   done")
+        self.__logger__.log_info_message("BUFFER:" + read_buffer)
+        return read_buffer
+
+    def __send_command__(self, com, add_eol=True, timeout=None):
+        """
+        Sends a command to the modem and reads until a final
+        result code or the prompt is seen, or the deadline passes.
+        The deadline defaults to DEFAULT_COMMAND_TIMEOUT.
+        Returns a CommandResult.
+        """
+        start_time = time.time()
+
+        if timeout is None:
+            timeout = DEFAULT_COMMAND_TIMEOUT
+
+        if self.serial_connection is None:
+            return CommandResult(com, [], RESULT_NO_CONNECTION, 0)
+
+        self.__modem_access_lock__.acquire(True)
+
+        try:
+            command = com
+            if add_eol:
+                command += '\r'
+
+            self.__modem_reader__.begin_command(com)
+            self.serial_connection.write(command)
+            self.__bytes_written__ += len(command)
+
+            command_result = self.__read_command_response__(com,
+                                                            start_time + timeout)
+            self.__record_command_throughput__(command, command_result)
+        except (IOError, OSError):
+            self.__connection_failed__("sending " + com + ":" + str(sys.exc_info()[1]))
+            command_result = CommandResult(com, [], RESULT_NO_CONNECTION,
+                                           time.time() - start_time)
+        except:
+            self.__logger__.log_warning_message(
+                "Exception sending " + com + ":" + str(sys.exc_info()[0]))
+            command_result = CommandResult(com, [], RESULT_ERROR,
+                                           time.time() - start_time)
+        finally:
+            self.__modem_reader__.end_command()
+            self.__modem_access_lock__.release()
+
+        if command_result.is_timeout():
+            self.__logger__.log_warning_message(
+                "TIMEOUT waiting for " + com)
+
+        self.__check_link_errors__(command_result)
+
+        return command_result
+
+    def __record_command_throughput__(self, command, command_result):
+        """
+        Adds a finished command to the effective throughput.
+        """
+
+        if command_result.is_timeout():
+            return
+
+        response_bytes = sum([len(line) + 2 for line in command_result.response_lines])
+        self.__command_bytes__ += len(command) + response_bytes \
+            + len(command_result.result_code) + 2
+        self.__command_seconds__ += command_result.elapsed_seconds
+
+    def __read_command_response__(self, command, deadline):
+        """
+        Reads the response to a command that has already been written.
+        The echo of the command is dropped.
+        Returns as soon as a final result code arrives.
+        """
+
+        start_time = time.time()
+        response_lines = []
+        echo = command.strip()
+
+        line = self.__modem_reader__.read_response_line(deadline - time.time())
+
+        while line is not None:
+            if line != echo:
+                self.__logger__.log_info_message(line)
+                result_code = get_final_result_code(line)
+
+                if result_code is not None:
+                    return CommandResult(command, response_lines, result_code,
+                                         time.time() - start_time)
+
+                response_lines.append(line)
+
+            line = self.__modem_reader__.read_response_line(deadline - time.time())
+
+        return CommandResult(command, response_lines, RESULT_TIMEOUT,
+                             time.time() - start_time)
+
+    def __submit_message__(self, cmgs_argument, payload, cleaned_number):
+        """
+        Runs one AT+CMGS exchange. Waits for the '>' prompt,
+        writes the payload, then waits for +CMGS: <mr> from the network.
+        Returns the message reference, or None if the send failed.
+        """
+
+        start_time = time.time()
+        self.__modem_access_lock__.acquire(True)
+        try:
+            prompt_result = self.__send_command__('AT+CMGS=' + cmgs_argument,
+                                                  timeout=SMS_PROMPT_TIMEOUT)
+            prompt_time = time.time()
+            self.__send_timings__[SEND_STAGE_PROMPT].record(prompt_time - start_time)
+
+            if not prompt_result.is_prompt():
+                self.__logger__.log_warning_message(
+                    "No prompt for message to " + cleaned_number
+                    + ", got " + prompt_result.result_code)
+                self.__last_send_error__ = prompt_result.get_error_code()
+                self.__cancel_message_input__()
+                return None
+
+            submit_result = self.__submit_message_text__(payload)
+        finally:
+            self.__modem_access_lock__.release()
+
+        self.__send_timings__[SEND_STAGE_TOTAL].record(time.time() - start_time)
+
+        message_reference = get_message_reference(submit_result.get_response("+CMGS:"))
+
+        if not submit_result.is_ok() or message_reference is None:
+            self.__logger__.log_warning_message(
+                "Message to " + cleaned_number + " failed with "
+                + submit_result.result_code)
+            self.__last_send_error__ = submit_result.get_error_code()
+            return None
+
+        self.__logger__.log_info_message(
+            "Sent message " + str(message_reference) + " to " + cleaned_number
+            + " in " + str(round(time.time() - start_time, 2)) + " seconds")
+
+        return message_reference
+
+    def __send_to_number__(self, message_num, text):
+        """
+        Sends a message to one number.
+        The modem lock must already be held.
+        Returns the message reference of the last segment,
+        or None if the send failed.
+        """
 
-        self.__logger__ = logger
-        self.__modem_access_lock__ = threading.Lock()
-        self.serial_connection = serial_connection
-        self.power_status_pin = power_status_pin
-        self.ring_indicator_pin = ring_indicator_pin
+        cleaned_number = utilities.get_cleaned_phone_number(message_num)
+        self.__last_send_error__ = None
+
+        if cleaned_number is None or text is None:
+            return None
+
+        if not self.__use_pdu_mode__:
+            return self.__submit_message__('"' + cleaned_number + '"', text, cleaned_number)
+
+        message_reference = None
+
+        for pdu, tpdu_length in encode_submit_pdus(cleaned_number,
+                                                   text,
+                                                   self.__get_concatenation_reference__(),
+                                                   STATUS_REPORT_REQUEST_FLAG):
+            message_reference = self.__submit_message__(str(tpdu_length),
+                                                        pdu,
+                                                        cleaned_number)
+
+            if message_reference is None:
+                return None
+
+        return message_reference
+
+    def __get_concatenation_reference__(self):
+        """
+        Returns the reference number for the next
+        outgoing concatenated message.
+        """
+
+        self.__concatenation_reference__ = (self.__concatenation_reference__ + 1) % 256
+
+        return self.__concatenation_reference__
+
+    def __submit_message_text__(self, text):
+        """
+        Writes the message text after the prompt and
+        waits for the network to accept it.
+        The modem lock must already be held.
+        """
+
+        submit_start_time = time.time()
+
+        try:
+            self.__modem_reader__.begin_command(text)
+            self.serial_connection.write(text + '\x1a')
+            self.serial_connection.flush()
+            self.__bytes_written__ += len(text) + 1
+
+            ack_start_time = time.time()
+            self.__send_timings__[SEND_STAGE_SUBMIT].record(
+                ack_start_time - submit_start_time)
+
+            submit_result = self.__read_command_response__(
+                text, ack_start_time + SMS_SUBMIT_TIMEOUT)
+            self.__send_timings__[SEND_STAGE_NETWORK_ACK].record(
+                time.time() - ack_start_time)
+        except (IOError, OSError):
+            self.__connection_failed__("submitting message:" + str(sys.exc_info()[1]))
+            submit_result = CommandResult(text, [], RESULT_NO_CONNECTION,
+                                          time.time() - submit_start_time)
+        except:
+            self.__logger__.log_warning_message(
+                "Exception submitting message:" + str(sys.exc_info()[0]))
+            submit_result = CommandResult(text, [], RESULT_ERROR,
+                                          time.time() - submit_start_time)
+        finally:
+            self.__modem_reader__.end_command()
+
+        return submit_result
+
+    def __cancel_message_input__(self):
+        """
+        Sends ESC so the modem drops a half started message.
+        """
 
         if self.serial_connection is not None:
-            self.serial_connection.flushInput()
-            self.serial_connection.flushOutput()
+            self.serial_connection.write('\x1b')
+            self.serial_connection.flush()
+
+    def __read_message__(self, message_index):
+        """
+        Reads a single message by its SIM index.
+        Returns a list with the message, or an empty list.
+        """
 
-        self.__send_command__("AT")
-        # self.send_command("AE0")
-        self.__disable_verbose_errors__()
-        self.__set_sms_mode__()
+        command_result = self.__send_command__("AT+CMGR=" + str(message_index),
+                                               timeout=MESSAGE_READ_TIMEOUT)
+        response_lines = command_result.response_lines
 
-        self.__read_from_fona__(10)
+        if len(response_lines) < 1 or not response_lines[0].startswith("+CMGR:"):
+            return []
 
-        self.__message_waiting_queue__ = MPQueue()
-        self.__initialize_gpio_pins__()
-        self.__poll_for_messages__()
+        self.__seen_message_indexes__.add(str(message_index))
 
-    def __use_gpio_pins__(self):
+        return [self.__create_message__(response_lines[0],
+                                        response_lines[1:],
+                                        message_index)]
+
+    def __list_messages__(self, message_status, include_seen=False):
         """
-        Returns true if we should use the GPIO pins
-        to tell status.
+        Lists the messages on the SIM with the given status.
+        Messages already handed out are skipped unless asked for.
         """
 
-        return self.power_status_pin is not None \
-            and self.ring_indicator_pin is not None
+        if self.__use_pdu_mode__:
+            list_command = 'AT+CMGL=' + PDU_MESSAGE_STATUS[message_status]
+        else:
+            list_command = 'AT+CMGL="' + message_status + '"'
 
-    def __initialize_gpio_pins__(self):
+        command_result = self.__send_command__(list_command,
+                                               timeout=MESSAGE_LIST_TIMEOUT)
+        messages = []
+        message_header = None
+        message_lines = []
+
+        for response_line in command_result.response_lines + ["+CMGL:"]:
+            if not response_line.startswith("+CMGL:"):
+                message_lines.append(response_line)
+                continue
+
+            if message_header is not None:
+                new_message = self.__create_message__(message_header,
+                                                      message_lines)
+
+                if include_seen \
+                        or new_message.message_id not in self.__seen_message_indexes__:
+                    self.__seen_message_indexes__.add(new_message.message_id)
+                    messages.append(new_message)
+
+            message_header = response_line
+            message_lines = []
+
+        return messages
+
+    def __create_message__(self, message_header, message_lines, message_id=None):
         """
-        Gets the Fona ready to be interacted with by the GPIO board.
+        Builds a message from its header and the lines after it.
         """
 
-        if not self.__use_gpio_pins__():
-            self.__logger__.log_info_message("Skipping GPIO init.")
-            return False
+        if self.__use_pdu_mode__:
+            pdu_hex = message_lines[0] if len(message_lines) > 0 else ""
+            return PduSmsMessage(message_header, pdu_hex, message_id)
 
-        self.__logger__.log_info_message("Setting GPIO input modes")
+        return SmsMessage(message_header, "\n".join(message_lines), message_id)
 
-        # Set the RI pin to pulse low when
-        # a text message is received
-        self.__send_command__("AT+CFGRI=1")
+    def __get_stored_message_count__(self):
+        """
+        Returns how many messages are stored on the SIM
+        according to AT+CPMS?
+        Returns None if it could not be read.
+        """
 
-        if not local_debug.is_debug():
-            GPIO.setwarnings(False)
-            GPIO.setmode(GPIO.BOARD)
-            GPIO.setup(self.ring_indicator_pin, GPIO.IN)
-            GPIO.setup(self.power_status_pin, GPIO.IN)
-            GPIO.add_event_detect(self.ring_indicator_pin,
-                                  GPIO.RISING, self.__ring_indicator_pulsed__)
+        cpms_response = self.__send_command__("AT+CPMS?").get_response("+CPMS:")
 
-        return True
+        try:
+            return int(cpms_response.split(",")[1])
+        except:
+            return None
 
-    def __poll_for_messages__(self):
+    def __purge_messages__(self):
         """
-        Check for messages every 60 seconds.
+        Tries the delete-all commands.
+        Returns True if the modem accepted one of them.
         """
-        self.__message_waiting_queue__.put("POLL")
-        threading.Timer(60, self.__poll_for_messages__).start()
 
-    def __ring_indicator_pulsed__(self, io_pin):
+        delete_all_command = 'AT+CMGDA="DEL ALL"'
+        if self.__use_pdu_mode__:
+            delete_all_command = 'AT+CMGDA=6'
+
+        for purge_command in ["AT+CMGD=1,4", delete_all_command]:
+            if self.__send_command__(purge_command, timeout=MESSAGE_PURGE_TIMEOUT).is_ok():
+                return True
+
+        return False
+
+    def __has_unseen_messages__(self):
         """
-        The RI went from LOW to HIGH.
-        That means a message.
+        Returns True if the SIM holds more messages than
+        we have handed out, or if the count is unknown.
         """
-        self.__message_waiting_queue__.put("RI:" + str(io_pin))
 
-    def __write_to_fona__(self, text):
+        stored_message_count = self.__get_stored_message_count__()
+
+        return stored_message_count is None \
+            or stored_message_count > len(self.__seen_message_indexes__)
+
+    def __get_first_response__(self, command_result):
         """
-        Write text to the Fona in a safe manner.
+        Returns the first line of a command response, or None.
         """
-        self.__logger__.log_info_message("Checking connection")
-        if self.serial_connection is None:
-            return "NO CON"
 
-        self.__logger__.log_info_message("Writting to serial")
-        num_bytes_written = self.serial_connection.write(text)
-        self.serial_connection.flush()
+        if len(command_result.response_lines) < 1:
+            return None
 
-        self.__logger__.log_info_message("Checking return")
-        self.__logger__.log_info_message("Wrote " + str(num_bytes_written) +
-                                         ", expected " + str(len(text)))
+        return command_result.response_lines[0]
 
-        self.__wait_for_command_response__()
+    def __ensure_modem_configuration__(self):
+        """
+        Makes sure every setting we rely on is in place.
+        Costs nothing unless the modem was reset,
+        lost power, was reconnected, or changed baud rate.
+        """
 
-        self.__logger__.log_info_message(
-            "Done with wait_for_command_repsonse()")
+        if self.__use_gpio_pins__():
+            self.__check_power_status__()
 
-        return num_bytes_written
+        for setting, value in self.__desired_modem_settings__:
+            self.__ensure_modem_setting__(setting, value)
 
-    def __read_from_fona__(self, response_timeout=2):
+    def __ensure_modem_setting__(self, setting, value):
         """
-        Read back from the Fona in a safe manner.
+        Sends the setting to the modem unless it is
+        already known to be in place.
+        Returns True if the setting is in place.
         """
-        read_buffer = ""
-        start_time = time.time()
 
-        if self.serial_connection is None:
-            return "NOCON"
+        if self.__modem_settings__.get(setting) == value:
+            self.__round_trips_avoided__ += 1
+            return True
 
-        self.__logger__.log_info_message("   starting read")
-        while self.serial_connection.inWaiting() > 0:
-            read_buffer += self.serial_connection.read(1)
-            time_elapsed = time.time() - start_time
-            if time_elapsed > response_timeout:
-                self.__logger__.log_warning_message("TIMEOUT")
-                break
+        # The modem said no. Asking again will not change
+        # its mind until it has been reset.
+        if self.__rejected_modem_settings__.get(setting) == value:
+            self.__round_trips_avoided__ += 1
+            return False
 
-        self.__logger__.log_info_message("   done")
-        self.__logger__.log_info_message("BUFFER:" + read_buffer)
-        return read_buffer
+        separator = "=" if setting.startswith("+") else ""
+        command_result = self.__send_command__("AT" + setting + separator + value)
 
-    def __send_command__(self, com, add_eol=True):
-        """ send a command to the modem """
-        self.__modem_access_lock__.acquire(True)
+        if command_result.is_ok():
+            self.__modem_settings__[setting] = value
+            return True
 
-        try:
-            command = com
-            if add_eol:
-                command += '\r\r\n '
+        if is_modem_rejection(command_result):
+            self.__logger__.log_warning_message(
+                "Modem rejected AT" + setting + separator + value
+                + ":" + command_result.result_code)
+            self.__rejected_modem_settings__[setting] = value
+
+        return False
 
-            if self.serial_connection is not None:
-                self.serial_connection.write(command)
-                time.sleep(2)
+    def __invalidate_modem_settings__(self, reason):
+        """
+        Forgets the cached settings so they are sent again.
+        """
 
-            ret = []
+        if len(self.__modem_settings__) > 0:
+            self.__logger__.log_info_message(
+                "Re-asserting modem settings after " + reason)
 
-            # "Starting read/wait"
-            while self.serial_connection is not None and self.serial_connection.inWaiting() > 0:
-                msg = self.serial_connection.readline().strip()
-                msg = msg.replace("\r", "")
-                msg = msg.replace("\n", "")
-                if msg != "":
-                    self.__logger__.log_info_message(msg)
-                    ret.append(msg)
+        self.__modem_settings__ = {}
+        self.__rejected_modem_settings__ = {}
 
-            self.__modem_access_lock__.release()
-            return ret
-        except:
-            self.__modem_access_lock__.release()
+    def __modem_was_reset__(self, urc_line):
+        """
+        The modem sent a URC that means it restarted.
+        """
+        self.__invalidate_modem_settings__(urc_line)
 
-        return []
+    def __check_power_status__(self):
+        """
+        Reads the power status pin.
+        Forgets the cached settings if it changed.
+        """
+
+        is_power_on = GPIO.input(self.power_status_pin) == GPIO.HIGH
+
+        if self.__last_power_state__ is not None \
+                and self.__last_power_state__ != is_power_on:
+            self.__invalidate_modem_settings__("power change")
+
+        self.__last_power_state__ = is_power_on
+
+        return is_power_on
 
     def __disable_verbose_errors__(self):
         """
         Disables verbose errors.
         Required for AT+CMGS to work.
         """
-        return self.__send_command__("AT+CMEE=0")
+        return self.__ensure_modem_setting__("+CMEE", "0")
 
     def __enable_verbose_errors__(self):
         """
         Enables trouble shooting errors.
         """
-        return self.__send_command__("AT+CMEE=2")
+        return self.__ensure_modem_setting__("+CMEE", "2")
 
     def __set_sms_mode__(self):
         """
-        Puts the card into SMS mode.
+        Puts the card into SMS mode, either PDU or text.
+        """
+        return self.__ensure_modem_setting__("+CMGF", self.__get_sms_mode__())
+
+    def __get_sms_mode__(self):
+        """
+        Returns the AT+CMGF value for the mode we run in.
         """
-        return self.__send_command__("AT+CMGF=1")
+
+        if self.__use_pdu_mode__:
+            return SMS_MODE_PDU
+
+        return SMS_MODE_TEXT
 
     def __read_until_text__(self, text):
         """
@@ -587,27 +2647,418 @@ class Fona(object):
             return False
 
         start_time = time.time()
-        while time.time() - start_time < 2 and self.serial_connection.inWaiting() < 1:
-            time.sleep(0.5)
+        while time.time() - start_time < 2 \
+                and not self.__modem_reader__.has_response():
+            time.sleep(COMMAND_POLL_INTERVAL)
 
-        return self.serial_connection.inWaiting() > 0
+        return self.__modem_reader__.has_response()
 
     def __clear_messages_waiting_queue__(self):
         """
         Clears the queue that tells us if we should check for
-        messages.
+        messages. Returns the events that were cleared.
         """
 
-        events_cleared = 0
-        while not self.__message_waiting_queue__.empty():
-            self.__logger__.log_info_message("Clearing queue.")
-            event = self.__message_waiting_queue__.get()
-            events_cleared += 1
-            self.__logger__.log_info_message("Q:" + event)
+        events_cleared = self.__message_checks__.get_pending()
+
+        for event in events_cleared:
+            self.__logger__.log_info_message("Q:" + event.reason + ":"
+                                             + str(event.message_index))
 
         return events_cleared
 
 
+##############
+# UNIT TESTS #
+##############
+
+
+def test_decode_deliver_pdu():
+    """
+    Test decoding a single part GSM 7 bit message.
+    """
+    message = PduSmsMessage("+CMGL: 3,0,,24",
+                            "07912160130300F4040B912160214365F700007101612100148A06536A905A9D02")
+    assert message.is_message_ok()
+    assert message.message_id == "3"
+    assert message.message_status == "REC UNREAD"
+    assert message.get_sender_number() == "12061234567"
+    assert message.message_text == "STATUS"
+    assert message.sent_time == datetime.datetime(2017, 10, 16, 12, 0, 41)
+    assert message.message_sent_time_utc() == datetime.datetime(2017, 10, 16, 19, 0, 41)
+    assert not message.is_concatenated()
+
+
+def test_decode_concatenated_pdus():
+    """
+    Test decoding both parts of a concatenated message,
+    one UCS2 and one GSM 7 bit with a header.
+    """
+    first_part = SmsDeliverPdu(
+        "07912160130300F4440B912160214365F700087101612100148A0E0500032A0201004800690020263A")
+    second_part = SmsDeliverPdu(
+        "07912160130300F4440B912160214365F700007101612100148A150500032A0202E0EC72785E066D78EEF77DE303")
+    assert first_part.is_valid() and second_part.is_valid()
+    assert first_part.text == u"Hi \u263a"
+    assert second_part.text == u"please [now]"
+    assert first_part.concatenation_reference == second_part.concatenation_reference == 42
+    assert first_part.concatenation_total == 2
+    assert [first_part.concatenation_sequence, second_part.concatenation_sequence] == [1, 2]
+
+
+def test_reassemble_pdu_messages():
+    """
+    Test that the parts read off the SIM come back as one message.
+    """
+    reassembler = MultipartReassembler()
+    second_part = PduSmsMessage(
+        "+CMGR: 0,,30",
+        "07912160130300F4440B912160214365F700007101612100148A150500032A0202E0EC72785E066D78EEF77DE303",
+        9)
+    first_part = PduSmsMessage(
+        "+CMGR: 0,,24",
+        "07912160130300F4440B912160214365F700087101612100148A0E0500032A0201004800690020263A",
+        4)
+    assert reassembler.add_message(second_part) == []
+    messages = reassembler.add_message(first_part)
+    assert len(messages) == 1
+    assert messages[0].message_text == u"Hi \u263aplease [now]".encode('utf-8')
+    assert messages[0].get_message_ids() == ["4", "9"]
+
+
+def test_decode_bad_pdu():
+    """
+    Test that garbage does not raise.
+    """
+    message = PduSmsMessage("+CMGR: 1,,5", "07", 4)
+    assert not message.is_message_ok()
+    assert message.message_id == "4"
+
+
+def test_encode_round_trip():
+    """
+    Test that a long message splits into segments
+    that each fit in one SMS.
+    """
+    pdus = encode_submit_pdus("2061234567", "STATUS " * 40, 9)
+    assert len(pdus) == 2
+    for pdu, tpdu_length in pdus:
+        assert len(pdu) == (tpdu_length + 1) * 2
+        assert tpdu_length <= 13 + 140
+
+
+class ScriptedModem(object):
+    """
+    A serial connection for the tests.
+    Every command written is kept, and answered
+    with whatever the responder returns for it.
+    """
+
+    def write(self, data):
+        self.__written__ += data
+
+        while "\r" in self.__written__:
+            command, _, self.__written__ = self.__written__.partition("\r")
+            self.commands.append(command)
+            self.__output__ += self.__responder__(command)
+
+        return len(data)
+
+    def read(self, size=1):
+        deadline = time.time() + (self.timeout or 0)
+
+        while len(self.__output__) < 1 and time.time() < deadline:
+            time.sleep(0.001)
+
+        data = self.__output__[:size]
+        self.__output__ = self.__output__[size:]
+
+        return data
+
+    def inWaiting(self):
+        return len(self.__output__)
+
+    def flushInput(self):
+        self.__output__ = ""
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __init__(self, responder):
+        self.__responder__ = responder
+        self.__written__ = ""
+        self.__output__ = ""
+        self.commands = []
+        self.timeout = None
+        self.baudrate = 9600
+
+
+def test_rejected_setting_is_not_resent():
+    """
+    Test that a setting the modem refuses is remembered,
+    and that the refusal does not make the other settings
+    go out again.
+    """
+    import logging
+
+    def responder(command):
+        if command == "AT+CSCS=\"GSM\"":
+            return "\r\nERROR\r\n"
+
+        return "\r\nOK\r\n"
+
+    modem = ScriptedModem(responder)
+    fona = Fona(Logger(logging.getLogger("test")), modem, None, None)
+
+    try:
+        assert modem.commands.count("AT+CSCS=\"GSM\"") == 1
+        assert modem.commands.count("ATE0") == 1
+        del modem.commands[:]
+        fona.__ensure_modem_configuration__()
+        fona.__send_command__("AT+CPMS?")
+        fona.__ensure_modem_configuration__()
+        assert modem.commands == ["AT+CPMS?"]
+
+        fona.__modem_was_reset__("RDY")
+        fona.__ensure_modem_configuration__()
+        assert "AT+CSCS=\"GSM\"" in modem.commands
+        assert "ATE0" in modem.commands
+    finally:
+        fona.__poll_task__.stop()
+        fona.__modem_reader__.stop(1)
+
+
+def test_expired_parts_are_deleted():
+    """
+    Test that part one of a two part message is deleted
+    from the SIM, and never returned, once it expires.
+    """
+    import logging
+
+    def responder(command):
+        if command == "AT+CMGR=4":
+            return "\r\n+CMGR: 0,,24\r\n" \
+                + "07912160130300F4440B912160214365F700087101612100148A0E0500032A0201004800690020263A" \
+                + "\r\n\r\nOK\r\n"
+
+        return "\r\nOK\r\n"
+
+    modem = ScriptedModem(responder)
+    fona = Fona(Logger(logging.getLogger("test")), modem, None, None)
+
+    try:
+        fona.__reassembler__ = MultipartReassembler(0)
+        fona.__message_indicated__('+CMTI: "SM",4')
+        assert fona.get_messages() == []
+        time.sleep(0.01)
+        assert fona.get_messages() == []
+        assert "AT+CMGD=4" in modem.commands
+        assert fona.__reassembler__.get_pending_count() == 0
+    finally:
+        fona.__poll_task__.stop()
+        fona.__modem_reader__.stop(1)
+
+
+def test_delete_messages_fallbacks():
+    """
+    Test that a modem that refuses AT+CMGD=1,4 is purged
+    with AT+CMGDA, and one that refuses both has each
+    message deleted by index.
+    """
+    import logging
+
+    stored_indexes = ["3", "5", "8"]
+    refused_commands = ["AT+CMGD=1,4"]
+
+    def responder(command):
+        if command in refused_commands:
+            return "\r\nERROR\r\n"
+
+        if command == "AT+CPMS?":
+            return '\r\n+CPMS: "SM",' + str(len(stored_indexes)) + ',30,"SM",' \
+                + str(len(stored_indexes)) + ',30,"SM",0,30\r\n\r\nOK\r\n'
+
+        if command == "AT+CMGDA=6":
+            del stored_indexes[:]
+
+        if command == "AT+CMGL=4":
+            return "".join(["\r\n+CMGL: " + index + ",1,,24\r\n"
+                            + "07912160130300F4040B912160214365F700007101612100148A06536A905A9D02"
+                            for index in stored_indexes]) + "\r\n\r\nOK\r\n"
+
+        if command.startswith("AT+CMGD="):
+            stored_indexes.remove(command.partition("=")[2])
+
+        return "\r\nOK\r\n"
+
+    modem = ScriptedModem(responder)
+    fona = Fona(Logger(logging.getLogger("test")), modem, None, None)
+
+    try:
+        del modem.commands[:]
+        assert fona.delete_messages() == 3
+        assert modem.commands == ["AT+CPMS?", "AT+CMGD=1,4", "AT+CMGDA=6", "AT+CPMS?"]
+
+        stored_indexes += ["3", "5"]
+        refused_commands.append("AT+CMGDA=6")
+        del modem.commands[:]
+        assert fona.delete_messages() == 2
+        assert modem.commands[-2:] == ["AT+CMGD=3", "AT+CMGD=5"]
+        assert stored_indexes == []
+    finally:
+        fona.__poll_task__.stop()
+        fona.__modem_reader__.stop(1)
+
+
+class BaudRateResponder(object):
+    """
+    Answers like a modem running at one rate. Commands sent
+    at any other rate get no answer, and so do the next few
+    sent while it is at a rate with dropped commands.
+    """
+
+    def __call__(self, command):
+        if self.serial_connection.baudrate != self.baud_rate:
+            return ""
+
+        if self.dropped_commands.get(self.baud_rate, 0) > 0:
+            self.dropped_commands[self.baud_rate] -= 1
+            return ""
+
+        if command.startswith("AT+IPR="):
+            self.baud_rate = int(command.partition("=")[2])
+        elif command == "AT&W":
+            self.saved_baud_rate = self.baud_rate
+
+        return "\r\nOK\r\n"
+
+    def __init__(self, baud_rate):
+        self.baud_rate = baud_rate
+        self.saved_baud_rate = baud_rate
+        self.dropped_commands = {}
+        self.serial_connection = None
+
+
+def run_baud_rate_test(responder, target_baud_rate, check):
+    """
+    Opens a Fona on a scripted modem at 9600 baud and hands
+    it to the check. Timeouts are cut short so the rates
+    the modem does not answer at do not slow the tests.
+    """
+    import logging
+    global DEFAULT_COMMAND_TIMEOUT, BAUD_RATE_SETTLE_SECONDS
+
+    saved_timeouts = (DEFAULT_COMMAND_TIMEOUT, BAUD_RATE_SETTLE_SECONDS)
+    DEFAULT_COMMAND_TIMEOUT, BAUD_RATE_SETTLE_SECONDS = 0.05, 0
+
+    modem = ScriptedModem(responder)
+    responder.serial_connection = modem
+    fona = None
+
+    try:
+        fona = Fona(Logger(logging.getLogger("test")), modem, None, None,
+                    target_baud_rate=target_baud_rate)
+        check(fona, modem)
+    finally:
+        DEFAULT_COMMAND_TIMEOUT, BAUD_RATE_SETTLE_SECONDS = saved_timeouts
+
+        if fona is not None:
+            fona.__poll_task__.stop()
+            fona.__modem_reader__.stop(1)
+
+
+def test_baud_rate_negotiation():
+    """
+    Test that a modem that passes the echo check is left
+    at the faster rate, and that the rate is saved.
+    """
+
+    responder = BaudRateResponder(9600)
+
+    def check(fona, modem):
+        assert fona.get_baud_rate() == 115200
+        assert responder.baud_rate == 115200
+        assert responder.saved_baud_rate == 115200
+
+        switch = modem.commands.index("AT+IPR=115200")
+        assert modem.commands[switch + 1:switch + 1 + BAUD_RATE_ECHO_TESTS] \
+            == ["AT"] * BAUD_RATE_ECHO_TESTS
+        assert modem.commands[switch + 1 + BAUD_RATE_ECHO_TESTS] == "AT&W"
+        assert fona.__fallback_baud_rate__ == 9600
+
+    run_baud_rate_test(responder, 115200, check)
+
+
+def test_failed_echo_check_restores_rate():
+    """
+    Test that a modem that misses an echo at the faster rate
+    is moved back to the starting rate, and that rate saved.
+    """
+
+    responder = BaudRateResponder(9600)
+    responder.dropped_commands[115200] = 1
+
+    def check(fona, modem):
+        assert fona.get_baud_rate() == 9600
+        assert responder.baud_rate == 9600
+        assert responder.saved_baud_rate == 9600
+        assert "AT&W" in modem.commands[modem.commands.index("AT+IPR=9600"):]
+        assert fona.__fallback_baud_rate__ is None
+
+    run_baud_rate_test(responder, 115200, check)
+
+
+def test_timeouts_fall_back_to_starting_rate():
+    """
+    Test that BAUD_RATE_FALLBACK_TIMEOUTS timeouts in a row
+    at the faster rate move the modem back to the rate it
+    started at, and that fewer do not.
+    """
+
+    responder = BaudRateResponder(9600)
+
+    def check(fona, modem):
+        assert fona.get_baud_rate() == 115200
+
+        responder.dropped_commands[115200] = BAUD_RATE_FALLBACK_TIMEOUTS - 1
+        for timeout in range(BAUD_RATE_FALLBACK_TIMEOUTS - 1):
+            assert fona.__send_command__("AT+CSQ").is_timeout()
+        assert fona.__send_command__("AT+CSQ").is_ok()
+        assert fona.get_baud_rate() == 115200
+
+        responder.dropped_commands[115200] = BAUD_RATE_FALLBACK_TIMEOUTS
+        for timeout in range(BAUD_RATE_FALLBACK_TIMEOUTS):
+            assert fona.__send_command__("AT+CSQ").is_timeout()
+
+        assert fona.get_baud_rate() == 9600
+        assert responder.baud_rate == 9600
+        assert responder.saved_baud_rate == 9600
+        assert fona.__fallback_baud_rate__ is None
+
+    run_baud_rate_test(responder, 115200, check)
+
+
+def test_modem_found_at_saved_rate():
+    """
+    Test that a modem saved at a rate other than the one
+    the port opens at is found, and used without moving it.
+    """
+
+    responder = BaudRateResponder(57600)
+
+    def check(fona, modem):
+        assert fona.get_baud_rate() == 57600
+        assert responder.baud_rate == 57600
+        assert not [command for command in modem.commands
+                    if command.startswith("AT+IPR=")]
+        assert fona.__send_command__("AT+CSQ").is_ok()
+
+    run_baud_rate_test(responder, None, check)
+
+
 if __name__ == '__main__':
     import serial
     import logging
@@ -0,0 +1,152 @@
+"""
+Module to keep track of how long things take.
+"""
+
+DEFAULT_BUCKET_BOUNDS = [0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 30, 60, 300]
+
+
+class LatencyHistogram(object):
+    """
+    Bucketed histogram of durations in seconds.
+    Keeps fixed storage no matter how many samples are recorded.
+    """
+
+    def record(self, seconds):
+        """
+        Adds a sample.
+        """
+
+        self.__count__ += 1
+        self.__total__ += seconds
+        self.__last__ = seconds
+        self.__max__ = max(self.__max__, seconds)
+
+        for bucket_index, upper_bound in enumerate(self.__bucket_bounds__):
+            if seconds <= upper_bound:
+                self.__bucket_counts__[bucket_index] += 1
+                return
+
+        self.__bucket_counts__[-1] += 1
+
+    def get_count(self):
+        """
+        Returns the number of samples.
+        """
+
+        return self.__count__
+
+    def get_last(self):
+        """
+        Returns the most recent sample.
+        """
+
+        return self.__last__
+
+    def get_mean(self):
+        """
+        Returns the average sample.
+
+        >>> histogram = LatencyHistogram()
+        >>> histogram.get_mean()
+        0.0
+        >>> histogram.record(1.0)
+        >>> histogram.record(3.0)
+        >>> histogram.get_mean()
+        2.0
+        """
+
+        if self.__count__ < 1:
+            return 0.0
+
+        return self.__total__ / self.__count__
+
+    def get_max(self):
+        """
+        Returns the largest sample.
+        """
+
+        return self.__max__
+
+    def get_percentile(self, percentile):
+        """
+        Returns the upper bound of the bucket that holds
+        the given percentile. Samples past the last bucket
+        report the largest sample seen.
+
+        >>> histogram = LatencyHistogram()
+        >>> for sample in [0.04] * 98 + [0.7, 4.0]:
+        ...     histogram.record(sample)
+        >>> histogram.get_percentile(50)
+        0.05
+        >>> histogram.get_percentile(99)
+        1
+        >>> histogram.get_percentile(100)
+        5
+        """
+
+        if self.__count__ < 1:
+            return 0.0
+
+        samples_needed = self.__count__ * (percentile / 100.0)
+        samples_seen = 0
+
+        for bucket_index, bucket_count in enumerate(self.__bucket_counts__):
+            samples_seen += bucket_count
+
+            if samples_seen >= samples_needed:
+                if bucket_index < len(self.__bucket_bounds__):
+                    return self.__bucket_bounds__[bucket_index]
+
+                return self.__max__
+
+        return self.__max__
+
+    def get_bucket_counts(self):
+        """
+        Returns a list of [upper bound, count] pairs.
+        The last pair has an upper bound of None.
+        """
+
+        return [[upper_bound, bucket_count] for upper_bound, bucket_count
+                in zip(self.__bucket_bounds__ + [None], self.__bucket_counts__)]
+
+    def get_summary_text(self):
+        """
+        Returns a short description of the samples.
+
+        >>> histogram = LatencyHistogram()
+        >>> histogram.record(0.5)
+        >>> histogram.record(1.5)
+        >>> histogram.get_summary_text()
+        'n=2 mean=1.0s p99=2s max=1.5s'
+        """
+
+        return "n=" + str(self.__count__) \
+            + " mean=" + str(round(self.get_mean(), 2)) + "s" \
+            + " p99=" + str(self.get_percentile(99)) + "s" \
+            + " max=" + str(round(self.__max__, 2)) + "s"
+
+    def __init__(self, bucket_bounds=None):
+        """
+        Create the histogram.
+        """
+
+        if bucket_bounds is None:
+            bucket_bounds = DEFAULT_BUCKET_BOUNDS
+
+        self.__bucket_bounds__ = list(bucket_bounds)
+        self.__bucket_counts__ = [0] * (len(self.__bucket_bounds__) + 1)
+        self.__count__ = 0
+        self.__total__ = 0.0
+        self.__last__ = 0.0
+        self.__max__ = 0.0
+
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
@@ -0,0 +1,229 @@
+"""
+Module to stop every background timer and worker
+when the process is told to quit.
+
+Anything that starts a thread registers how to stop it.
+Shutdown stops them newest first, so a task is stopped
+before the scheduler it runs on, and every stop shares
+one deadline so the whole shutdown stays short.
+"""
+
+import sys
+import threading
+import monotonic_clock
+
+# systemd and the watchdog expect the process
+# to be gone well inside this.
+DEFAULT_SHUTDOWN_SECONDS = 0.9
+
+
+class LifecycleManager(object):
+    """
+    Owns how to stop every background component.
+
+    >>> manager = LifecycleManager()
+    >>> stopped = []
+    >>> manager.register("scheduler", lambda timeout: stopped.append("scheduler"))
+    >>> manager.register("update_lcd", lambda timeout: stopped.append("update_lcd"))
+    >>> results = manager.shutdown()
+    >>> stopped
+    ['update_lcd', 'scheduler']
+    >>> [(name, is_stopped) for name, seconds, is_stopped in results]
+    [('update_lcd', True), ('scheduler', True)]
+    >>> manager.shutdown()
+    []
+    """
+
+    def register(self, name, stop_callback):
+        """
+        Adds a component. The stop callback is given the
+        seconds left before the deadline, and returns False
+        if the component did not stop in time.
+        Components registered after shutdown are stopped at once.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            if not self.__is_shut_down__:
+                self.__components__.append((name, stop_callback))
+                return
+        finally:
+            self.__lock__.release()
+
+        self.__stop_component__(name, stop_callback, 0)
+
+    def get_component_count(self):
+        """
+        Returns how many components are registered.
+        """
+
+        return len(self.__components__)
+
+    def is_shut_down(self):
+        """
+        Returns True once shutdown has started.
+        """
+
+        return self.__is_shut_down__
+
+    def shutdown(self, timeout=DEFAULT_SHUTDOWN_SECONDS):
+        """
+        Stops every component, newest first, within the timeout.
+        Returns a list of (name, seconds, stopped) for each one.
+        Only the first call does anything.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            if self.__is_shut_down__:
+                return []
+
+            self.__is_shut_down__ = True
+            components = list(reversed(self.__components__))
+            self.__components__ = []
+        finally:
+            self.__lock__.release()
+
+        start_time = self.__clock__()
+        deadline = start_time + timeout
+        results = []
+
+        for name, stop_callback in components:
+            remaining_seconds = max(0.0, deadline - self.__clock__())
+            results.append(self.__stop_component__(name, stop_callback, remaining_seconds))
+
+        self.__shutdown_seconds__ = self.__clock__() - start_time
+        self.__results__ = results
+        self.__log_info__(self.get_report_text())
+
+        return results
+
+    def get_report_text(self):
+        """
+        Returns how long the last shutdown took,
+        naming anything that did not stop in time.
+        """
+
+        if self.__shutdown_seconds__ is None:
+            return "Shutdown: not run"
+
+        late_names = [name for name, seconds, is_stopped in self.__results__
+                      if not is_stopped]
+        slowest = sorted(self.__results__, key=lambda result: result[1], reverse=True)[:3]
+
+        report_text = "Shutdown: " + str(len(self.__results__)) + " stopped in " \
+            + str(round(self.__shutdown_seconds__, 3)) + "s"
+
+        if len(slowest) > 0:
+            report_text += ", slowest " + ", ".join(
+                [name + "=" + str(round(seconds, 3)) + "s" for name, seconds, is_stopped in slowest])
+
+        if len(late_names) > 0:
+            report_text += ", did not stop:" + ",".join(late_names)
+
+        return report_text
+
+    def set_logger(self, logger):
+        """
+        Sets where the shutdown report is logged.
+        """
+
+        self.__logger__ = logger
+
+    def __stop_component__(self, name, stop_callback, remaining_seconds):
+        """
+        Stops one component and times it.
+        """
+
+        start_time = self.__clock__()
+
+        try:
+            is_stopped = stop_callback(remaining_seconds) is not False
+        except:
+            is_stopped = False
+            self.__log_warning__("Exception stopping " + name + ":"
+                                 + str(sys.exc_info()[0]))
+
+        return (name, self.__clock__() - start_time, is_stopped)
+
+    def __log_info__(self, message):
+        """
+        Logs if there is a logger.
+        """
+
+        if self.__logger__ is not None:
+            self.__logger__.log_info_message(message)
+
+    def __log_warning__(self, message):
+        """
+        Logs a warning if there is a logger.
+        """
+
+        if self.__logger__ is not None:
+            self.__logger__.log_warning_message(message)
+
+    def __init__(self, logger=None, clock=None):
+        """
+        Create the manager.
+        The clock is a function that returns seconds,
+        the monotonic clock unless one is given.
+        """
+
+        if clock is None:
+            clock = monotonic_clock.get_seconds
+
+        self.__logger__ = logger
+        self.__clock__ = clock
+        self.__lock__ = threading.Lock()
+        self.__components__ = []
+        self.__is_shut_down__ = False
+        self.__shutdown_seconds__ = None
+        self.__results__ = []
+
+
+__DEFAULT_MANAGER__ = LifecycleManager()
+
+
+def get_default_manager():
+    """
+    Returns the manager shared by the whole process.
+    """
+
+    return __DEFAULT_MANAGER__
+
+
+##############
+# UNIT TESTS #
+##############
+
+
+def test_shared_deadline():
+    """
+    Test that a component that will not stop uses up
+    the deadline without holding up the rest.
+    """
+    clock_seconds = [0.0]
+    manager = LifecycleManager(clock=lambda: clock_seconds[0])
+    stop_timeouts = []
+
+    def stuck_worker(timeout):
+        stop_timeouts.append(timeout)
+        clock_seconds[0] += timeout
+        return False
+
+    manager.register("scheduler", lambda timeout: stop_timeouts.append(timeout))
+    manager.register("stuck", stuck_worker)
+    results = manager.shutdown(0.2)
+    assert stop_timeouts == [0.2, 0.0]
+    assert results[0] == ("stuck", 0.2, False)
+    assert "did not stop:stuck" in manager.get_report_text()
+
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
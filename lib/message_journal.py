@@ -0,0 +1,351 @@
+"""
+Module to keep outbound text messages on disk
+until they have been sent, so a restart or crash
+does not lose them.
+
+The journal is an append-only file with one JSON
+record per line. Writes are buffered and made durable
+with a single fsync per call to sync(), so a burst of
+messages costs one flush to the SD card. Once nothing
+is pending the file is truncated in place, and it is
+only rewritten when it has built up many stale records.
+"""
+
+import os
+import sys
+import json
+import threading
+
+JOURNAL_ADD = "add"
+JOURNAL_UPDATE = "update"
+JOURNAL_REMOVE = "remove"
+
+# Rewrite the file once it holds this many records
+# more than are needed to describe the pending messages.
+COMPACTION_THRESHOLD = 64
+
+
+class MessageJournal(object):
+    """
+    Append-only journal of the messages waiting to be sent.
+    Each pending message is a dictionary with an "id" key.
+    """
+
+    def replay(self):
+        """
+        Reads the journal back and returns the messages
+        that were still pending, in the order they were added.
+        A partly written last line from a crash is ignored.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            self.__pending__ = {}
+            self.__pending_order__ = []
+            self.__record_count__ = 0
+
+            if not os.path.exists(self.__journal_path__):
+                return []
+
+            with open(self.__journal_path__, 'r') as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        self.__log_warning__("Skipping damaged journal record.")
+                        continue
+
+                    self.__record_count__ += 1
+                    self.__apply_record__(record)
+
+            self.__compact__()
+
+            return [dict(self.__pending__[message_id])
+                    for message_id in self.__pending_order__]
+        finally:
+            self.__lock__.release()
+
+    def add_message(self, message_record):
+        """
+        Adds a message that is waiting to be sent.
+        """
+
+        self.__append_record__({"op": JOURNAL_ADD, "message": message_record})
+
+    def update_message(self, message_id, changes):
+        """
+        Records a change to a pending message,
+        such as the number of retries left.
+        """
+
+        self.__append_record__({"op": JOURNAL_UPDATE, "id": message_id, "changes": changes})
+
+    def remove_message(self, message_id):
+        """
+        Records that a message was sent or given up on.
+        """
+
+        self.__append_record__({"op": JOURNAL_REMOVE, "id": message_id})
+
+    def sync(self):
+        """
+        Makes everything written so far durable.
+        Empties the file when nothing is pending, and
+        compacts it when it has grown well past what
+        the pending messages need.
+        Returns True if anything was written to disk.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            if not self.__is_dirty__:
+                return False
+
+            try:
+                if len(self.__pending__) == 0:
+                    self.__truncate__()
+                elif self.__record_count__ - len(self.__pending__) > COMPACTION_THRESHOLD:
+                    self.__compact__()
+                else:
+                    self.__flush__()
+            except:
+                self.__log_warning__("Unable to sync the message journal:"
+                                     + str(sys.exc_info()[0]))
+                return False
+
+            self.__sync_count__ += 1
+
+            return True
+        finally:
+            self.__lock__.release()
+
+    def get_pending_count(self):
+        """
+        Returns the number of messages waiting to be sent.
+        """
+
+        return len(self.__pending__)
+
+    def get_sync_count(self):
+        """
+        Returns how many times the journal was written to disk.
+        """
+
+        return self.__sync_count__
+
+    def close(self):
+        """
+        Syncs and closes the journal file.
+        """
+
+        self.sync()
+
+        self.__lock__.acquire(True)
+        try:
+            if self.__journal_file__ is not None:
+                self.__journal_file__.close()
+                self.__journal_file__ = None
+        finally:
+            self.__lock__.release()
+
+    def __append_record__(self, record):
+        """
+        Buffers a record and applies it to the pending messages.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            self.__apply_record__(record)
+            self.__record_count__ += 1
+            self.__is_dirty__ = True
+
+            try:
+                self.__get_journal_file__().write(json.dumps(record) + "\n")
+            except:
+                self.__log_warning__("Unable to write to the message journal:"
+                                     + str(sys.exc_info()[0]))
+        finally:
+            self.__lock__.release()
+
+    def __apply_record__(self, record):
+        """
+        Applies a record to the pending messages.
+        """
+
+        operation = record.get("op")
+
+        if operation == JOURNAL_ADD:
+            message_id = record["message"]["id"]
+            if message_id not in self.__pending__:
+                self.__pending_order__.append(message_id)
+            self.__pending__[message_id] = dict(record["message"])
+        elif operation == JOURNAL_UPDATE:
+            if record["id"] in self.__pending__:
+                self.__pending__[record["id"]].update(record["changes"])
+        elif operation == JOURNAL_REMOVE:
+            if record["id"] in self.__pending__:
+                del self.__pending__[record["id"]]
+                self.__pending_order__.remove(record["id"])
+
+    def __get_journal_file__(self):
+        """
+        Opens the journal for appending if it is not open.
+        """
+
+        if self.__journal_file__ is None:
+            self.__journal_file__ = open(self.__journal_path__, 'a')
+
+        return self.__journal_file__
+
+    def __flush__(self):
+        """
+        Flushes the buffered records and fsyncs the file.
+        """
+
+        journal_file = self.__get_journal_file__()
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+        self.__is_dirty__ = False
+
+    def __truncate__(self):
+        """
+        Empties the journal in place once nothing is pending.
+        One fsync, like an append, with no new file or rename.
+        """
+
+        journal_file = self.__get_journal_file__()
+        journal_file.flush()
+        journal_file.truncate(0)
+        os.fsync(journal_file.fileno())
+        self.__record_count__ = 0
+        self.__is_dirty__ = False
+
+    def __compact__(self):
+        """
+        Rewrites the journal with one record per pending
+        message, then swaps it in place of the old file.
+        """
+
+        if self.__journal_file__ is not None:
+            self.__journal_file__.close()
+            self.__journal_file__ = None
+
+        temporary_path = self.__journal_path__ + ".tmp"
+
+        with open(temporary_path, 'w') as compacted_file:
+            for message_id in self.__pending_order__:
+                compacted_file.write(json.dumps({"op": JOURNAL_ADD,
+                                                 "message": self.__pending__[message_id]}) + "\n")
+            compacted_file.flush()
+            os.fsync(compacted_file.fileno())
+
+        os.rename(temporary_path, self.__journal_path__)
+
+        self.__record_count__ = len(self.__pending_order__)
+        self.__is_dirty__ = False
+
+    def __log_warning__(self, message):
+        """
+        Logs a warning if there is a logger.
+        """
+
+        if self.__logger__ is not None:
+            self.__logger__.log_warning_message(message)
+
+    def __init__(self, journal_path, logger=None):
+        """
+        Create the journal. Call replay() before adding messages.
+        """
+
+        self.__journal_path__ = journal_path
+        self.__logger__ = logger
+        self.__lock__ = threading.RLock()
+        self.__journal_file__ = None
+        self.__pending__ = {}
+        self.__pending_order__ = []
+        self.__record_count__ = 0
+        self.__sync_count__ = 0
+        self.__is_dirty__ = False
+
+
+##############
+# UNIT TESTS #
+##############
+
+
+def test_replay_after_restart():
+    """
+    Test that pending messages survive closing the journal.
+    """
+    import tempfile
+
+    journal_path = os.path.join(tempfile.mkdtemp(), "journal.log")
+    journal = MessageJournal(journal_path)
+    assert journal.replay() == []
+    journal.add_message({"id": 1, "text": "Gas warning"})
+    journal.add_message({"id": 2, "text": "STATUS"})
+    journal.update_message(2, {"retries": 3})
+    journal.remove_message(1)
+    assert journal.sync()
+    assert not journal.sync()
+    journal.close()
+
+    # A crash part way through a write.
+    with open(journal_path, 'a') as journal_file:
+        journal_file.write('{"op": "add", "mess')
+
+    replayed = MessageJournal(journal_path).replay()
+    assert replayed == [{"id": 2, "text": "STATUS", "retries": 3}]
+
+
+def test_compaction():
+    """
+    Test that the journal shrinks once everything is sent.
+    """
+    import tempfile
+
+    journal_path = os.path.join(tempfile.mkdtemp(), "journal.log")
+    journal = MessageJournal(journal_path)
+    journal.replay()
+
+    for message_id in range(COMPACTION_THRESHOLD * 2):
+        journal.add_message({"id": message_id})
+        journal.remove_message(message_id)
+
+    journal.add_message({"id": "last"})
+    journal.sync()
+
+    with open(journal_path, 'r') as journal_file:
+        assert len(journal_file.readlines()) == 1
+
+
+def test_empty_journal_is_truncated_in_place():
+    """
+    Test that sending the last pending message empties
+    the file without rewriting it.
+    """
+    import tempfile
+
+    journal_path = os.path.join(tempfile.mkdtemp(), "journal.log")
+    journal = MessageJournal(journal_path)
+    journal.replay()
+    journal.add_message({"id": 1, "text": "STATUS"})
+    assert journal.sync()
+    inode = os.stat(journal_path).st_ino
+    journal.remove_message(1)
+    assert journal.sync()
+    assert os.stat(journal_path).st_ino == inode
+    assert os.path.getsize(journal_path) == 0
+    journal.add_message({"id": 2, "text": "HELP"})
+    journal.close()
+    assert MessageJournal(journal_path).replay() == [{"id": 2, "text": "HELP"}]
+
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
@@ -0,0 +1,370 @@
+"""
+Module to own the reads from the modem's serial port.
+
+A single background thread reads everything the modem sends.
+Lines that answer a command are handed to the caller
+that is waiting on that command. Unsolicited result codes
+(URCs) are handed to whoever subscribed to them.
+"""
+
+import sys
+import time
+import threading
+import Queue
+from serial_buffer import BufferedSerialReader
+
+DEFAULT_READ_TIMEOUT = 0.1
+READ_ERROR_BACKOFF = 1
+
+PROMPT = ">"
+
+# Lines the modem can send at any time.
+URC_PREFIXES = ["+CMTI:",
+                "+CDS:",
+                "RING",
+                "+CREG:",
+                "UNDER-VOLTAGE",
+                "OVER-VOLTAGE",
+                "NORMAL POWER DOWN",
+                "RDY",
+                "+CFUN:",
+                "+CPIN:",
+                "Call Ready",
+                "SMS Ready"]
+
+
+# URCs whose PDU arrives on the next line. In text mode
+# the same URC is one line with comma separated fields.
+# +CMT: is not here because AT+CNMI=2,1 stores messages
+# on the SIM and only sends +CMTI:.
+TWO_LINE_URC_PREFIXES = ["+CDS:"]
+
+
+def is_two_line_urc(urc_prefix, line):
+    """
+    Returns True if the rest of the URC is on the next line.
+
+    >>> is_two_line_urc("+CDS:", "+CDS: 25")
+    True
+    >>> is_two_line_urc("+CDS:", '+CDS: 6,27,"2061234567",129')
+    False
+    >>> is_two_line_urc("+CMTI:", '+CMTI: "SM",4')
+    False
+    >>> is_two_line_urc("+CMT:", "+CMT: 25")
+    False
+    """
+
+    return urc_prefix in TWO_LINE_URC_PREFIXES and "," not in line
+
+
+def get_urc_prefix(line):
+    """
+    Returns the URC prefix the line starts with, or None.
+
+    >>> get_urc_prefix('+CMTI: "SM",4')
+    '+CMTI:'
+    >>> get_urc_prefix("UNDER-VOLTAGE WARNNING")
+    'UNDER-VOLTAGE'
+    >>> get_urc_prefix("+CSQ: 14,0")
+    """
+
+    for urc_prefix in URC_PREFIXES:
+        if line.startswith(urc_prefix):
+            return urc_prefix
+
+    return None
+
+
+def is_owned_by_command(urc_prefix, command):
+    """
+    Returns True if the pending command asked for a line
+    that looks like the URC, such as AT+CREG? and +CREG:
+
+    >>> is_owned_by_command("+CREG:", "AT+CREG?")
+    True
+    >>> is_owned_by_command("+CMTI:", "AT+CREG?")
+    False
+    >>> is_owned_by_command("+CMTI:", None)
+    False
+    """
+
+    if command is None:
+        return False
+
+    return urc_prefix.rstrip(':') in command
+
+
+class ModemReader(object):
+    """
+    Background reader that demultiplexes everything
+    coming from the modem.
+    """
+
+    def start(self):
+        """
+        Starts the reader thread.
+        Returns False if there is no serial connection.
+        """
+
+        if self.__serial_connection__ is None or self.is_running():
+            return False
+
+        self.__is_running__ = True
+        self.__thread__ = threading.Thread(target=self.__run__,
+                                           name="modem_reader")
+        self.__thread__.daemon = True
+        self.__thread__.start()
+
+        return True
+
+    def stop(self, timeout=None):
+        """
+        Stops the reader thread.
+        Returns False if it was still reading after the timeout.
+        """
+
+        self.__is_running__ = False
+        is_stopped = True
+
+        if self.__thread__ is not None:
+            self.__thread__.join(timeout)
+            is_stopped = not self.__thread__.is_alive()
+            self.__thread__ = None
+
+        return is_stopped
+
+    def is_running(self):
+        """
+        Returns True if the reader thread is running.
+        """
+
+        return self.__is_running__ and self.__thread__ is not None
+
+    def attach(self, serial_connection):
+        """
+        Switches to a new serial connection, such as
+        after a reconnect. The reader must be stopped.
+        """
+
+        self.__serial_connection__ = serial_connection
+        self.__serial_buffer__.set_serial_connection(serial_connection)
+        self.__partial_urc__ = None
+        self.__clear_responses__()
+
+        if self.__serial_connection__ is not None:
+            self.__serial_connection__.timeout = self.__read_timeout__
+
+    def subscribe(self, urc_prefix, callback):
+        """
+        Calls the callback with the full line every time
+        a URC with the given prefix arrives.
+        A queue can subscribe by passing its put method.
+        """
+
+        self.__subscribers_lock__.acquire(True)
+        try:
+            if urc_prefix not in self.__subscribers__:
+                self.__subscribers__[urc_prefix] = []
+
+            self.__subscribers__[urc_prefix].append(callback)
+        finally:
+            self.__subscribers_lock__.release()
+
+    def begin_command(self, command):
+        """
+        Marks a command as waiting for a response.
+        Anything left over from an earlier command is thrown away.
+        """
+
+        self.__clear_responses__()
+        self.__pending_command__ = command
+
+    def end_command(self):
+        """
+        Marks that nobody is waiting on a response any more.
+        """
+
+        self.__pending_command__ = None
+
+    def read_response_line(self, timeout):
+        """
+        Returns the next line for the pending command.
+        Returns None if nothing arrives before the timeout.
+        """
+
+        try:
+            return self.__response_queue__.get(True, max(timeout, 0))
+        except Queue.Empty:
+            return None
+
+    def has_response(self):
+        """
+        Returns True if a response line is waiting.
+        """
+
+        return not self.__response_queue__.empty()
+
+    def get_serial_buffer(self):
+        """
+        Returns the buffered reader so its counters can be reported.
+        """
+
+        return self.__serial_buffer__
+
+    def get_urc_count(self):
+        """
+        Returns how many URCs have been dispatched.
+        """
+
+        return self.__urc_count__
+
+    def __run__(self):
+        """
+        The reader thread.
+        """
+
+        while self.__is_running__:
+            try:
+                if self.__serial_buffer__.wait_and_fill() < 1 \
+                        and self.__serial_buffer__.is_empty():
+                    continue
+
+                for line in self.__serial_buffer__.read_lines():
+                    self.__route_line__(line)
+
+                # The prompt is not followed by a newline.
+                if self.__pending_command__ is not None \
+                        and self.__serial_buffer__.get_partial().strip() == PROMPT:
+                    self.__serial_buffer__.clear()
+                    self.__response_queue__.put(PROMPT)
+            except (IOError, OSError):
+                # The port is gone. Let the owner reconnect
+                # instead of spinning on a dead connection.
+                if self.__error_callback__ is None:
+                    self.__log_warning__("Exception reading from modem:"
+                                         + str(sys.exc_info()[0]))
+                    time.sleep(READ_ERROR_BACKOFF)
+                else:
+                    self.__is_running__ = False
+                    self.__error_callback__("reading:" + str(sys.exc_info()[1]))
+            except:
+                self.__log_warning__("Exception reading from modem:"
+                                     + str(sys.exc_info()[0]))
+                time.sleep(READ_ERROR_BACKOFF)
+
+    def __route_line__(self, line):
+        """
+        Sends a line to a subscriber or to the waiting command.
+        """
+
+        line = line.strip()
+
+        if line == "":
+            return
+
+        if self.__partial_urc__ is not None:
+            urc_prefix, first_line = self.__partial_urc__
+            self.__partial_urc__ = None
+            self.__dispatch_urc__(urc_prefix, first_line + "\n" + line)
+            return
+
+        urc_prefix = get_urc_prefix(line)
+
+        if urc_prefix is not None and is_two_line_urc(urc_prefix, line):
+            self.__partial_urc__ = (urc_prefix, line)
+            return
+
+        if urc_prefix is not None \
+                and not is_owned_by_command(urc_prefix, self.__pending_command__):
+            self.__dispatch_urc__(urc_prefix, line)
+        elif self.__pending_command__ is not None:
+            self.__response_queue__.put(line)
+        else:
+            self.__log_info__("Unrequested line from modem:" + line)
+
+    def __dispatch_urc__(self, urc_prefix, line):
+        """
+        Calls every subscriber of the URC.
+        """
+
+        self.__urc_count__ += 1
+        self.__log_info__("URC:" + line)
+
+        self.__subscribers_lock__.acquire(True)
+        try:
+            callbacks = list(self.__subscribers__.get(urc_prefix, []))
+        finally:
+            self.__subscribers_lock__.release()
+
+        for callback in callbacks:
+            try:
+                callback(line)
+            except:
+                self.__log_warning__("Exception in URC subscriber for "
+                                     + urc_prefix + ":" + str(sys.exc_info()[0]))
+
+    def __clear_responses__(self):
+        """
+        Empties the response queue.
+        """
+
+        try:
+            while True:
+                self.__response_queue__.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def __log_info__(self, message):
+        """
+        Logs if there is a logger.
+        """
+
+        if self.__logger__ is not None:
+            self.__logger__.log_info_message(message)
+
+    def __log_warning__(self, message):
+        """
+        Logs a warning if there is a logger.
+        """
+
+        if self.__logger__ is not None:
+            self.__logger__.log_warning_message(message)
+
+    def __init__(self,
+                 serial_connection,
+                 logger=None,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 error_callback=None):
+        """
+        Create the reader. The serial timeout is set so the
+        thread can block on the port without spinning.
+        If an error callback is given, the reader stops
+        and calls it when the port fails.
+        """
+
+        self.__serial_connection__ = serial_connection
+        self.__logger__ = logger
+        self.__read_timeout__ = read_timeout
+        self.__error_callback__ = error_callback
+        self.__serial_buffer__ = BufferedSerialReader(serial_connection)
+        self.__response_queue__ = Queue.Queue()
+        self.__pending_command__ = None
+        self.__partial_urc__ = None
+        self.__subscribers__ = {}
+        self.__subscribers_lock__ = threading.Lock()
+        self.__urc_count__ = 0
+        self.__is_running__ = False
+        self.__thread__ = None
+
+        if self.__serial_connection__ is not None:
+            self.__serial_connection__.timeout = self.__read_timeout__
+
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
@@ -0,0 +1,106 @@
+"""
+Module to read a clock that only moves forward.
+
+time.time() jumps when NTP or the GPS sets the clock,
+which makes timers fire early, late, or not at all.
+Python 2 has no time.monotonic(), so clock_gettime
+is called through ctypes. If that can not be loaded,
+the wall clock is used instead.
+"""
+
+import sys
+import time
+import ctypes
+import ctypes.util
+
+# CLOCK_MONOTONIC is 1 on Linux and 6 on macOS.
+LINUX_CLOCK_MONOTONIC = 1
+DARWIN_CLOCK_MONOTONIC = 6
+
+
+class Timespec(ctypes.Structure):
+    """
+    The struct timespec that clock_gettime fills in.
+    """
+
+    _fields_ = [("tv_sec", ctypes.c_long),
+                ("tv_nsec", ctypes.c_long)]
+
+
+def __load_clock_gettime__():
+    """
+    Returns a function that reads the monotonic clock,
+    or None if clock_gettime is not available.
+    """
+
+    if sys.platform.startswith("linux"):
+        clock_id = LINUX_CLOCK_MONOTONIC
+    elif sys.platform == "darwin":
+        clock_id = DARWIN_CLOCK_MONOTONIC
+    else:
+        return None
+
+    try:
+        library_name = ctypes.util.find_library("rt") or ctypes.util.find_library("c")
+        clock_gettime = ctypes.CDLL(library_name, use_errno=True).clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+        clock_gettime.restype = ctypes.c_int
+    except:
+        return None
+
+    def read_clock():
+        """
+        Returns the monotonic clock in seconds.
+        """
+
+        timespec = Timespec()
+
+        if clock_gettime(clock_id, ctypes.byref(timespec)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+    try:
+        read_clock()
+    except:
+        return None
+
+    return read_clock
+
+
+__READ_CLOCK__ = __load_clock_gettime__()
+
+
+def is_monotonic():
+    """
+    Returns True if the clock really is monotonic,
+    False if it fell back to the wall clock.
+    """
+
+    return __READ_CLOCK__ is not None
+
+
+def get_seconds():
+    """
+    Returns the clock in seconds. Only the difference
+    between two readings means anything.
+
+    >>> first_reading = get_seconds()
+    >>> get_seconds() >= first_reading
+    True
+    """
+
+    if __READ_CLOCK__ is None:
+        return time.time()
+
+    return __READ_CLOCK__()
+
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
@@ -0,0 +1,195 @@
+"""
+Module to hold outbound messages in priority order.
+"""
+
+import time
+import threading
+from collections import deque
+from latency_histogram import LatencyHistogram
+
+# A message moves up one priority class
+# for every this many seconds it waits.
+DEFAULT_AGING_SECONDS = 60
+
+# The most urgent class. Nothing ages into it,
+# so a backed up queue can not delay an alert.
+URGENT_PRIORITY = 0
+
+
+class PriorityMessageQueue(object):
+    """
+    One first-in, first-out queue per priority class.
+    Priority 0 is the most urgent. The next message
+    comes from the most urgent class, but waiting messages
+    age up so lower classes are never starved. Aging stops
+    short of priority 0, and between classes that have aged
+    to the same priority the longest waiting goes first.
+
+    >>> queue = PriorityMessageQueue(3)
+    >>> queue.put("status", 2)
+    >>> queue.put("gas", 0)
+    >>> queue.get_depth()
+    2
+    >>> queue.get(), queue.get(), queue.get()
+    ('gas', 'status', None)
+    """
+
+    def put(self, item, priority):
+        """
+        Adds an item to the end of its class.
+        """
+
+        priority = min(max(priority, 0), len(self.__queues__) - 1)
+
+        self.__lock__.acquire(True)
+        try:
+            self.__queues__[priority].append([time.time(), item])
+        finally:
+            self.__lock__.release()
+
+    def get(self):
+        """
+        Removes and returns the next item,
+        or None if every class is empty.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            current_time = time.time()
+            next_priority = None
+            next_rank = None
+
+            for priority, queue in enumerate(self.__queues__):
+                if len(queue) < 1:
+                    continue
+
+                waited_seconds = current_time - queue[0][0]
+                effective_priority = priority - int(waited_seconds / self.__aging_seconds__)
+
+                if priority > URGENT_PRIORITY:
+                    effective_priority = max(URGENT_PRIORITY + 1, effective_priority)
+
+                rank = (effective_priority, queue[0][0])
+
+                if next_priority is None or rank < next_rank:
+                    next_priority = priority
+                    next_rank = rank
+
+            if next_priority is None:
+                return None
+
+            queued_time, item = self.__queues__[next_priority].popleft()
+            self.__wait_times__[next_priority].record(current_time - queued_time)
+
+            return item
+        finally:
+            self.__lock__.release()
+
+    def take_matching(self, priority, is_match):
+        """
+        Removes and returns every item in a class
+        that the is_match function accepts.
+
+        >>> queue = PriorityMessageQueue(2)
+        >>> for item in ["a", "b", "a"]:
+        ...     queue.put(item, 1)
+        >>> queue.take_matching(1, lambda item: item == "a")
+        ['a', 'a']
+        >>> queue.get_depth()
+        1
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            current_time = time.time()
+            matched_items = []
+            kept_entries = deque()
+
+            for queued_time, item in self.__queues__[priority]:
+                if is_match(item):
+                    matched_items.append(item)
+                    self.__wait_times__[priority].record(current_time - queued_time)
+                else:
+                    kept_entries.append([queued_time, item])
+
+            self.__queues__[priority] = kept_entries
+
+            return matched_items
+        finally:
+            self.__lock__.release()
+
+    def is_empty(self):
+        """
+        Returns True if every class is empty.
+        """
+
+        return self.get_depth() == 0
+
+    def get_depth(self, priority=None):
+        """
+        Returns the number of items waiting in a class,
+        or in every class if no priority is given.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            if priority is not None:
+                return len(self.__queues__[priority])
+
+            return sum([len(queue) for queue in self.__queues__])
+        finally:
+            self.__lock__.release()
+
+    def get_wait_times(self):
+        """
+        Returns the histograms of how long items waited,
+        indexed by priority.
+        """
+
+        return self.__wait_times__
+
+    def __init__(self, priority_count, aging_seconds=DEFAULT_AGING_SECONDS):
+        """
+        Create the queue.
+        """
+
+        self.__lock__ = threading.Lock()
+        self.__aging_seconds__ = aging_seconds
+        self.__queues__ = [deque() for priority in range(priority_count)]
+        self.__wait_times__ = [LatencyHistogram() for priority in range(priority_count)]
+
+
+##############
+# UNIT TESTS #
+##############
+
+
+def test_aging():
+    """
+    Test that an old broadcast goes before a new reply,
+    but never before a new alert.
+    """
+    queue = PriorityMessageQueue(3, 10)
+    queue.put("broadcast", 2)
+    queue.__queues__[2][0][0] -= 35
+    queue.put("reply", 1)
+    queue.put("alert", 0)
+    assert queue.get() == "alert"
+    assert queue.get() == "broadcast"
+    assert queue.get() == "reply"
+    assert queue.get_wait_times()[2].get_count() == 1
+
+    queue.put("broadcast", 2)
+    queue.__queues__[2][0][0] -= 3600
+    queue.put("alert", 0)
+    assert queue.get() == "alert"
+
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
@@ -2,9 +2,16 @@
 Module to handle tasks that occur on a regularly scheduled interval.
 """
 
-import threading
 import sys
 import time
+import threading
+import monotonic_clock
+import task_scheduler
+import task_telemetry
+import lifecycle
+
+# How often stop() checks if a run has finished.
+STOP_POLL_SECONDS = 0.01
 
 FUNCTION_A_COUNT = 0
 FUNCTION_B_COUNT = 0
@@ -12,6 +19,9 @@ FUNCTION_B_COUNT = 0
 class RecurringTask(object):
     """
     Object to control and handle a recurring task.
+    Runs are scheduled on a fixed grid from when the task
+    started, so they do not drift. Ticks that pass while
+    the callback is still running are skipped.
     """
 
     def is_running(self):
@@ -24,45 +34,166 @@ class RecurringTask(object):
     def start(self):
         """
         Starts the task if it is not already running.
+        The first run happens right away.
         """
-        if self.__task_callback__ is not None and not self.__is_running__:
+        self.__lock__.acquire(True)
+        try:
+            if self.__task_callback__ is None or self.__is_running__:
+                return False
+
             self.__is_running__ = True
-            self.__run_task__()
+            self.__next_run_time__ = self.__scheduler__.get_seconds()
+        finally:
+            self.__lock__.release()
 
-            return True
+        self.__run_task__()
 
-        return False
+        return True
 
     def pause(self):
         """
         Pauses the task if it is running.
+        A run in progress finishes, but is not followed by another.
         """
 
-        if self.is_running():
+        self.__lock__.acquire(True)
+        try:
             self.__is_running__ = False
 
+            if self.__scheduled_call__ is not None:
+                self.__scheduled_call__.cancel()
+                self.__scheduled_call__ = None
+        finally:
+            self.__lock__.release()
+
+    def stop(self, timeout=None):
+        """
+        Stops the task for good. A run that is in progress
+        is given up to the timeout to finish.
+        Returns False if it was still running.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            self.__task_callback__ = None
+        finally:
+            self.__lock__.release()
+
+        self.pause()
+
+        deadline = None
+
+        if timeout is not None:
+            deadline = monotonic_clock.get_seconds() + timeout
+
+        while not self.__run_lock__.acquire(False):
+            if deadline is not None and monotonic_clock.get_seconds() >= deadline:
+                return False
+
+            time.sleep(STOP_POLL_SECONDS)
+
+        self.__run_lock__.release()
+
+        return True
+
+    def get_telemetry(self):
+        """
+        Returns the run counters for the task.
+        """
+
+        return self.__telemetry__
+
     def __run_task__(self):
         """
         Runs the callback.
         """
 
-        if not self.__is_running__:
+        self.__lock__.acquire(True)
+        try:
+            task_callback = self.__task_callback__
+
+            if not self.__is_running__ or task_callback is None:
+                return False
+        finally:
+            self.__lock__.release()
+
+        # Never run the same task twice at once.
+        if not self.__run_lock__.acquire(False):
+            self.__telemetry__.record_overlap()
             return False
 
         try:
-            self.__task_callback__()
-        except:
-            if self.__logger__ is not None:
-                error_mesage = "EX(" + self.__task_name__ + ")=" + sys.exc_info()[0]
-                self.__logger__.info(error_mesage)
+            start_time = self.__scheduler__.get_seconds()
+
+            try:
+                task_callback()
+            except:
+                self.__telemetry__.record_exception()
+                error_mesage = "EX(" + self.__task_name__ + ")=" + str(sys.exc_info()[0])
+                self.__log_warning__(error_mesage)
+
+            self.__telemetry__.record_run(self.__scheduler__.get_seconds() - start_time)
+        finally:
+            self.__run_lock__.release()
+
+        # Checked under the lock, so a pause() during
+        # the run can not miss the call scheduled here.
+        self.__lock__.acquire(True)
+        try:
+            if self.__is_running__:
+                self.__schedule_next_run__()
+        finally:
+            self.__lock__.release()
 
-        if self.__is_running__:
-            threading.Timer(int(self.__task_interval__), self.__run_task__).start()
+        return True
 
-    def __init__(self, task_name, task_interval, task_callback, logger=None):
+    def __log_warning__(self, message):
+        """
+        Logs a warning with either our Logger
+        or a standard library logger.
+        """
+
+        if self.__logger__ is None:
+            return
+
+        if hasattr(self.__logger__, "log_warning_message"):
+            self.__logger__.log_warning_message(message)
+        else:
+            self.__logger__.warning(message)
+
+    def __schedule_next_run__(self):
+        """
+        Schedules the next tick on the grid that is still ahead.
+        """
+
+        current_time = self.__scheduler__.get_seconds()
+        self.__next_run_time__ += self.__task_interval__
+
+        if self.__next_run_time__ <= current_time:
+            missed_ticks = int((current_time - self.__next_run_time__) / self.__task_interval__) + 1
+            self.__next_run_time__ += missed_ticks * self.__task_interval__
+            self.__telemetry__.record_missed_ticks(missed_ticks)
+
+        self.__scheduled_call__ = self.__scheduler__.call_at(self.__next_run_time__,
+                                                             self.__run_task__,
+                                                             self.__task_name__)
+
+    def __init__(self,
+                 task_name,
+                 task_interval,
+                 task_callback,
+                 logger=None,
+                 scheduler=None,
+                 telemetry=None,
+                 lifecycle_manager=None):
         """
         Creates a new reocurring task.
         The call back is called at the given time schedule.
+        Runs on the shared scheduler unless one is given.
+        Runs are recorded in the given telemetry, or in
+        new telemetry in the shared registry.
+        The task is stopped by the given lifecycle manager,
+        or when the process shuts down.
         """
 
         self.__task_name__ = task_name
@@ -70,9 +201,166 @@ class RecurringTask(object):
         self.__task_callback__ = task_callback
         self.__logger__ = logger
         self.__is_running__ = False
+        self.__next_run_time__ = None
+        self.__scheduled_call__ = None
+        self.__scheduler__ = scheduler
+        self.__lock__ = threading.Lock()
+        self.__run_lock__ = threading.Lock()
+        self.__telemetry__ = telemetry
+
+        if self.__telemetry__ is None:
+            self.__telemetry__ = task_telemetry.register_task(task_name, task_interval)
+
+        if self.__scheduler__ is None:
+            self.__scheduler__ = task_scheduler.get_default_scheduler()
+
+        if lifecycle_manager is None:
+            lifecycle_manager = lifecycle.get_default_manager()
+
+        lifecycle_manager.register(task_name, self.stop)
 
         self.start()
 
+def test_skips_missed_ticks():
+    """
+    Test that a slow run skips the ticks it overran
+    instead of running them back to back.
+    """
+    clock = task_scheduler.FakeClock()
+    run_times = []
+
+    def slow_callback():
+        run_times.append(clock.get_seconds())
+        if len(run_times) == 1:
+            clock.advance(25)
+
+    scheduler = task_scheduler.TaskScheduler(0, clock=clock.get_seconds)
+    telemetry = task_telemetry.TaskTelemetry("slow", 10)
+    task = RecurringTask("slow", 10, slow_callback, scheduler=scheduler, telemetry=telemetry,
+                         lifecycle_manager=lifecycle.LifecycleManager())
+    # The first run happened in the constructor,
+    # and overran the ticks at 10 and 20.
+    clock.advance(4)
+    assert scheduler.run_pending() == 0
+    clock.advance(1)
+    assert scheduler.run_pending() == 1
+    task.pause()
+    assert run_times[1] - run_times[0] == 30
+    assert telemetry.get_statistics()["missed_ticks"] == 2
+    assert telemetry.get_statistics()["overruns"] == 1
+    assert telemetry not in task_telemetry.get_registered_tasks()
+
+def start_blocking_run(scheduler, callback_started):
+    """
+    Runs the due calls on another thread, and waits
+    until the callback has started.
+    """
+    runner = threading.Thread(target=scheduler.run_pending)
+    runner.start()
+    assert callback_started.wait(5)
+
+    return runner
+
+def test_stop_waits_for_run():
+    """
+    Test that stop waits for a run in progress
+    and that a stopped task does not start again.
+    """
+    clock = task_scheduler.FakeClock()
+    callback_started = threading.Event()
+    finish_callback = threading.Event()
+    run_count = []
+
+    def blocking_callback():
+        run_count.append(1)
+        if len(run_count) > 1:
+            callback_started.set()
+            finish_callback.wait(5)
+
+    scheduler = task_scheduler.TaskScheduler(0, clock=clock.get_seconds)
+    task = RecurringTask("stop", 10, blocking_callback, scheduler=scheduler,
+                         telemetry=task_telemetry.TaskTelemetry("stop", 10),
+                         lifecycle_manager=lifecycle.LifecycleManager())
+    clock.advance(10)
+    runner = start_blocking_run(scheduler, callback_started)
+    assert task.stop(0) is False
+    finish_callback.set()
+    assert task.stop(5) is True
+    runner.join(5)
+    assert len(run_count) == 2
+    assert not task.start()
+    clock.advance(100)
+    assert scheduler.run_pending() == 0
+
+def test_pause_while_callback_runs():
+    """
+    Test that a task paused while its callback
+    is running does not run again.
+    """
+    clock = task_scheduler.FakeClock()
+    callback_started = threading.Event()
+    finish_callback = threading.Event()
+    run_count = []
+
+    def blocking_callback():
+        run_count.append(1)
+        if len(run_count) > 1:
+            callback_started.set()
+            finish_callback.wait(5)
+
+    scheduler = task_scheduler.TaskScheduler(0, clock=clock.get_seconds)
+    task = RecurringTask("pause", 10, blocking_callback, scheduler=scheduler,
+                         telemetry=task_telemetry.TaskTelemetry("pause", 10),
+                         lifecycle_manager=lifecycle.LifecycleManager())
+    clock.advance(10)
+    runner = start_blocking_run(scheduler, callback_started)
+    task.pause()
+    finish_callback.set()
+    runner.join(5)
+    clock.advance(100)
+    assert scheduler.run_pending() == 0
+    assert len(run_count) == 2
+    assert not task.is_running()
+
+class PausingScheduler(task_scheduler.TaskScheduler):
+    """
+    A scheduler that pauses a task from another
+    thread while the task schedules its next run.
+    """
+
+    def call_at(self, run_time, callback, name=None):
+        if self.task_to_pause is not None:
+            pauser = threading.Thread(target=self.task_to_pause.pause)
+            pauser.start()
+            pauser.join(0.1)
+            self.pausers.append(pauser)
+
+        return task_scheduler.TaskScheduler.call_at(self, run_time, callback, name)
+
+    def __init__(self, clock):
+        task_scheduler.TaskScheduler.__init__(self, 0, clock=clock)
+        self.task_to_pause = None
+        self.pausers = []
+
+def test_pause_while_rescheduling():
+    """
+    Test that a pause() that lands while a finished run
+    is scheduling the next one still stops the task.
+    """
+    clock = task_scheduler.FakeClock()
+    run_count = []
+    scheduler = PausingScheduler(clock.get_seconds)
+    task = RecurringTask("reschedule", 10, lambda: run_count.append(1), scheduler=scheduler,
+                         telemetry=task_telemetry.TaskTelemetry("reschedule", 10),
+                         lifecycle_manager=lifecycle.LifecycleManager())
+    scheduler.task_to_pause = task
+    clock.advance(10)
+    assert scheduler.run_pending() == 1
+    scheduler.pausers[0].join(5)
+    clock.advance(100)
+    assert scheduler.run_pending() == 0
+    assert len(run_count) == 2
+
 class timer_test(object):
     def __init__(self):
         self.a = 0
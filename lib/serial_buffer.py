@@ -0,0 +1,348 @@
+"""
+Module to read from a serial connection in bulk
+and hand back complete lines.
+
+This is a compacting buffer, not a ring buffer.
+Reads are appended to one bytearray and consumed
+bytes are dropped from the front now and then.
+"""
+
+import time
+
+DEFAULT_COMPACT_THRESHOLD = 4096
+DEFAULT_THROUGHPUT_WINDOW = 60
+
+
+class BufferedSerialReader(object):
+    """
+    Drains everything waiting on a serial connection with a
+    single read and appends it to a bytearray.
+
+    Lines are taken out by moving a read offset forward.
+    Each line is copied out once, as a str for the caller.
+    The consumed bytes at the front are deleted once the
+    offset passes the compact threshold, which moves what
+    is left down to the start of the buffer. That happens
+    once per threshold of bytes instead of on every line.
+
+    >>> reader = BufferedSerialReader(None, compact_threshold=8)
+    >>> reader.append("OK\\r\\nERROR\\r\\n+CSQ")
+    >>> reader.read_lines()
+    ['OK', 'ERROR']
+    >>> reader.get_buffered_size()
+    4
+    """
+
+    def fill(self):
+        """
+        Reads every byte that is currently waiting.
+        Returns the number of bytes read.
+        """
+
+        if self.__serial_connection__ is None:
+            return 0
+
+        bytes_waiting = self.__serial_connection__.inWaiting()
+
+        if bytes_waiting < 1:
+            return 0
+
+        start_time = time.time()
+        data = self.__serial_connection__.read(bytes_waiting)
+        self.__record_read__(len(data), time.time() - start_time)
+        self.__buffer__.extend(data)
+
+        return len(data)
+
+    def wait_and_fill(self):
+        """
+        Blocks for up to the serial timeout waiting for
+        the first byte, then drains everything else waiting.
+        The wait and the drain are recorded as one read.
+        Returns the number of bytes read.
+
+        >>> reader = BufferedSerialReader(FakeSerialConnection("OK\\r\\n"))
+        >>> reader.wait_and_fill()
+        4
+        >>> reader.get_read_count(), reader.get_total_bytes_read()
+        (1, 4)
+        >>> reader.wait_and_fill()
+        0
+        >>> reader.get_read_count()
+        1
+        """
+
+        if self.__serial_connection__ is None:
+            return 0
+
+        start_time = time.time()
+        data = self.__serial_connection__.read(1)
+
+        if len(data) < 1:
+            return 0
+
+        bytes_waiting = self.__serial_connection__.inWaiting()
+
+        if bytes_waiting > 0:
+            data += self.__serial_connection__.read(bytes_waiting)
+
+        self.__record_read__(len(data), time.time() - start_time)
+        self.__buffer__.extend(data)
+
+        return len(data)
+
+    def set_serial_connection(self, serial_connection):
+        """
+        Reads from a new connection, such as after a reconnect.
+        Anything buffered from the old one is thrown away,
+        but the counters carry on.
+        """
+
+        self.__serial_connection__ = serial_connection
+        self.clear()
+
+    def append(self, data):
+        """
+        Adds data that was read outside of fill().
+        """
+
+        self.__buffer__.extend(data)
+
+    def read_line(self):
+        """
+        Returns the next complete line without the line ending.
+        Returns None if there is not a complete line buffered.
+
+        >>> reader = BufferedSerialReader(None)
+        >>> reader.append("+CSQ: 14,0\\r\\nOK\\r\\n> ")
+        >>> reader.read_line()
+        '+CSQ: 14,0'
+        >>> reader.read_line()
+        'OK'
+        >>> reader.read_line()
+        >>> reader.get_partial()
+        '> '
+        """
+
+        line_end = self.__buffer__.find('\n', self.__read_offset__)
+
+        if line_end < 0:
+            return None
+
+        line = str(self.__buffer__[self.__read_offset__:line_end])
+        self.__read_offset__ = line_end + 1
+        self.__compact__()
+
+        return line.rstrip('\r')
+
+    def read_lines(self):
+        """
+        Returns a list of every complete line that is buffered.
+
+        >>> reader = BufferedSerialReader(None)
+        >>> reader.append("RING\\r\\n\\r\\n+CMTI: \\"SM\\",3\\r\\n+CR")
+        >>> reader.read_lines()
+        ['RING', '', '+CMTI: "SM",3']
+        """
+
+        lines = []
+        line = self.read_line()
+
+        while line is not None:
+            lines.append(line)
+            line = self.read_line()
+
+        return lines
+
+    def get_buffered_size(self):
+        """
+        Returns how many bytes the buffer is holding,
+        including consumed bytes not yet compacted away.
+        """
+
+        return len(self.__buffer__)
+
+    def is_empty(self):
+        """
+        Returns True if nothing is buffered.
+        """
+
+        return self.__read_offset__ >= len(self.__buffer__)
+
+    def get_partial(self):
+        """
+        Returns the text after the last line ending.
+        Used to spot prompts that are not followed by a newline.
+        """
+
+        return str(self.__buffer__[self.__read_offset__:])
+
+    def read_all(self):
+        """
+        Returns everything that is buffered and empties the buffer.
+        """
+
+        buffered_text = str(self.__buffer__[self.__read_offset__:])
+        self.clear()
+
+        return buffered_text
+
+    def clear(self):
+        """
+        Throws away anything that is buffered.
+        """
+
+        del self.__buffer__[:]
+        self.__read_offset__ = 0
+
+    def get_total_bytes_read(self):
+        """
+        Returns the number of bytes read since the reader was created.
+        """
+
+        return self.__total_bytes_read__
+
+    def get_read_count(self):
+        """
+        Returns the number of reads that returned data.
+        """
+
+        return self.__read_count__
+
+    def get_bytes_per_second(self):
+        """
+        Returns the throughput of the most recent
+        complete window, or of the current window
+        if no window has completed yet.
+        """
+
+        self.__roll_throughput_window__()
+
+        if self.__last_window_rate__ is not None:
+            return self.__last_window_rate__
+
+        window_elapsed = time.time() - self.__window_start_time__
+
+        if window_elapsed <= 0:
+            return 0.0
+
+        return self.__window_bytes__ / window_elapsed
+
+    def get_last_read_latency(self):
+        """
+        Returns how long the most recent read took in seconds.
+        """
+
+        return self.__last_read_latency__
+
+    def get_mean_read_latency(self):
+        """
+        Returns the average time a read took in seconds.
+        """
+
+        if self.__read_count__ < 1:
+            return 0.0
+
+        return self.__total_read_latency__ / self.__read_count__
+
+    def get_max_read_latency(self):
+        """
+        Returns the longest time a read took in seconds.
+        """
+
+        return self.__max_read_latency__
+
+    def __record_read__(self, number_of_bytes, read_latency):
+        """
+        Updates the throughput and latency counters.
+        """
+
+        self.__roll_throughput_window__()
+
+        self.__total_bytes_read__ += number_of_bytes
+        self.__window_bytes__ += number_of_bytes
+        self.__read_count__ += 1
+        self.__last_read_latency__ = read_latency
+        self.__total_read_latency__ += read_latency
+        self.__max_read_latency__ = max(self.__max_read_latency__,
+                                        read_latency)
+
+    def __roll_throughput_window__(self):
+        """
+        Starts a new throughput window when the current one is over.
+        """
+
+        window_elapsed = time.time() - self.__window_start_time__
+
+        if window_elapsed >= self.__throughput_window__:
+            self.__last_window_rate__ = self.__window_bytes__ / window_elapsed
+            self.__window_bytes__ = 0
+            self.__window_start_time__ = time.time()
+
+    def __compact__(self):
+        """
+        Drops consumed bytes once enough of them have built up.
+        """
+
+        if self.__read_offset__ >= len(self.__buffer__):
+            self.clear()
+        elif self.__read_offset__ >= self.__compact_threshold__:
+            del self.__buffer__[:self.__read_offset__]
+            self.__read_offset__ = 0
+
+    def __init__(self,
+                 serial_connection,
+                 compact_threshold=DEFAULT_COMPACT_THRESHOLD,
+                 throughput_window=DEFAULT_THROUGHPUT_WINDOW):
+        """
+        Create the reader.
+        """
+
+        self.__serial_connection__ = serial_connection
+        self.__compact_threshold__ = compact_threshold
+        self.__throughput_window__ = throughput_window
+        self.__buffer__ = bytearray()
+        self.__read_offset__ = 0
+
+        self.__total_bytes_read__ = 0
+        self.__read_count__ = 0
+        self.__last_read_latency__ = 0.0
+        self.__total_read_latency__ = 0.0
+        self.__max_read_latency__ = 0.0
+        self.__window_start_time__ = time.time()
+        self.__window_bytes__ = 0
+        self.__last_window_rate__ = None
+
+
+##############
+# UNIT TESTS #
+##############
+
+
+class FakeSerialConnection(object):
+    """
+    A serial connection for the tests
+    that hands back the data it was given.
+    """
+
+    def inWaiting(self):
+        return len(self.data)
+
+    def read(self, size=1):
+        data = self.data[:size]
+        self.data = self.data[size:]
+
+        return data
+
+    def __init__(self, data):
+        self.data = data
+
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
@@ -0,0 +1,248 @@
+"""
+Module to keep a serial connection open.
+
+When the port goes away, such as a USB brown out
+or the modem resetting, the connection is dropped and
+reopened with a growing delay between attempts.
+"""
+
+import sys
+import time
+import threading
+import backoff
+
+DEFAULT_BASE_SECONDS = 2
+DEFAULT_MAXIMUM_SECONDS = 60 * 2
+
+
+class SerialSupervisor(object):
+    """
+    Owns opening the serial connection and
+    tracks how often and for how long it was lost.
+
+    >>> opened = []
+    >>> supervisor = SerialSupervisor(lambda: opened.append(1) or "port", None, 0, 0)
+    >>> supervisor.connect()
+    'port'
+    >>> supervisor.report_failure("unplugged")
+    True
+    >>> supervisor.report_failure("unplugged")
+    False
+    >>> supervisor.reconnect_if_due()
+    'port'
+    >>> supervisor.get_reconnect_count(), len(opened)
+    (1, 2)
+    """
+
+    def get_connection(self):
+        """
+        Returns the open connection, or None.
+        """
+
+        return self.__connection__
+
+    def is_connected(self):
+        """
+        Returns True if there is an open connection.
+        """
+
+        return self.__connection__ is not None
+
+    def connect(self):
+        """
+        Tries to open the connection now.
+        Returns the connection, or None if it could not be opened.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            if self.__connection__ is not None:
+                return self.__connection__
+
+            self.__connect_attempts__ += 1
+
+            try:
+                self.__connection__ = self.__open_connection__()
+            except:
+                self.__log_warning__("Unable to open the serial connection:"
+                                     + str(sys.exc_info()[0]))
+                self.__connection__ = None
+
+            if self.__connection__ is None:
+                self.__next_attempt_time__ = time.time() + backoff.get_backoff_seconds(
+                    self.__failed_attempts__,
+                    self.__base_seconds__,
+                    self.__maximum_seconds__)
+                self.__failed_attempts__ += 1
+                return None
+
+            self.__failed_attempts__ = 0
+
+            if self.__disconnected_time__ is not None:
+                self.__reconnect_count__ += 1
+                self.__last_outage_seconds__ = time.time() - self.__disconnected_time__
+                self.__disconnected_time__ = None
+                self.__log_info__("Serial connection restored after "
+                                  + str(round(self.__last_outage_seconds__, 1))
+                                  + " seconds.")
+
+            return self.__connection__
+        finally:
+            self.__lock__.release()
+
+    def reconnect_if_due(self):
+        """
+        Tries to reopen a lost connection once the
+        backoff delay has passed.
+        Returns the new connection, or None if it was
+        not reopened.
+        """
+
+        if self.__connection__ is not None \
+                or time.time() < self.__next_attempt_time__:
+            return None
+
+        return self.connect()
+
+    def get_next_attempt_time(self):
+        """
+        Returns when the next reconnect may be tried,
+        or None if the connection is open.
+        """
+
+        if self.__connection__ is not None:
+            return None
+
+        return self.__next_attempt_time__
+
+    def report_failure(self, reason):
+        """
+        Drops the connection after an I/O error or a write timeout.
+        Returns True if the connection was open.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            if self.__connection__ is None:
+                return False
+
+            self.__log_warning__("Serial connection lost: " + reason)
+
+            try:
+                self.__connection__.close()
+            except:
+                pass
+
+            self.__connection__ = None
+            self.__disconnect_count__ += 1
+            self.__disconnected_time__ = time.time()
+            self.__next_attempt_time__ = 0
+
+            return True
+        finally:
+            self.__lock__.release()
+
+    def get_reconnect_count(self):
+        """
+        Returns how many times a lost connection was reopened.
+        """
+
+        return self.__reconnect_count__
+
+    def get_disconnected_seconds(self):
+        """
+        Returns how long the connection has been lost,
+        or zero if it is open.
+        """
+
+        if self.__disconnected_time__ is None:
+            return 0.0
+
+        return time.time() - self.__disconnected_time__
+
+    def get_statistics(self):
+        """
+        Returns the connection counters.
+        """
+
+        return {"connected": self.is_connected(),
+                "disconnects": self.__disconnect_count__,
+                "reconnects": self.__reconnect_count__,
+                "connect_attempts": self.__connect_attempts__,
+                "last_outage_seconds": self.__last_outage_seconds__,
+                "disconnected_seconds": self.get_disconnected_seconds()}
+
+    def __log_info__(self, message):
+        """
+        Logs if there is a logger.
+        """
+
+        if self.__logger__ is not None:
+            self.__logger__.log_info_message(message)
+
+    def __log_warning__(self, message):
+        """
+        Logs a warning if there is a logger.
+        """
+
+        if self.__logger__ is not None:
+            self.__logger__.log_warning_message(message)
+
+    def __init__(self,
+                 open_connection,
+                 logger=None,
+                 base_seconds=DEFAULT_BASE_SECONDS,
+                 maximum_seconds=DEFAULT_MAXIMUM_SECONDS):
+        """
+        Create the supervisor. The open_connection function
+        returns a new connection or raises.
+        """
+
+        self.__open_connection__ = open_connection
+        self.__logger__ = logger
+        self.__base_seconds__ = base_seconds
+        self.__maximum_seconds__ = maximum_seconds
+        self.__lock__ = threading.Lock()
+        self.__connection__ = None
+        self.__connect_attempts__ = 0
+        self.__failed_attempts__ = 0
+        self.__next_attempt_time__ = 0
+        self.__disconnect_count__ = 0
+        self.__reconnect_count__ = 0
+        self.__disconnected_time__ = None
+        self.__last_outage_seconds__ = None
+
+
+##############
+# UNIT TESTS #
+##############
+
+
+def test_backoff_between_attempts():
+    """
+    Test that a port that will not open is not retried on every call.
+    """
+    attempts = []
+
+    def open_connection():
+        attempts.append(time.time())
+        raise IOError("No such device")
+
+    supervisor = SerialSupervisor(open_connection, None, 10, 60)
+    assert supervisor.connect() is None
+    assert supervisor.reconnect_if_due() is None
+    assert len(attempts) == 1
+    supervisor.__next_attempt_time__ = 0
+    assert supervisor.reconnect_if_due() is None
+    assert len(attempts) == 2
+    assert supervisor.__next_attempt_time__ - time.time() >= 10
+
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
@@ -0,0 +1,303 @@
+"""
+Module to put concatenated (multipart) text messages
+back together before they are processed.
+"""
+
+import time
+
+DEFAULT_PART_TIMEOUT = 60 * 5
+
+
+class ReassembledSmsMessage(object):
+    """
+    A text message built from its parts.
+    Looks like the first part, but carries the text
+    and SIM indexes of every part.
+    """
+
+    def get_sender_number(self):
+        """
+        Gets the sender's number.
+        """
+        return self.__parts__[0].get_sender_number()
+
+    def get_message_ids(self):
+        """
+        Returns the SIM index of every part.
+        """
+        return self.__message_ids__
+
+    def get_concatenation_info(self):
+        """
+        The parts are already joined.
+        """
+        return None
+
+    def is_message_ok(self):
+        """
+        Did every part arrive, and is every part valid?
+        An incomplete message must never be acted on.
+        """
+        if not self.is_complete():
+            return False
+
+        for part in self.__parts__:
+            if not part.is_message_ok():
+                return False
+
+        return True
+
+    def get_part_count(self):
+        """
+        Returns how many parts arrived.
+        """
+        return len(self.__parts__)
+
+    def is_complete(self):
+        """
+        Did every part arrive?
+        """
+        return self.get_part_count() == self.total_parts
+
+    def minutes_waiting(self):
+        """
+        How many minutes between the first part
+        being sent and received.
+        """
+        return self.__parts__[0].minutes_waiting()
+
+    def message_sent_time_utc(self):
+        """
+        When was the first part sent in UTC time?
+        """
+        return self.__parts__[0].message_sent_time_utc()
+
+    def __init__(self, parts, total_parts, extra_message_ids=None):
+        """
+        Create the message from parts sorted in sequence order.
+        """
+
+        self.__parts__ = parts
+        self.__message_ids__ = [part.message_id for part in parts]
+
+        if extra_message_ids is not None:
+            self.__message_ids__ += extra_message_ids
+
+        self.total_parts = total_parts
+        self.message_id = parts[0].message_id
+        self.sender_number = parts[0].sender_number
+        self.message_status = parts[0].message_status
+        self.received_time = parts[0].received_time
+        self.sent_time = parts[0].sent_time
+        self.message_text = "".join([part.message_text for part in parts])
+        self.error_state = not self.is_message_ok()
+
+
+class MultipartReassembler(object):
+    """
+    Holds the parts of concatenated messages until every
+    part has arrived, keyed by sender and reference number.
+    Parts that wait longer than the timeout are given up on
+    and handed back as an incomplete message so their
+    SIM indexes can be deleted. It is never message_ok.
+    """
+
+    def add_message(self, message):
+        """
+        Adds a message that was read off the SIM.
+        Returns the list of messages that are ready,
+        which is the message itself if it is not a part.
+        """
+
+        concatenation_info = message.get_concatenation_info()
+
+        if concatenation_info is None:
+            return [message]
+
+        reference, total_parts, sequence = concatenation_info
+        key = (message.get_sender_number(), reference, total_parts)
+
+        if key not in self.__pending__:
+            self.__pending__[key] = {"parts": {},
+                                     "extra_ids": [],
+                                     "first_seen": time.time()}
+
+        pending = self.__pending__[key]
+
+        # A resent part replaces the old one, but the old
+        # one still has to be deleted from the SIM.
+        if sequence in pending["parts"]:
+            pending["extra_ids"].append(pending["parts"][sequence].message_id)
+
+        pending["parts"][sequence] = message
+
+        if len(pending["parts"]) < total_parts:
+            return []
+
+        del self.__pending__[key]
+
+        return [self.__assemble__(pending, total_parts)]
+
+    def has_expired_parts(self):
+        """
+        Returns True if any incomplete message has
+        waited longer than the timeout.
+        """
+
+        expire_time = time.time() - self.__part_timeout__
+
+        for pending in self.__pending__.values():
+            if pending["first_seen"] < expire_time:
+                return True
+
+        return False
+
+    def get_next_expiry_time(self):
+        """
+        Returns when the oldest incomplete message expires,
+        or None if nothing is waiting on parts.
+        """
+
+        if len(self.__pending__) < 1:
+            return None
+
+        return min([pending["first_seen"] for pending in self.__pending__.values()]) \
+            + self.__part_timeout__
+
+    def get_expired_messages(self):
+        """
+        Removes and returns every incomplete message that
+        has waited longer than the timeout.
+        """
+
+        expire_time = time.time() - self.__part_timeout__
+        expired_messages = []
+
+        for key in list(self.__pending__.keys()):
+            pending = self.__pending__[key]
+
+            if pending["first_seen"] < expire_time:
+                del self.__pending__[key]
+                expired_messages.append(self.__assemble__(pending, key[2]))
+
+        return expired_messages
+
+    def get_pending_count(self):
+        """
+        Returns how many messages are waiting on parts.
+        """
+
+        return len(self.__pending__)
+
+    def clear(self):
+        """
+        Forgets every part, such as after the SIM is purged.
+        """
+
+        self.__pending__.clear()
+
+    def __assemble__(self, pending, total_parts):
+        """
+        Builds the message from the parts received.
+        """
+
+        parts = [pending["parts"][sequence] for sequence in sorted(pending["parts"])]
+
+        return ReassembledSmsMessage(parts, total_parts, pending["extra_ids"])
+
+    def __init__(self, part_timeout=DEFAULT_PART_TIMEOUT):
+        """
+        Create the reassembler.
+        """
+
+        self.__part_timeout__ = part_timeout
+        self.__pending__ = {}
+
+
+##############
+# UNIT TESTS #
+##############
+
+
+class FakeMessagePart(object):
+    """
+    Stand in for a message part.
+    """
+
+    def get_sender_number(self):
+        """
+        Gets the sender's number.
+        """
+        return self.sender_number
+
+    def get_concatenation_info(self):
+        """
+        Returns reference, total, and sequence.
+        """
+        return self.concatenation_info
+
+    def is_message_ok(self):
+        """
+        Is the message valid?
+        """
+        return True
+
+    def __init__(self, message_id, message_text, concatenation_info, sender_number="2061234567"):
+        self.message_id = message_id
+        self.message_text = message_text
+        self.concatenation_info = concatenation_info
+        self.sender_number = sender_number
+        self.message_status = "REC UNREAD"
+        self.received_time = None
+        self.sent_time = None
+
+
+def test_single_part_passes_through():
+    """
+    Test that a normal message is handed straight back.
+    """
+    reassembler = MultipartReassembler()
+    message = FakeMessagePart("1", "STATUS", None)
+    assert reassembler.add_message(message) == [message]
+
+
+def test_parts_out_of_order():
+    """
+    Test that parts are joined in sequence order.
+    """
+    reassembler = MultipartReassembler()
+    assert reassembler.add_message(FakeMessagePart("5", " please", (42, 2, 2))) == []
+    assert reassembler.add_message(FakeMessagePart("6", "other", (42, 2, 1), "2065550000")) == []
+    messages = reassembler.add_message(FakeMessagePart("4", "STATUS", (42, 2, 1)))
+    assert len(messages) == 1
+    assert messages[0].message_text == "STATUS please"
+    assert messages[0].get_message_ids() == ["4", "5"]
+    assert messages[0].is_complete()
+    assert reassembler.get_pending_count() == 1
+
+
+def test_expired_parts():
+    """
+    Test that incomplete messages are handed back after the timeout.
+    """
+    reassembler = MultipartReassembler(0)
+    reassembler.add_message(FakeMessagePart("1", "STAT", (7, 3, 1)))
+    reassembler.add_message(FakeMessagePart("2", "US", (7, 3, 2)))
+    time.sleep(0.01)
+    assert reassembler.has_expired_parts()
+    messages = reassembler.get_expired_messages()
+    assert len(messages) == 1
+    assert not messages[0].is_complete()
+    assert not messages[0].is_message_ok()
+    assert messages[0].message_text == "STATUS"
+    assert reassembler.get_pending_count() == 0
+
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
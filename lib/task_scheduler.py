@@ -0,0 +1,366 @@
+"""
+Module to run callbacks at given times without
+starting a thread for every call.
+
+One scheduler thread keeps the pending calls in a heap
+ordered by when they are due, and hands each due call
+to a small pool of worker threads. Between calls it
+sleeps on a Wakeup, so it does not poll.
+"""
+
+import sys
+import heapq
+import itertools
+import threading
+import Queue
+import monotonic_clock
+import lifecycle
+from wakeup import Wakeup
+
+DEFAULT_WORKER_COUNT = 3
+
+
+class ScheduledCall(object):
+    """
+    A call waiting in the scheduler.
+    """
+
+    def cancel(self):
+        """
+        Stops the call from running if it has not started.
+        """
+
+        self.__is_cancelled__ = True
+
+    def is_cancelled(self):
+        """
+        Returns True if the call was cancelled.
+        """
+
+        return self.__is_cancelled__
+
+    def __init__(self, run_time, callback, name):
+        """
+        Create the call.
+        """
+
+        self.run_time = run_time
+        self.callback = callback
+        self.name = name
+        self.__is_cancelled__ = False
+
+
+class TaskScheduler(object):
+    """
+    Runs callbacks at times on the monotonic clock.
+    A scheduler with no workers starts no threads; its
+    calls only run when run_pending() is called.
+
+    >>> scheduler = TaskScheduler(1)
+    >>> done = threading.Event()
+    >>> call = scheduler.call_later(0.01, done.set, "test")
+    >>> done.wait(5)
+    True
+    >>> scheduler.stop(5)
+    True
+    """
+
+    def call_at(self, run_time, callback, name=None):
+        """
+        Runs the callback once the monotonic clock reaches the run time.
+        Returns a ScheduledCall that can be cancelled.
+        """
+
+        scheduled_call = ScheduledCall(run_time, callback, name)
+
+        self.__lock__.acquire(True)
+        try:
+            heapq.heappush(self.__schedule__,
+                           (run_time, next(self.__call_ids__), scheduled_call))
+            is_next_call = self.__schedule__[0][2] is scheduled_call
+        finally:
+            self.__lock__.release()
+
+        if is_next_call:
+            self.__wakeup__.signal()
+
+        return scheduled_call
+
+    def call_later(self, delay_seconds, callback, name=None):
+        """
+        Runs the callback after a delay.
+        Returns a ScheduledCall that can be cancelled.
+        """
+
+        return self.call_at(self.get_seconds() + delay_seconds, callback, name)
+
+    def get_seconds(self):
+        """
+        Returns the time on the scheduler's clock.
+        """
+
+        return self.__clock__()
+
+    def run_pending(self):
+        """
+        Runs every call that is due on this thread.
+        Returns how many ran.
+        """
+
+        run_count = 0
+
+        while True:
+            scheduled_call, wait_seconds = self.__take_due_call__()
+
+            if scheduled_call is None:
+                return run_count
+
+            if not scheduled_call.is_cancelled():
+                self.__run_call__(scheduled_call)
+                run_count += 1
+
+    def get_pending_count(self):
+        """
+        Returns how many calls are waiting to come due.
+        """
+
+        return len(self.__schedule__)
+
+    def get_worker_count(self):
+        """
+        Returns the number of worker threads.
+        """
+
+        return len(self.__workers__)
+
+    def is_running(self):
+        """
+        Returns True until the scheduler is stopped.
+        """
+
+        return self.__is_running__
+
+    def stop(self, timeout=None):
+        """
+        Stops the scheduler and its workers.
+        Calls that have not started are dropped.
+        The timeout covers all of the threads together.
+        Returns False if a thread was still running a call.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            self.__is_running__ = False
+            self.__schedule__ = []
+        finally:
+            self.__lock__.release()
+
+        self.__wakeup__.signal()
+
+        for worker in self.__workers__:
+            self.__ready_calls__.put(None)
+
+        deadline = None
+
+        if timeout is not None:
+            deadline = monotonic_clock.get_seconds() + timeout
+
+        is_stopped = True
+
+        for thread in self.__threads__:
+            if thread is threading.current_thread():
+                continue
+
+            if deadline is None:
+                thread.join()
+            else:
+                thread.join(max(0.0, deadline - monotonic_clock.get_seconds()))
+
+            is_stopped = is_stopped and not thread.is_alive()
+
+        return is_stopped
+
+    def __run_scheduler__(self):
+        """
+        The scheduler thread. Sleeps until the next
+        call is due, then hands it to a worker.
+        """
+
+        while self.__is_running__:
+            scheduled_call, wait_seconds = self.__take_due_call__()
+
+            if scheduled_call is None:
+                self.__wakeup__.wait(wait_seconds)
+            elif not scheduled_call.is_cancelled():
+                self.__ready_calls__.put(scheduled_call)
+
+    def __take_due_call__(self):
+        """
+        Removes the next call if it is due.
+        Returns the call and None, or None and the seconds
+        until the next call is due. The seconds are None
+        if nothing is scheduled.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            if len(self.__schedule__) < 1:
+                return None, None
+
+            wait_seconds = self.__schedule__[0][0] - self.get_seconds()
+
+            if wait_seconds > 0:
+                return None, wait_seconds
+
+            return heapq.heappop(self.__schedule__)[2], None
+        finally:
+            self.__lock__.release()
+
+    def __run_worker__(self):
+        """
+        A worker thread. Runs calls as they come due.
+        """
+
+        while True:
+            scheduled_call = self.__ready_calls__.get()
+
+            if scheduled_call is None:
+                return
+
+            if not scheduled_call.is_cancelled():
+                self.__run_call__(scheduled_call)
+
+    def __run_call__(self, scheduled_call):
+        """
+        Runs a call, logging anything it raises.
+        """
+
+        try:
+            scheduled_call.callback()
+        except:
+            self.__log_warning__("Exception in scheduled call "
+                                 + str(scheduled_call.name) + ":"
+                                 + str(sys.exc_info()[0]))
+
+    def __log_warning__(self, message):
+        """
+        Logs a warning if there is a logger.
+        """
+
+        if self.__logger__ is not None:
+            self.__logger__.log_warning_message(message)
+
+    def __init__(self, worker_count=DEFAULT_WORKER_COUNT, logger=None, clock=None):
+        """
+        Create the scheduler and start its threads.
+        The clock is a function that returns seconds,
+        the monotonic clock unless one is given.
+        """
+
+        if clock is None:
+            clock = monotonic_clock.get_seconds
+
+        self.__logger__ = logger
+        self.__clock__ = clock
+        self.__lock__ = threading.Lock()
+        self.__wakeup__ = Wakeup()
+        self.__schedule__ = []
+        self.__call_ids__ = itertools.count()
+        self.__ready_calls__ = Queue.Queue()
+        self.__is_running__ = True
+
+        self.__workers__ = []
+
+        for worker_number in range(worker_count):
+            worker = threading.Thread(target=self.__run_worker__,
+                                      name="task_worker_" + str(worker_number))
+            worker.daemon = True
+            self.__workers__.append(worker)
+
+        self.__threads__ = list(self.__workers__)
+
+        if worker_count > 0:
+            scheduler_thread = threading.Thread(target=self.__run_scheduler__,
+                                                name="task_scheduler")
+            scheduler_thread.daemon = True
+            self.__threads__.insert(0, scheduler_thread)
+
+        for thread in self.__threads__:
+            thread.start()
+
+
+__DEFAULT_SCHEDULER__ = None
+__DEFAULT_SCHEDULER_LOCK__ = threading.Lock()
+
+
+def get_default_scheduler():
+    """
+    Returns the scheduler shared by the whole process,
+    starting it the first time it is asked for.
+    It is stopped when the process shuts down.
+    """
+
+    global __DEFAULT_SCHEDULER__
+
+    __DEFAULT_SCHEDULER_LOCK__.acquire(True)
+    try:
+        if __DEFAULT_SCHEDULER__ is None or not __DEFAULT_SCHEDULER__.is_running():
+            __DEFAULT_SCHEDULER__ = TaskScheduler()
+            lifecycle.get_default_manager().register("task_scheduler",
+                                                     __DEFAULT_SCHEDULER__.stop)
+
+        return __DEFAULT_SCHEDULER__
+    finally:
+        __DEFAULT_SCHEDULER_LOCK__.release()
+
+
+##############
+# UNIT TESTS #
+##############
+
+
+class FakeClock(object):
+    """
+    A clock for the tests that only moves when told to.
+    """
+
+    def get_seconds(self):
+        return self.seconds
+
+    def advance(self, seconds):
+        self.seconds += seconds
+
+    def __init__(self):
+        self.seconds = 1000.0
+
+
+def test_calls_run_in_time_order():
+    """
+    Test that calls run in the order they are due,
+    not the order they were scheduled, and that a
+    cancelled call does not run.
+    """
+    clock = FakeClock()
+    scheduler = TaskScheduler(0, clock=clock.get_seconds)
+    calls = []
+    scheduler.call_later(6, lambda: calls.append("late"))
+    scheduler.call_later(2, lambda: calls.append("early"))
+    scheduler.call_later(4, lambda: calls.append("cancelled")).cancel()
+    assert scheduler.run_pending() == 0
+    clock.advance(5)
+    assert scheduler.run_pending() == 1
+    assert calls == ["early"]
+    clock.advance(1)
+    assert scheduler.run_pending() == 1
+    assert calls == ["early", "late"]
+    assert scheduler.get_pending_count() == 0
+    assert scheduler.stop(0)
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
@@ -0,0 +1,303 @@
+"""
+Module to keep track of how recurring tasks are running.
+
+Every task records its runs in a TaskTelemetry, and every
+TaskTelemetry is kept in one registry so the status
+message and the diagnostics dump can read them all.
+"""
+
+import time
+import threading
+import traceback
+from latency_histogram import LatencyHistogram
+
+# Tasks mostly take milliseconds, so the
+# buckets start finer than the default.
+TASK_DURATION_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 300]
+
+
+class TaskTelemetry(object):
+    """
+    Counters for one recurring task.
+
+    >>> telemetry = TaskTelemetry("update_lcd", 5)
+    >>> telemetry.record_run(0.02)
+    >>> telemetry.record_run(6.0)
+    >>> telemetry.record_missed_ticks(1)
+    >>> telemetry.get_summary_text()
+    'update_lcd: n=2 last=6.0s mean=3.01s p99=10s missed=1 overruns=1 overlaps=0 errors=0'
+    """
+
+    def record_run(self, duration_seconds):
+        """
+        Adds a finished run.
+        A run longer than the interval is an overrun.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            self.__durations__.record(duration_seconds)
+            self.__last_run_time__ = time.time()
+
+            if duration_seconds > self.interval:
+                self.__overrun_count__ += 1
+        finally:
+            self.__lock__.release()
+
+    def record_missed_ticks(self, missed_ticks):
+        """
+        Adds ticks that were skipped because
+        the task was still running.
+        """
+
+        self.__missed_ticks__ += missed_ticks
+
+    def record_overlap(self):
+        """
+        Adds a run that was due while the
+        previous run was still going.
+        """
+
+        self.__overlap_count__ += 1
+
+    def record_exception(self):
+        """
+        Keeps the exception being handled, with its traceback.
+        Must be called from inside an except block.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            self.__exception_count__ += 1
+            self.__last_exception__ = traceback.format_exc()
+            self.__last_exception_time__ = time.time()
+        finally:
+            self.__lock__.release()
+
+    def has_problems(self):
+        """
+        Returns True if the task overran, skipped ticks,
+        overlapped, or raised.
+        """
+
+        return self.__overrun_count__ > 0 or self.__missed_ticks__ > 0 \
+            or self.__overlap_count__ > 0 or self.__exception_count__ > 0
+
+    def get_statistics(self):
+        """
+        Returns the counters.
+        """
+
+        self.__lock__.acquire(True)
+        try:
+            return {"name": self.name,
+                    "interval": self.interval,
+                    "runs": self.__durations__.get_count(),
+                    "last_seconds": self.__durations__.get_last(),
+                    "mean_seconds": self.__durations__.get_mean(),
+                    "p99_seconds": self.__durations__.get_percentile(99),
+                    "max_seconds": self.__durations__.get_max(),
+                    "missed_ticks": self.__missed_ticks__,
+                    "overruns": self.__overrun_count__,
+                    "overlaps": self.__overlap_count__,
+                    "exceptions": self.__exception_count__,
+                    "last_run_time": self.__last_run_time__,
+                    "last_exception": self.__last_exception__,
+                    "last_exception_time": self.__last_exception_time__}
+        finally:
+            self.__lock__.release()
+
+    def get_summary_text(self):
+        """
+        Returns a one line description of the task.
+        """
+
+        statistics = self.get_statistics()
+
+        return self.name + ":" \
+            + " n=" + str(statistics["runs"]) \
+            + " last=" + str(round(statistics["last_seconds"], 2)) + "s" \
+            + " mean=" + str(round(statistics["mean_seconds"], 2)) + "s" \
+            + " p99=" + str(statistics["p99_seconds"]) + "s" \
+            + " missed=" + str(statistics["missed_ticks"]) \
+            + " overruns=" + str(statistics["overruns"]) \
+            + " overlaps=" + str(statistics["overlaps"]) \
+            + " errors=" + str(statistics["exceptions"])
+
+    def __init__(self, name, interval):
+        """
+        Create the counters.
+        """
+
+        self.name = name
+        self.interval = interval
+        self.__lock__ = threading.Lock()
+        self.__durations__ = LatencyHistogram(TASK_DURATION_BUCKETS)
+        self.__missed_ticks__ = 0
+        self.__overrun_count__ = 0
+        self.__overlap_count__ = 0
+        self.__exception_count__ = 0
+        self.__last_run_time__ = None
+        self.__last_exception__ = None
+        self.__last_exception_time__ = None
+
+
+__REGISTRY__ = []
+__REGISTRY_LOCK__ = threading.Lock()
+
+
+def register_task(name, interval):
+    """
+    Creates the telemetry for a task and adds it to the registry.
+    """
+
+    telemetry = TaskTelemetry(name, interval)
+
+    __REGISTRY_LOCK__.acquire(True)
+    try:
+        __REGISTRY__.append(telemetry)
+    finally:
+        __REGISTRY_LOCK__.release()
+
+    return telemetry
+
+
+def get_registered_tasks():
+    """
+    Returns the telemetry of every task, in name order.
+    """
+
+    __REGISTRY_LOCK__.acquire(True)
+    try:
+        return sorted(__REGISTRY__, key=lambda telemetry: telemetry.name)
+    finally:
+        __REGISTRY_LOCK__.release()
+
+
+def get_status_text():
+    """
+    Returns a short line for the status message naming
+    the tasks that overran or raised, or None if none have.
+    The rest of the counters are in the diagnostics.
+    """
+
+    overran_names = []
+    raised_names = []
+
+    for telemetry in get_registered_tasks():
+        statistics = telemetry.get_statistics()
+
+        if statistics["overruns"] > 0:
+            overran_names.append(telemetry.name.strip("_"))
+
+        if statistics["exceptions"] > 0:
+            raised_names.append(telemetry.name.strip("_"))
+
+    if len(overran_names) < 1 and len(raised_names) < 1:
+        return None
+
+    status_text = "Tasks"
+
+    if len(overran_names) > 0:
+        status_text += " overran:" + ",".join(overran_names)
+
+    if len(raised_names) > 0:
+        status_text += " raised:" + ",".join(raised_names)
+
+    return status_text
+
+
+def get_diagnostics_text(extra_lines=None):
+    """
+    Returns the extra lines, then every task's
+    counters and its last exception.
+    """
+
+    lines = ["Diagnostics at " + time.strftime("%Y-%m-%d %H:%M:%S")]
+
+    if extra_lines is not None:
+        lines.extend(extra_lines)
+
+    for telemetry in get_registered_tasks():
+        lines.append(telemetry.get_summary_text())
+
+        last_exception = telemetry.get_statistics()["last_exception"]
+
+        if last_exception is not None:
+            lines.append(last_exception.rstrip())
+
+    return "\n".join(lines) + "\n"
+
+
+def write_diagnostics(file_path, extra_lines=None):
+    """
+    Writes the diagnostics, after the extra lines, to a file.
+    Returns True if it was written.
+    """
+
+    try:
+        with open(file_path, "w") as diagnostics_file:
+            diagnostics_file.write(get_diagnostics_text(extra_lines))
+        return True
+    except:
+        return False
+
+
+##############
+# UNIT TESTS #
+##############
+
+
+def test_exception_keeps_traceback():
+    """
+    Test that the last exception is kept with its traceback.
+    """
+    telemetry = TaskTelemetry("failing", 1)
+    try:
+        raise ValueError("sensor unplugged")
+    except ValueError:
+        telemetry.record_exception()
+    last_exception = telemetry.get_statistics()["last_exception"]
+    assert "Traceback" in last_exception
+    assert "sensor unplugged" in last_exception
+    assert telemetry.has_problems()
+
+
+def test_status_names_only_failing_tasks():
+    """
+    Test that the status line is empty while every task
+    is healthy, and names the tasks that overran or raised.
+    """
+    registered_tasks = __REGISTRY__[:]
+    del __REGISTRY__[:]
+
+    try:
+        healthy = register_task("update_lcd", 5)
+        healthy.record_run(0.02)
+        healthy.record_missed_ticks(1)
+        assert get_status_text() is None
+
+        register_task("__monitor_gas_sensor__", 1).record_run(2.0)
+        failing = register_task("battery_check", 300)
+        try:
+            raise ValueError("no battery")
+        except ValueError:
+            failing.record_exception()
+        assert get_status_text() == "Tasks overran:monitor_gas_sensor raised:battery_check"
+
+        diagnostics_text = get_diagnostics_text(["Serial:9600 baud"])
+        assert diagnostics_text.splitlines()[1] == "Serial:9600 baud"
+        assert "update_lcd: n=1" in diagnostics_text
+        assert "no battery" in diagnostics_text
+    finally:
+        __REGISTRY__[:] = registered_tasks
+
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
@@ -0,0 +1,94 @@
+"""
+Module to limit how fast something can happen.
+"""
+
+import time
+
+
+class TokenBucket(object):
+    """
+    Holds up to a capacity of tokens and refills
+    at a steady rate. Taking more than is available
+    is refused, so bursts are allowed up to the
+    capacity while the long run rate is capped.
+
+    >>> bucket = TokenBucket(2, 1)
+    >>> bucket.try_consume(), bucket.try_consume(), bucket.try_consume()
+    (True, True, False)
+    >>> 0 < bucket.get_seconds_until_available() <= 1
+    True
+    """
+
+    def try_consume(self, tokens=1):
+        """
+        Takes tokens if there are enough.
+        Asking for more than the capacity asks for all of it.
+        Returns True if they were taken.
+        """
+
+        tokens = min(tokens, self.__capacity__)
+        self.__refill__()
+
+        if self.__tokens__ < tokens:
+            return False
+
+        self.__tokens__ -= tokens
+
+        return True
+
+    def get_seconds_until_available(self, tokens=1):
+        """
+        Returns how long until the tokens can be taken.
+        Returns zero if they can be taken now.
+        """
+
+        tokens = min(tokens, self.__capacity__)
+        self.__refill__()
+
+        if self.__tokens__ >= tokens:
+            return 0.0
+
+        if self.__tokens_per_second__ <= 0:
+            return float('inf')
+
+        return (tokens - self.__tokens__) / self.__tokens_per_second__
+
+    def get_tokens(self):
+        """
+        Returns how many tokens are available.
+        """
+
+        self.__refill__()
+
+        return self.__tokens__
+
+    def __refill__(self):
+        """
+        Adds the tokens earned since the last refill.
+        """
+
+        current_time = time.time()
+        elapsed_seconds = max(current_time - self.__last_refill_time__, 0)
+        self.__last_refill_time__ = current_time
+        self.__tokens__ = min(self.__capacity__,
+                              self.__tokens__ + elapsed_seconds * self.__tokens_per_second__)
+
+    def __init__(self, capacity, tokens_per_second):
+        """
+        Create a full bucket.
+        """
+
+        self.__capacity__ = float(capacity)
+        self.__tokens_per_second__ = float(tokens_per_second)
+        self.__tokens__ = float(capacity)
+        self.__last_refill_time__ = time.time()
+
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
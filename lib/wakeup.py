@@ -0,0 +1,178 @@
+"""
+Module to let a service loop sleep until there is work.
+
+The loop blocks in select() on a pipe, so while it is idle
+the thread does not run at all until a signal writes to the
+pipe or the timeout passes. Python 2.7's Condition.wait()
+with a timeout is not used because it polls, waking up to
+20 times a second.
+"""
+
+import os
+import errno
+import fcntl
+import select
+import threading
+import time
+
+
+class Wakeup(object):
+    """
+    A single thing the service loop blocks on.
+    Anything that hands the loop work signals it.
+    A signal that arrives while the loop is busy
+    is kept in the pipe, so the next wait returns at once.
+
+    >>> wakeup = Wakeup()
+    >>> wakeup.wait(0)
+    False
+    >>> wakeup.signal()
+    >>> wakeup.signal()
+    >>> wakeup.wait(10)
+    True
+    >>> wakeup.wait(0)
+    False
+    """
+
+    def signal(self):
+        """
+        Wakes the loop.
+        Safe to call from any thread, or from a
+        signal handler on the thread that waits,
+        as it takes no lock.
+        """
+
+        self.__signal_count__ += 1
+
+        try:
+            os.write(self.__write_fd__, "x")
+        except OSError as error:
+            # A full pipe is already signalled.
+            if error.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout):
+        """
+        Blocks until signalled, or until the timeout passes.
+        A timeout of None waits until signalled.
+        Clears the signal.
+        Returns True if it was signalled.
+        """
+
+        if timeout is not None:
+            timeout = max(0, timeout)
+
+        try:
+            readable = select.select([self.__read_fd__], [], [], timeout)[0]
+        except select.error as error:
+            if error.args[0] != errno.EINTR:
+                raise
+
+            # A signal handler ran, and may have signalled.
+            readable = select.select([self.__read_fd__], [], [], 0)[0]
+
+        was_signalled = len(readable) > 0
+
+        if was_signalled:
+            self.__drain__()
+            self.__signalled_wakes__ += 1
+        else:
+            self.__timeout_wakes__ += 1
+
+        return was_signalled
+
+    def get_statistics(self):
+        """
+        Returns how often the loop was signalled
+        and how it woke up.
+        """
+
+        return {"signals": self.__signal_count__,
+                "signalled_wakes": self.__signalled_wakes__,
+                "timeout_wakes": self.__timeout_wakes__}
+
+    def close(self):
+        """
+        Closes the pipe.
+        """
+
+        os.close(self.__read_fd__)
+        os.close(self.__write_fd__)
+
+    def __drain__(self):
+        """
+        Reads every signal waiting in the pipe.
+        """
+
+        try:
+            while len(os.read(self.__read_fd__, 4096)) > 0:
+                pass
+        except OSError as error:
+            if error.errno != errno.EAGAIN:
+                raise
+
+    def __init__(self):
+        """
+        Create the wakeup.
+        """
+
+        self.__read_fd__, self.__write_fd__ = os.pipe()
+
+        # Neither end may block: the reader drains
+        # until empty, and a signal handler must
+        # never wait on a full pipe.
+        for pipe_fd in [self.__read_fd__, self.__write_fd__]:
+            fcntl.fcntl(pipe_fd, fcntl.F_SETFL,
+                        fcntl.fcntl(pipe_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        self.__signal_count__ = 0
+        self.__signalled_wakes__ = 0
+        self.__timeout_wakes__ = 0
+
+
+def get_seconds_until(deadlines, maximum_seconds):
+    """
+    Returns how long to sleep until the earliest deadline,
+    never more than the maximum and never less than zero.
+    Deadlines of None are ignored.
+
+    >>> get_seconds_until([None, time.time() - 5], 30)
+    0.0
+    >>> get_seconds_until([None], 30)
+    30
+    """
+
+    upcoming = [deadline for deadline in deadlines if deadline is not None]
+
+    if len(upcoming) < 1:
+        return maximum_seconds
+
+    return min(maximum_seconds, max(0.0, min(upcoming) - time.time()))
+
+
+##############
+# UNIT TESTS #
+##############
+
+
+def test_signal_from_another_thread():
+    """
+    Test that a signal from another thread ends the wait early.
+    """
+    wakeup = Wakeup()
+    threading.Timer(0.05, wakeup.signal).start()
+    start_time = time.time()
+    assert wakeup.wait(5)
+    assert time.time() - start_time < 1
+    assert wakeup.get_statistics()["signalled_wakes"] == 1
+    wakeup.close()
+
+
+if __name__ == '__main__':
+    import doctest
+
+    print "Starting tests."
+
+    doctest.testmod()
+
+    print "Tests finished"
@@ -3,12 +3,24 @@
 # encoding: UTF-8
 
 import time
-import Queue
-from multiprocessing import Queue as MPQueue
 
 import text
 import lib.utilities as utilities
 from lib.relay import PowerRelay
+from lib.event_bus import EventBus
+
+
+class HeaterCommand(object):
+    """
+    Event telling the heater what to do.
+    The action is text.HEATER_ON_COMMAND,
+    text.HEATER_OFF_COMMAND, or text.MAX_TIME.
+    """
+
+    __slots__ = ("action",)
+
+    def __init__(self, action):
+        self.action = action
 
 
 class RelayManager(object):
@@ -22,7 +34,7 @@ class RelayManager(object):
         """
 
         if not self.is_relay_on():
-            self.__heater_queue__.put(text.HEATER_ON_COMMAND)
+            self.__queue_heater_command__(text.HEATER_ON_COMMAND)
             return True
 
         return False
@@ -32,7 +44,7 @@ class RelayManager(object):
         Tells the heater to turn off.
         """
         if self.is_relay_on():
-            self.__heater_queue__.put(text.HEATER_OFF_COMMAND)
+            self.__queue_heater_command__(text.HEATER_OFF_COMMAND)
             return True
 
         return False
@@ -73,40 +85,46 @@ class RelayManager(object):
 
         return time_remaining
 
+    def get_next_update_time(self):
+        """
+        Returns when update() next has work that nothing
+        will signal, which is the heater shutoff,
+        or None if the heater is not timed.
+        """
+
+        return self.__heater_shutoff_timer__
+
     def update(self):
         """
-        Services the queue from the heater service thread.
+        Services the heater commands from the heater service thread.
         """
 
         self.__update_shutoff_timer__()
 
-        # check the queue to deal with various issues,
+        # handle the commands to deal with various issues,
         # such as Max heater time and the gas sensor being tripped
-        while not self.__heater_queue__.empty():
-            try:
-                status_queue = self.__heater_queue__.get()
-
-                if text.HEATER_ON_COMMAND in status_queue:
-                    self.__start_heater_immediate__()
-
-                if text.HEATER_OFF_COMMAND in status_queue:
-                    self.__stop_heater_immediate__()
-
-                if text.MAX_TIME in status_queue:
-                    self.__max_time_immediate__()
-            except Queue.Empty:
-                pass
+        self.__heater_commands__.dispatch()
 
     def __init__(self,
                  configuration,
                  logger,
                  heater_on_callback,
                  heater_off_callback,
-                 heater_max_time_callback):
-        """ Initialize the object. """
+                 heater_max_time_callback,
+                 wakeup=None,
+                 event_bus=None):
+        """
+        Initialize the object.
+        Heater commands go through the event bus, which signals
+        the wakeup when the heater has been told to change.
+        """
 
         self.__configuration__ = configuration
         self.__logger__ = logger
+        self.__event_bus__ = event_bus
+
+        if self.__event_bus__ is None:
+            self.__event_bus__ = EventBus(wakeup)
         self.__on_callback__ = heater_on_callback
         self.__off_callback__ = heater_off_callback
         self.__max_time_callback__ = heater_max_time_callback
@@ -114,7 +132,11 @@ class RelayManager(object):
         # create heater relay instance
         self.__heater_relay__ = PowerRelay(
             "heater_relay", configuration.heater_pin)
-        self.__heater_queue__ = MPQueue()
+        # Unbounded, so a command to turn the heater
+        # off can never be turned away by a full queue.
+        self.__heater_commands__ = self.__event_bus__.subscribe(HeaterCommand,
+                                                                self.__heater_command_received__,
+                                                                None)
 
         # create queue to hold heater timer.
         self.__heater_shutoff_timer__ = None
@@ -122,6 +144,26 @@ class RelayManager(object):
         # make sure and turn heater off
         self.__heater_relay__.switch_low()
 
+    def __queue_heater_command__(self, command):
+        """
+        Queues a command for the heater.
+        The event bus wakes the service loop.
+        """
+
+        self.__event_bus__.publish(HeaterCommand(command))
+
+    def __heater_command_received__(self, heater_command):
+        """
+        Carries out a queued heater command.
+        """
+
+        if heater_command.action == text.HEATER_ON_COMMAND:
+            self.__start_heater_immediate__()
+        elif heater_command.action == text.HEATER_OFF_COMMAND:
+            self.__stop_heater_immediate__()
+        elif heater_command.action == text.MAX_TIME:
+            self.__max_time_immediate__()
+
     def __max_time_immediate__(self):
         """
         Trigger everything associated with the timer
@@ -197,9 +239,57 @@ class RelayManager(object):
 
         if self.__heater_shutoff_timer__ is not None \
                 and self.__heater_shutoff_timer__ < time.time():
-            self.__heater_queue__.put(text.MAX_TIME)
+            self.__queue_heater_command__(text.MAX_TIME)
         elif self.__heater_shutoff_timer__ is None \
                 and self.is_relay_on():
             self.__logger__.log_warning_message(
                 "Heater should not be on, but the PIN is still active... attempting shutdown.")
-            self.__heater_queue__.put(text.HEATER_OFF_COMMAND)
+            self.__queue_heater_command__(text.HEATER_OFF_COMMAND)
+
+
+##############
+# UNIT TESTS #
+##############
+
+
+class FakeConfiguration(object):
+    """
+    The settings the relay manager reads.
+    """
+
+    def __init__(self):
+        self.heater_pin = 22
+        self.max_minutes_to_run = 60
+
+
+class NullLogger(object):
+    """
+    A logger that keeps nothing.
+    """
+
+    def log_info_message(self, message_to_log, print_to_screen=True):
+        pass
+
+    def log_warning_message(self, message_to_log):
+        pass
+
+
+def test_off_is_never_dropped():
+    """
+    Test that turning the heater off works even when
+    more commands are waiting than a bounded queue holds.
+    """
+    from lib.event_bus import DEFAULT_MAXIMUM_PENDING
+
+    relay_manager = RelayManager(FakeConfiguration(), NullLogger(), None, None, None)
+    relay_manager.turn_on()
+    relay_manager.update()
+    assert relay_manager.is_relay_on()
+
+    for command_number in range(DEFAULT_MAXIMUM_PENDING * 2):
+        relay_manager.__queue_heater_command__(text.HEATER_ON_COMMAND)
+
+    assert relay_manager.turn_off()
+    relay_manager.update()
+    assert not relay_manager.is_relay_on()
+    assert relay_manager.get_next_update_time() is None
@@ -5,8 +5,6 @@ Module to hold common text messages and strings.
 MAX_TIME = "MAX_TIME"
 GAS_WARNING = "Gas warning"
 GAS_OK = "OK"
-CHECK_SIGNAL = "SIGNAL"
-CHECK_BATTERY = "BATTERY"
 ERROR = "ERROR"
 NOOP = "NOOP"
 